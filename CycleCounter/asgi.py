@@ -1,7 +1,8 @@
 """
 ASGI config for CycleCounter project.
 
-It exposes the ASGI callable as a module-level variable named ``application``.
+It exposes the ASGI callable as a module-level variable named ``application``. HTTP goes to Django as before,
+WebSockets to the Channels consumers in cyclecount/routing.py.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/4.1/howto/deployment/asgi/
@@ -9,8 +10,20 @@ https://docs.djangoproject.com/en/4.1/howto/deployment/asgi/
 
 import os
 
+from channels.auth import AuthMiddlewareStack
+from channels.routing import ProtocolTypeRouter, URLRouter
+from channels.security.websocket import AllowedHostsOriginValidator
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'CycleCounter.settings')
 
-application = get_asgi_application()
+# Sets up Django, before anything imports the models
+django_application = get_asgi_application()
+
+from cyclecount.routing import websocket_urlpatterns  # noqa: E402
+
+application = ProtocolTypeRouter({
+    'http': django_application,
+    # Session cookie auth, so only accept sockets opened by pages from ALLOWED_HOSTS
+    'websocket': AllowedHostsOriginValidator(AuthMiddlewareStack(URLRouter(websocket_urlpatterns))),
+})
@@ -0,0 +1,114 @@
+import functools
+from contextvars import ContextVar
+from typing import Callable, Iterable, Iterator, List, Optional
+
+import structlog
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+from django.http import HttpRequest, HttpResponse
+
+
+log = structlog.get_logger(__name__)
+
+'''
+Sends the reads of the read only views (inventory grid, session list/review, exports) to a replica of default,
+so supervisors paging through big tables don't compete with associates' scan writes on the primary.
+
+- Views opt in with @replica_reads, everything else (writes, select_for_update, sessions/auth in the middleware)
+  stays on default.
+- Read your writes: a request that wrote anything pins the user to the primary for REPLICA_STICKY_SECONDS (a
+  cookie set by PrimaryAfterWriteMiddleware), long enough for the replica to catch up, so e.g. the session list
+  right after finalizing a session doesn't show it as still open.
+- REPLICA_DATABASE_ALIAS = None (the default) turns it all off.
+'''
+
+# True while a @replica_reads view is running
+_reads_from_replica: ContextVar[bool] = ContextVar('reads_from_replica', default=False)
+# Set per request by PrimaryAfterWriteMiddleware, the router adds to it when anything is written
+_writes: ContextVar[Optional[List[str]]] = ContextVar('writes', default=None)
+
+
+class ReplicaRouter:
+
+    def db_for_read(self, model, **hints) -> Optional[str]:
+        if settings.REPLICA_DATABASE_ALIAS and _reads_from_replica.get():
+            return settings.REPLICA_DATABASE_ALIAS
+        return DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints) -> Optional[str]:
+        writes = _writes.get()
+        if writes is not None:
+            writes.append(model._meta.label)
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints) -> Optional[bool]:
+        # Same data either way
+        return True
+
+    def allow_migrate(self, db: str, app_label: str, model_name: Optional[str] = None, **hints) -> Optional[bool]:
+        # The replica gets its schema from the primary
+        return db == DEFAULT_DB_ALIAS
+
+
+def _pinned_to_primary(request: HttpRequest) -> bool:
+    return settings.REPLICA_PIN_COOKIE in request.COOKIES
+
+
+def _streamed_from_replica(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    # Streamed responses are read after the view returned, route each chunk's reads while it is produced (only
+    # then, a half consumed stream mustn't leave the thread reading from the replica).
+    iterator = iter(chunks)
+    while True:
+        token = _reads_from_replica.set(True)
+        try:
+            chunk = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            _reads_from_replica.reset(token)
+        yield chunk
+
+
+def replica_reads(view: Callable[..., HttpResponse]) -> Callable[..., HttpResponse]:
+    """
+    Run a read only view's queries against the replica, unless the user just wrote something. Goes under
+    @login_required, so the user is loaded from the primary.
+    """
+    @functools.wraps(view)
+    def wrapper(request: HttpRequest, *args, **kwargs) -> HttpResponse:
+        if not settings.REPLICA_DATABASE_ALIAS or request.method not in ('GET', 'HEAD') \
+                or _pinned_to_primary(request):
+            return view(request, *args, **kwargs)
+
+        token = _reads_from_replica.set(True)
+        try:
+            response = view(request, *args, **kwargs)
+        finally:
+            _reads_from_replica.reset(token)
+        if response.streaming:
+            response.streaming_content = _streamed_from_replica(response.streaming_content)
+        return response
+    return wrapper
+
+
+class PrimaryAfterWriteMiddleware:
+    # Goes before SessionMiddleware, so a session save counts as a write too.
+
+    def __init__(self, get_response: Callable[[HttpRequest], HttpResponse]):
+        self.get_response = get_response
+
+    def __call__(self, request: HttpRequest) -> HttpResponse:
+        if not settings.REPLICA_DATABASE_ALIAS:
+            return self.get_response(request)
+
+        writes: List[str] = []
+        token = _writes.set(writes)
+        try:
+            response = self.get_response(request)
+        finally:
+            _writes.reset(token)
+        if writes:
+            response.set_cookie(settings.REPLICA_PIN_COOKIE, '1', max_age=settings.REPLICA_STICKY_SECONDS,
+                                httponly=True, samesite='Lax')
+            log.debug('pinned to primary', models=sorted(set(writes)), seconds=settings.REPLICA_STICKY_SECONDS)
+        return response
@@ -0,0 +1,130 @@
+import re
+import time
+from collections import Counter
+from contextlib import ExitStack
+from typing import Callable, Dict, Optional, Tuple
+
+import structlog
+from django.conf import settings
+from django.db import connections
+from django.dispatch import receiver
+from django.http import HttpRequest, HttpResponse
+from django_structlog import signals
+
+
+log = structlog.get_logger(__name__)
+
+'''
+Per request SQL instrumentation.
+
+SqlStatsMiddleware installs a database execute wrapper (on every connection) for the duration of the request,
+which times each statement with PerfTrack. The totals end up on the django_structlog request_finished (or
+request_failed) event in logs/json.log, e.g.
+
+    "sql": {"count": 12, "ms": 8.4, "slowest": [{"sql": "SELECT ... WHERE id = %s", "ms": 3.1, "count": 1}, ...],
+            "duplicates": [{"sql": "SELECT ... FROM cyclecount_product WHERE id = %s", "count": 100}]}
+
+Statements are normalized before grouping (literals and IN lists collapsed) so the same query with different
+parameters counts as a duplicate, which is what an N+1 looks like. Parameters are never logged.
+'''
+
+NUMBER_LITERAL = re.compile(r'\b\d+(\.\d+)?\b')
+STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+PLACEHOLDER_LIST = re.compile(r'\((\s*%s\s*,)+\s*%s\s*\)')
+WHITESPACE = re.compile(r'\s+')
+
+
+class PerfTrack:
+    def __enter__(self):
+        self.time = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.result = time.perf_counter() - self.time
+
+
+def normalize_sql(sql: str) -> str:
+    sql = STRING_LITERAL.sub('?', sql)
+    sql = NUMBER_LITERAL.sub('?', sql)
+    sql = PLACEHOLDER_LIST.sub('(...)', sql)
+    return WHITESPACE.sub(' ', sql).strip()[:settings.SQL_STATS_MAX_SQL_LENGTH]
+
+
+class QueryStats:
+    """
+    A database execute wrapper (see connection.execute_wrapper) that keeps count of what went through it.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        # normalized sql -> (executions, seconds)
+        self.statements: Dict[str, Tuple[int, float]] = {}
+
+    def __call__(self, execute: Callable, sql: str, params, many: bool, context: Dict):
+        pt = PerfTrack()
+        try:
+            with pt:
+                return execute(sql, params, many, context)
+        finally:
+            # Recorded even if the statement failed, it still went to the database
+            self._record(sql, pt.result)
+
+    def _record(self, sql: str, seconds: float) -> None:
+        self.count += 1
+        self.seconds += seconds
+        normalized = normalize_sql(sql)
+        (executions, total) = self.statements.get(normalized, (0, 0.0))
+        self.statements[normalized] = (executions + 1, total + seconds)
+
+    def summary(self) -> Dict:
+        """
+        :return: count, ms, the slowest statements (total time over all executions) and the repeated ones
+        """
+        slowest = sorted(self.statements.items(), key=lambda item: item[1][1], reverse=True)
+        repeated = Counter({sql: executions for (sql, (executions, _)) in self.statements.items()
+                            if executions >= settings.SQL_STATS_DUPLICATE_THRESHOLD})
+        return {
+            'count': self.count,
+            'ms': round(self.seconds * 1000, 2),
+            'slowest': [{'sql': sql, 'ms': round(seconds * 1000, 2), 'count': executions}
+                        for (sql, (executions, seconds)) in slowest[:settings.SQL_STATS_SLOWEST]],
+            'duplicates': [{'sql': sql, 'count': executions}
+                           for (sql, executions) in repeated.most_common(settings.SQL_STATS_SLOWEST)],
+        }
+
+
+class SqlStatsMiddleware:
+    # Goes right after django_structlog's RequestMiddleware so everything the view and the inner middleware run
+    # is counted.
+
+    def __init__(self, get_response: Callable[[HttpRequest], HttpResponse]):
+        self.get_response = get_response
+
+    def __call__(self, request: HttpRequest) -> HttpResponse:
+        stats = QueryStats()
+        request.sql_stats = stats
+        with ExitStack() as stack:
+            # Wrapping doesn't open a database connection, aliases the request never touches cost nothing
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(stats))
+            return self.get_response(request)
+
+
+def _sql_summary(request: HttpRequest) -> Optional[Dict]:
+    stats: Optional[QueryStats] = getattr(request, 'sql_stats', None)
+    return stats.summary() if stats is not None else None
+
+
+@receiver(signals.bind_extra_request_finished_metadata)
+def add_sql_stats_to_request_finished(request: HttpRequest, log_kwargs: Dict, **kwargs) -> None:
+    summary = _sql_summary(request)
+    if summary is not None:
+        log_kwargs['sql'] = summary
+
+
+@receiver(signals.bind_extra_request_failed_metadata)
+def add_sql_stats_to_request_failed(request: HttpRequest, log_kwargs: Dict, **kwargs) -> None:
+    summary = _sql_summary(request)
+    if summary is not None:
+        log_kwargs['sql'] = summary
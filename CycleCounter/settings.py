@@ -44,6 +44,8 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django_structlog.middlewares.RequestMiddleware',
+    'CycleCounter.perf.SqlStatsMiddleware',
+    'CycleCounter.db_router.PrimaryAfterWriteMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -72,6 +74,15 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'CycleCounter.wsgi.application'
+# The WebSocket scan channel (cyclecount.consumers) needs the ASGI app, e.g. daphne CycleCounter.asgi:application
+ASGI_APPLICATION = 'CycleCounter.asgi.application'
+
+# In memory only works with a single ASGI process, use channels_redis.core.RedisChannelLayer for more.
+CHANNEL_LAYERS = {
+    'default': {
+        'BACKEND': 'channels.layers.InMemoryChannelLayer',
+    },
+}
 
 
 # Database
@@ -90,6 +101,19 @@ DATABASES = {
     }
 }
 
+# A streaming replica of default for the read only views, see CycleCounter.db_router. To use the replica service
+# from docker-compose.yml, set its 'PORT': 5434 here and REPLICA_DATABASE_ALIAS = 'replica' below. The tests run it
+# as a mirror of default (which only swaps the database NAME, so the host/port must reach the test database).
+DATABASES['replica'] = {
+    **DATABASES['default'],
+    'TEST': {'MIRROR': 'default'},
+}
+DATABASE_ROUTERS = ['CycleCounter.db_router.ReplicaRouter']
+REPLICA_DATABASE_ALIAS = None
+# After a request writes anything, that user reads from default for this long (longer than the replication lag)
+REPLICA_STICKY_SECONDS = 10
+REPLICA_PIN_COOKIE = 'primary_pin'
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.1/ref/settings/#auth-password-validators
@@ -113,6 +137,64 @@ AUTH_USER_MODEL = 'cyclecount.CustomUser'
 
 LOGIN_REDIRECT_URL = '/'
 
+# Max number of scans a handheld can submit in one request to cyclecount:scan_batch
+SCAN_BATCH_MAX_SIZE = 500
+# Scans sent over the scan WebSocket are inserted in batches of up to this many, or this long after the first
+# scan of a batch came in.
+SCAN_SOCKET_BATCH_SIZE = 50
+SCAN_SOCKET_FLUSH_SECONDS = 0.1
+# Max number of changes sent back by one sync (cyclecount.sync), the handheld syncs again if there are more
+SYNC_PAGE_SIZE = 1000
+
+# The product service that owns Product records (python manage.py product_service_stub stands in for it locally)
+PRODUCT_SERVICE_URL = 'http://127.0.0.1:8001'
+# Max number of ids sent in a single bulk lookup to the product service
+PRODUCT_SERVICE_BULK_CHUNK_SIZE = 100
+# Set to False for product service deployments without the bulk (?ids=) lookup, ProductClient then
+# fans out single product requests with at most PRODUCT_SERVICE_MAX_IN_FLIGHT outstanding at once.
+PRODUCT_SERVICE_BULK_LOOKUP = True
+PRODUCT_SERVICE_MAX_IN_FLIGHT = 16
+PRODUCT_SERVICE_TIMEOUT_SECONDS = 2.0
+
+# Product lookups from the inventory grid go through inventory.product_cache.ProductCache
+PRODUCT_CACHE_MAX_ENTRIES = 50000
+PRODUCT_CACHE_TTL_SECONDS = 300
+# How long we remember that a product doesn't exist (404 from the product service)
+PRODUCT_CACHE_NEGATIVE_TTL_SECONDS = 60
+# Alias in CACHES for the shared second tier (e.g. memcached/redis), None to only cache in process.
+PRODUCT_CACHE_SHARED_ALIAS = None
+
+# Open sessions and locations seen by the scan pages, see cyclecount.scan_context. Other processes pick up a
+# finalized session after at most the TTL when there's no shared tier (scans are refused either way).
+SCAN_CONTEXT_TTL_SECONDS = 30
+SCAN_CONTEXT_MAX_ENTRIES = 10000
+# Alias in CACHES for the shared second tier, None to only cache in process.
+SCAN_CONTEXT_SHARED_ALIAS = None
+
+# Rows fetched per round trip by the server-side cursor behind the inventory export (inventory.export)
+INVENTORY_EXPORT_CHUNK_SIZE = 2000
+
+# Accepted sessions are applied to Inventory by manage.py finalize_worker (cyclecount.finalize_jobs), this many
+# (location, product) keys per transaction.
+FINALIZE_CHUNK_SIZE = 5000
+# A running job whose worker hasn't reported progress for this long is taken over by another worker. Has to be
+# well over the time a chunk takes.
+FINALIZE_JOB_STALE_SECONDS = 300
+# Failed or abandoned jobs are retried until they have been tried this many times, then left FAILED
+FINALIZE_JOB_MAX_ATTEMPTS = 3
+# Tries for a finalize chunk that Postgres rolls back as a deadlock/serialization failure, with a random backoff
+# of up to FINALIZE_RETRY_BACKOFF_SECONDS * 2^attempt in between.
+FINALIZE_RETRY_ATTEMPTS = 5
+FINALIZE_RETRY_BACKOFF_SECONDS = 0.05
+# How long an idle finalize_worker waits before looking at the queue again
+FINALIZE_WORKER_POLL_SECONDS = 2.0
+
+# CycleCounter.perf.SqlStatsMiddleware adds query count/time to the request_finished log event, along with the
+# SQL_STATS_SLOWEST slowest statements and the ones run at least SQL_STATS_DUPLICATE_THRESHOLD times (N+1s).
+SQL_STATS_SLOWEST = 5
+SQL_STATS_DUPLICATE_THRESHOLD = 3
+SQL_STATS_MAX_SQL_LENGTH = 300
+
 # Internationalization
 # https://docs.djangoproject.com/en/4.1/topics/i18n/
 
@@ -1,5 +1,6 @@
 from django.contrib import admin
-from .models import Location, Product, Inventory, CountSession, IndividualCount, CycleCountModification, CustomUser
+from .models import Location, Product, CasePack, Inventory, CountSession, IndividualCount, SessionTally, CycleCountModification, \
+    CustomUser, FinalizeJob
 
 
 class ProductAdmin(admin.ModelAdmin):
@@ -10,22 +11,43 @@ class LocationAdmin(admin.ModelAdmin):
     list_display = ('id', 'description')
 
 
+class CasePackAdmin(admin.ModelAdmin):
+    list_display = ('id', 'barcode', 'product', 'qty')
+
+
 class InventoryAdmin(admin.ModelAdmin):
     list_display = ('id', 'qty', 'location', 'product')
 
 
 class CountSessionAdmin(admin.ModelAdmin):
-    list_display = ('id', 'created_by', 'final_state', 'count_of_individual_counts')
+    list_display = ('id', 'created_by', 'final_state', 'total_scans', 'active_scans', 'distinct_locations',
+                    'distinct_skus', 'last_scan_at')
+    list_select_related = ('created_by',)
+    # Maintained by the scans, see cyclecount.tallies
+    readonly_fields = ('total_scans', 'active_scans', 'distinct_locations', 'distinct_skus', 'last_scan_at')
 
 
 class IndividualCountAdmin(admin.ModelAdmin):
     list_display = ('id', 'session_id', 'associate_id', 'location_id', 'product_id', 'qty', 'state')
 
 
+class SessionTallyAdmin(admin.ModelAdmin):
+    list_display = ('id', 'session_id', 'location_id', 'product_id', 'counted_qty', 'scan_count', 'last_scanned_at')
+
+
+class FinalizeJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'session_id', 'state', 'keys_done', 'keys_total', 'attempts', 'worker', 'heartbeat_at',
+                    'finished_at')
+    list_filter = ('state',)
+
+
 admin.site.register(CustomUser)
 admin.site.register(Location, LocationAdmin)
 admin.site.register(Product, ProductAdmin)
+admin.site.register(CasePack, CasePackAdmin)
 admin.site.register(Inventory, InventoryAdmin)
 admin.site.register(CountSession, CountSessionAdmin)
 admin.site.register(IndividualCount, IndividualCountAdmin)
+admin.site.register(SessionTally, SessionTallyAdmin)
 admin.site.register(CycleCountModification)
+admin.site.register(FinalizeJob, FinalizeJobAdmin)
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class CyclecountConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'cyclecount'
+
+    def ready(self):
+        # Connects the model signal receivers
+        from cyclecount import signals  # noqa: F401
@@ -0,0 +1,180 @@
+import threading
+import time
+from typing import Any, Dict, Iterable, NamedTuple, Optional, Sequence, Set, Tuple, Type
+
+import structlog
+from django.db import transaction
+from django.db.models import Model
+
+from cyclecount.gs1 import parse_gs1, gtin_candidates
+from cyclecount.models import Location, Product, CasePack
+
+
+log = structlog.get_logger(__name__)
+
+
+class BarcodeResolver:
+    """
+    Resolves a scanned barcode to the id of the Location/Product it belongs to (or other value_fields of the
+    matching row, e.g. the product and qty of a CasePack).
+
+    Lookups hit the unique index on the barcode column once, after that the answer (including "no such
+    barcode") is served from an in-process map. Saves and deletes in this process invalidate the map through
+    model signals (see cyclecount.signals). Changes made by other processes, or by bulk operations that don't
+    send signals, are picked up once an entry is older than ttl_seconds - negative_ttl_seconds for a "no such
+    barcode", so a product added elsewhere can be scanned soon after.
+    """
+
+    def __init__(self, model: Type[Model], field: str, value_fields: Sequence[str] = ('id',),
+                 ttl_seconds: float = 300, negative_ttl_seconds: float = 5, max_entries: int = 1000000):
+        self.model = model
+        self.field = field
+        self.value_fields = tuple(value_fields)
+        self.ttl_seconds = ttl_seconds
+        self.negative_ttl_seconds = negative_ttl_seconds
+        self.max_entries = max_entries
+        # barcode -> (expires_at, value or None)
+        self._values: Dict[str, Tuple[float, Any]] = {}
+        # pk -> barcode, so a rename can drop the old barcode
+        self._barcodes: Dict[int, str] = {}
+        self._lock = threading.Lock()
+
+    def _rows(self, rows: Iterable[Tuple]) -> Iterable[Tuple]:
+        # (barcode, pk, value)
+        for row in rows:
+            yield row[0], row[1], row[2] if len(self.value_fields) == 1 else row[2:]
+
+    def _query(self, **filters):
+        return self.model.objects.filter(**filters).values_list(self.field, 'pk', *self.value_fields)
+
+    def _store(self, barcode: str, pk: Optional[int], value: Any, now: float) -> None:
+        # Caller holds self._lock
+        if len(self._values) >= self.max_entries:
+            # Crude, but a full reload is just the cost of warm() and this should never happen in practice.
+            self._values.clear()
+            self._barcodes.clear()
+        self._values[barcode] = (now + (self.negative_ttl_seconds if pk is None else self.ttl_seconds), value)
+        if pk is not None:
+            self._barcodes[pk] = barcode
+
+    def resolve(self, barcode: str) -> Any:
+        entry = self._values.get(barcode)
+        if entry is not None and entry[0] > time.monotonic():
+            return entry[1]
+
+        (_, pk, value) = next(iter(self._rows(self._query(**{self.field: barcode}))), (barcode, None, None))
+        with self._lock:
+            self._store(barcode, pk, value, time.monotonic())
+        return value
+
+    def resolve_many(self, barcodes: Iterable[str]) -> Dict[str, Any]:
+        # Same as resolve, but everything that isn't in memory is looked up with a single IN query.
+        now = time.monotonic()
+        resolved: Dict[str, Any] = {}
+        misses = set()
+        for barcode in barcodes:
+            entry = self._values.get(barcode)
+            if entry is not None and entry[0] > now:
+                resolved[barcode] = entry[1]
+            else:
+                misses.add(barcode)
+
+        if misses:
+            rows = self._rows(self._query(**{f'{self.field}__in': misses}))
+            found = {barcode: (pk, value) for (barcode, pk, value) in rows}
+            with self._lock:
+                for barcode in misses:
+                    (pk, value) = found.get(barcode, (None, None))
+                    resolved[barcode] = value
+                    self._store(barcode, pk, value, now)
+        return resolved
+
+    def warm(self) -> int:
+        """
+        Preload every barcode, e.g. at worker start up, so even the first scan of each barcode is served from memory.
+        :return: number of barcodes loaded
+        """
+        now = time.monotonic()
+        count = 0
+        with self._lock:
+            for (barcode, pk, value) in self._rows(self._query().iterator(chunk_size=10000)):
+                self._store(barcode, pk, value, now)
+                count += 1
+        log.info('barcode_resolver warmed', model=self.model.__name__, count=count)
+        return count
+
+    def _invalidate(self, pk: Optional[int], barcode: str) -> None:
+        with self._lock:
+            old_barcode = self._barcodes.pop(pk, None)
+            if old_barcode is not None:
+                self._values.pop(old_barcode, None)
+            # Also drops a cached "not found" for a barcode that was just created.
+            self._values.pop(barcode, None)
+
+    def invalidate(self, instance: Model) -> None:
+        self._invalidate(instance.pk, getattr(instance, self.field))
+
+    def invalidate_on_commit(self, instance: Model) -> None:
+        # Dropped right away for the rest of this transaction, and again once it commits: a request that looked
+        # the barcode up in the meantime saw (and cached) the old row, or the miss. Taken now, delete() clears pk.
+        (pk, barcode) = (instance.pk, getattr(instance, self.field))
+        self._invalidate(pk, barcode)
+        transaction.on_commit(lambda: self._invalidate(pk, barcode))
+
+    def clear(self) -> None:
+        with self._lock:
+            self._values.clear()
+            self._barcodes.clear()
+
+
+location_resolver = BarcodeResolver(Location, 'description')
+product_resolver = BarcodeResolver(Product, 'sku')
+case_pack_resolver = BarcodeResolver(CasePack, 'barcode', value_fields=('product_id', 'qty'))
+
+
+class ProductScan(NamedTuple):
+    product_id: int
+    # How many units of the product one scan of this barcode counts
+    qty: int
+
+
+def _resolve_sku_or_case_pack(barcodes: Set[str]) -> Dict[str, ProductScan]:
+    resolved: Dict[str, ProductScan] = {}
+    for (barcode, product_id) in product_resolver.resolve_many(barcodes).items():
+        if product_id is not None:
+            resolved[barcode] = ProductScan(product_id, 1)
+
+    remaining = barcodes - resolved.keys()
+    if remaining:
+        for (barcode, case_pack) in case_pack_resolver.resolve_many(remaining).items():
+            if case_pack is not None:
+                resolved[barcode] = ProductScan(*case_pack)
+    return resolved
+
+
+def resolve_product_barcodes(barcodes: Iterable[str]) -> Dict[str, Optional[ProductScan]]:
+    """
+    Resolve what was scanned at the product prompt, in order of preference:
+    1. A product sku (qty 1)
+    2. A CasePack barcode (qty of the pack)
+    3. A GS1-128 label, its GTIN is resolved as 1 or 2 and multiplied by the count on the label
+    """
+    barcodes = set(barcodes)
+    resolved: Dict[str, Optional[ProductScan]] = dict(_resolve_sku_or_case_pack(barcodes))
+
+    for barcode in barcodes - resolved.keys():
+        resolved[barcode] = None
+        gs1_scan = parse_gs1(barcode)
+        if gs1_scan is None:
+            continue
+        # GS1 labels are rare enough next to plain sku scans that a lookup per label is fine.
+        for gtin in gtin_candidates(gs1_scan.gtin):
+            product_scan = _resolve_sku_or_case_pack({gtin}).get(gtin)
+            if product_scan is not None:
+                resolved[barcode] = ProductScan(product_scan.product_id, product_scan.qty * gs1_scan.count)
+                break
+    return resolved
+
+
+def resolve_product_barcode(barcode: str) -> Optional[ProductScan]:
+    return resolve_product_barcodes([barcode])[barcode]
@@ -0,0 +1,271 @@
+"""
+Latency, queries per request and throughput of the hot paths, driven through the Django test client against
+whatever database the connection points at (see manage.py benchmark_views, which builds a throwaway one).
+
+Every request is timed on its own, anything a scenario needs to set up per request (e.g. a fresh session to
+finalize) happens outside the timing. Results are plain dicts so they can be written out as JSON and compared
+against a stored baseline run.
+"""
+
+import json
+import platform
+import random
+import statistics
+import subprocess
+import time
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+import django
+import structlog
+from django.db import connection
+from django.http import HttpResponse
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import reverse
+
+from cyclecount.finalize_jobs import enqueue_finalize, run_pending_jobs
+from cyclecount.models import CustomUser, CountSession, Inventory, Product
+from cyclecount.tallies import rebuild_tallies
+from inventory.product_cache import product_cache
+from inventory.product_service_stub import ProductServiceStub, products_from_db
+
+
+log = structlog.get_logger(__name__)
+
+# A request to time, made by a scenario's prepare step
+TimedRequest = Callable[[Client], HttpResponse]
+
+CLONE_SESSION_SQL = '''
+INSERT INTO cyclecount_individualcount (associate_id, session_id, location_id, product_id, qty, state,
+                                        client_scanned_at, created_at, updated_at)
+SELECT associate_id, %s, location_id, product_id, qty, state, client_scanned_at, created_at, updated_at
+FROM cyclecount_individualcount
+WHERE session_id = %s
+'''
+
+
+class Scenario(NamedTuple):
+    name: str
+    # Untimed, called once per iteration with a seeded Random, returns the request to time
+    prepare: Callable[[random.Random], TimedRequest]
+
+
+class BenchmarkData(NamedTuple):
+    associate: CustomUser
+    session_id: int
+    # (location_id, location barcode, sku) of what's actually stocked, for realistic scans
+    stocked: List[tuple]
+    inventory_count: int
+
+
+def load_benchmark_data(sample_size: int = 5000) -> BenchmarkData:
+    count_session = CountSession.objects.filter(final_state__isnull=True).order_by('-active_scans').first()
+    if count_session is None:
+        raise ValueError('No open CountSession to benchmark with, generate data with setup_test_data first')
+    stocked = list(Inventory.objects.order_by('id')
+                   .values_list('location_id', 'location__description', 'product__sku')[:sample_size])
+    return BenchmarkData(associate=count_session.created_by, session_id=count_session.id, stocked=stocked,
+                         inventory_count=Inventory.objects.count())
+
+
+def clone_session(data: BenchmarkData) -> int:
+    # A copy of the benchmark session, for scenarios that close the session they work on.
+    count_session = CountSession.objects.create(created_by=data.associate)
+    with connection.cursor() as cursor:
+        cursor.execute(CLONE_SESSION_SQL, [count_session.id, data.session_id])
+    rebuild_tallies([count_session.id])
+    return count_session.id
+
+
+def scenarios(data: BenchmarkData, page_size: int = 100) -> List[Scenario]:
+    session_id = data.session_id
+    last_page = max(data.inventory_count // page_size, 1)
+    max_inventory_id = Inventory.objects.order_by('-id').values_list('id', flat=True).first() or 0
+
+    def scan_product(rng: random.Random) -> TimedRequest:
+        (location_id, _, sku) = rng.choice(data.stocked)
+        url = reverse('cyclecount:scan_product', args=(session_id, location_id))
+        return lambda client: client.post(url, {'sku': sku})
+
+    def scan(rng: random.Random) -> TimedRequest:
+        # The scan page's single JSON scan, compare with scan_product + the redirect it is followed by
+        (_, location, sku) = rng.choice(data.stocked)
+        body = json.dumps({'location': location, 'sku': sku})
+        url = reverse('cyclecount:scan', args=(session_id,))
+        return lambda client: client.post(url, body, content_type='application/json')
+
+    def scan_batch(rng: random.Random) -> TimedRequest:
+        # A handheld flushing its buffer, 100 scans from one location
+        (location_id, location, _) = rng.choice(data.stocked)
+        skus = [sku for (stocked_location_id, _, sku) in data.stocked if stocked_location_id == location_id]
+        body = json.dumps({'scans': [{'location': location, 'sku': rng.choice(skus)} for _ in range(100)]})
+        url = reverse('cyclecount:scan_batch', args=(session_id,))
+        return lambda client: client.post(url, body, content_type='application/json')
+
+    def session_review(rng: random.Random) -> TimedRequest:
+        url = reverse('cyclecount:session_review', args=(session_id,))
+        return lambda client: client.get(url)
+
+    def proposed_modifications(rng: random.Random) -> TimedRequest:
+        # What the supervisor looks at first, biggest shortfalls
+        url = reverse('cyclecount:proposed_modifications_page', args=(session_id,))
+        params = {'page': 1, 'size': page_size, 'sort[0][field]': 'variance', 'sort[0][dir]': 'asc'}
+        return lambda client: client.get(url, params)
+
+    def individual_counts(rng: random.Random) -> TimedRequest:
+        url = reverse('cyclecount:individual_counts_page', args=(session_id,))
+        params = {'page': rng.randint(1, 20), 'size': page_size}
+        return lambda client: client.get(url, params)
+
+    def finalize_session(rng: random.Random) -> TimedRequest:
+        url = reverse('cyclecount:finalize_session', args=(clone_session(data),))
+        return lambda client: client.post(url, {'choice': CountSession.FinalState.ACCEPTED})
+
+    def finalize_job(rng: random.Random) -> TimedRequest:
+        # The worker side of finalize_session, not a request: applying the queued session to Inventory
+        run_pending_jobs('benchmark')  # Whatever the finalize_session scenario left in the queue
+        count_session = CountSession.objects.get(pk=clone_session(data))
+        count_session.final_state = CountSession.FinalState.ACCEPTED
+        count_session.save(update_fields=['final_state', 'updated_at'])
+        enqueue_finalize(count_session, data.associate)
+
+        def run(client: Client) -> HttpResponse:
+            run_pending_jobs('benchmark')
+            return HttpResponse()
+        return run
+
+    def inventory_table_db(rng: random.Random) -> TimedRequest:
+        params = {'page': rng.randint(1, last_page), 'size': page_size}
+        return lambda client: client.get(reverse('inventory:inventory_table_db'), params)
+
+    def inventory_table_db_cursor(rng: random.Random) -> TimedRequest:
+        params = {'after_id': rng.randint(0, max_inventory_id), 'size': page_size}
+        return lambda client: client.get(reverse('inventory:inventory_table_db'), params)
+
+    def inventory_table_api(cold_cache: bool) -> Callable[[random.Random], TimedRequest]:
+        def prepare(rng: random.Random) -> TimedRequest:
+            if cold_cache:
+                product_cache().clear()
+            params = {'page': rng.randint(1, 20), 'size': page_size}
+            return lambda client: client.get(reverse('inventory:inventory_table_api'), params)
+        return prepare
+
+    return [
+        Scenario('scan_product', scan_product),
+        Scenario('scan', scan),
+        Scenario('scan_batch_100', scan_batch),
+        Scenario('session_review', session_review),
+        Scenario('proposed_modifications_page', proposed_modifications),
+        Scenario('individual_counts_page', individual_counts),
+        Scenario('finalize_session', finalize_session),
+        Scenario('finalize_job', finalize_job),
+        Scenario('inventory_table_db', inventory_table_db),
+        Scenario('inventory_table_db_cursor', inventory_table_db_cursor),
+        Scenario('inventory_table_api_cold_cache', inventory_table_api(cold_cache=True)),
+        Scenario('inventory_table_api_warm_cache', inventory_table_api(cold_cache=False)),
+    ]
+
+
+def _percentile(sorted_values: List[float], percent: int) -> float:
+    if len(sorted_values) == 1:
+        return sorted_values[0]
+    return statistics.quantiles(sorted_values, n=100, method='inclusive')[percent - 1]
+
+
+def run_scenario(scenario: Scenario, client: Client, iterations: int, warmup: int, seed: int) -> Dict:
+    rng = random.Random(f'{seed}-{scenario.name}')
+    timings: List[float] = []
+    queries: List[int] = []
+    errors = 0
+    for iteration in range(warmup + iterations):
+        request = scenario.prepare(rng)
+        with CaptureQueriesContext(connection) as captured:
+            started = time.perf_counter()
+            response = request(client)
+            elapsed = time.perf_counter() - started
+        if iteration < warmup:
+            continue
+        timings.append(elapsed)
+        queries.append(len(captured))
+        errors += response.status_code >= 400
+
+    timings.sort()
+    result = {
+        'iterations': iterations,
+        'errors': errors,
+        'p50_ms': round(_percentile(timings, 50) * 1000, 3),
+        'p95_ms': round(_percentile(timings, 95) * 1000, 3),
+        'p99_ms': round(_percentile(timings, 99) * 1000, 3),
+        'mean_ms': round(statistics.fmean(timings) * 1000, 3),
+        'max_ms': round(timings[-1] * 1000, 3),
+        'queries_per_request': round(statistics.fmean(queries), 2),
+        'max_queries': max(queries),
+        # One client, one request at a time
+        'throughput_rps': round(len(timings) / sum(timings), 1),
+    }
+    log.info('benchmark scenario', scenario=scenario.name, **result)
+    return result
+
+
+def _git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(iterations: int, warmup: int, seed: int, only: Optional[List[str]] = None,
+                   scenario_done: Optional[Callable[[str, Dict], None]] = None) -> Dict:
+    """
+    Run every scenario (or the ones named in only) against the current database.
+    :return: results, ready for json.dump
+    """
+    data = load_benchmark_data()
+    client = Client()
+    client.force_login(data.associate)
+
+    # The inventory grid's product lookups go to a stub of the product service in its own process.
+    products = products_from_db()
+    stub = ProductServiceStub(products, port=0).start_process()
+    results: Dict[str, Dict] = {}
+    try:
+        with override_settings(PRODUCT_SERVICE_URL=stub.url):
+            for scenario in scenarios(data):
+                if only and scenario.name not in only:
+                    continue
+                results[scenario.name] = run_scenario(scenario, client, iterations, warmup, seed)
+                if scenario_done is not None:
+                    scenario_done(scenario.name, results[scenario.name])
+    finally:
+        stub.stop()
+
+    return {
+        'git_revision': _git_revision(),
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'postgres': connection.pg_version,
+        'seed': seed,
+        'iterations': iterations,
+        'session_scans': CountSession.objects.get(pk=data.session_id).total_scans,
+        'products': Product.objects.count(),
+        'inventory': data.inventory_count,
+        'scenarios': results,
+    }
+
+
+def compare_to_baseline(results: Dict, baseline: Dict, tolerance: float) -> List[str]:
+    """
+    :return: a line per scenario that got slower (p95 by more than tolerance) or makes more queries
+    """
+    regressions = []
+    for (name, result) in results['scenarios'].items():
+        previous = baseline.get('scenarios', {}).get(name)
+        if previous is None:
+            continue
+        if result['p95_ms'] > previous['p95_ms'] * (1 + tolerance):
+            regressions.append(f'{name}: p95 {previous["p95_ms"]}ms -> {result["p95_ms"]}ms')
+        if result['queries_per_request'] > previous['queries_per_request']:
+            regressions.append(f'{name}: queries per request '
+                               f'{previous["queries_per_request"]} -> {result["queries_per_request"]}')
+    return regressions
@@ -0,0 +1,138 @@
+import asyncio
+from typing import Dict, List, Optional, Tuple
+
+import structlog
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncJsonWebsocketConsumer
+from django.conf import settings
+
+from cyclecount.barcodes import location_resolver
+from cyclecount.scan_context import open_session
+from cyclecount.scans import record_scan_batch, session_progress
+
+
+log = structlog.get_logger(__name__)
+
+'''
+WebSocket version of the scan API (ws/scan/<session_id>, see CycleCounter/asgi.py), so a handheld keeps one
+connection open for the whole count instead of a request (and TLS handshake, headers, session lookup) per scan.
+
+- Same session login as the site: the socket is refused for anonymous users and sessions that aren't open.
+- The handheld sends {"type": "scan", "id": <its own id for the scan>, "location": ..., "sku": ..., "qty": ...,
+  "client_timestamp": ...} and gets {"type": "ack", "scan": <that id>, "status": "created", "id": ...} or
+  {"type": "ack", "scan": ..., "status": "rejected", "error": ...} back.
+- Scans are buffered and inserted through record_scan_batch, SCAN_SOCKET_BATCH_SIZE at a time or
+  SCAN_SOCKET_FLUSH_SECONDS after the first one in the buffer, whichever comes first. Acks come after the insert,
+  so a handheld should keep a scan until it's acked and resend it after a reconnect - with a "key" (see
+  cyclecount.sync) the resent scan is acked as a duplicate instead of being counted twice. A batch that fails to
+  insert (database error) is acked rejected, for the handheld to send again.
+- Everyone connected to the session (the handhelds, and supervisors that just connect and listen) gets
+  {"type": "tallies", "counters": {...}, "locations": {"<location_id>": [...]}} after every batch.
+- Finalizing the session rejects the scans still buffered, and the socket is closed with SESSION_CLOSED.
+'''
+
+SESSION_CLOSED = 4410
+
+
+def _group(session_id: int) -> str:
+    return f'scan-session-{session_id}'
+
+
+class ScanConsumer(AsyncJsonWebsocketConsumer):
+
+    async def connect(self) -> None:
+        self.session_id: int = self.scope['url_route']['kwargs']['session_id']
+        self.pending: List[Dict] = []
+        self.flush_timer: Optional[asyncio.Task] = None
+        self.joined = False
+
+        if not self.scope['user'].is_authenticated \
+                or await database_sync_to_async(open_session)(self.session_id) is None:
+            await self.close()
+            return
+        await self.channel_layer.group_add(_group(self.session_id), self.channel_name)
+        self.joined = True
+        await self.accept()
+        log.info('scan socket connected', session_id=self.session_id, associate=self.scope['user'].id)
+
+    async def disconnect(self, code: int) -> None:
+        if not self.joined:
+            return
+        # Nobody left to ack, but what was sent is still counted
+        await self.flush(send_acks=False)
+        await self.channel_layer.group_discard(_group(self.session_id), self.channel_name)
+        log.info('scan socket disconnected', session_id=self.session_id, associate=self.scope['user'].id, code=code)
+
+    async def receive_json(self, content, **kwargs) -> None:
+        if not isinstance(content, dict) or content.get('type') != 'scan':
+            await self.send_json({'type': 'error', 'error': 'Expected {"type": "scan", ...}'})
+            return
+
+        self.pending.append(content)
+        if len(self.pending) >= settings.SCAN_SOCKET_BATCH_SIZE:
+            await self.flush()
+        elif self.flush_timer is None:
+            self.flush_timer = asyncio.ensure_future(self._flush_later())
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(settings.SCAN_SOCKET_FLUSH_SECONDS)
+        self.flush_timer = None
+        try:
+            await self.flush()
+        except Exception:
+            # A task nobody awaits, an exception left in it would never be seen
+            log.exception('scan socket timed flush failed', session_id=self.session_id)
+
+    def _record(self, scans: List[Dict]) -> Tuple[Optional[List[Dict]], Optional[Dict]]:
+        results = record_scan_batch(self.session_id, self.scope['user'], scans)
+        if results is None:
+            return None, None
+        try:
+            scanned = location_resolver.resolve_many({scans[result['index']]['location'] for result in results
+                                                      if result['status'] == 'created'})
+            return results, session_progress(self.session_id, scanned.values())
+        except Exception:
+            # The scans are in, they still get acked, the tallies go out with the next batch
+            log.exception('scan socket tallies failed', session_id=self.session_id)
+            return results, None
+
+    async def flush(self, send_acks: bool = True) -> None:
+        """
+        Insert the buffered scans, ack them and send the session's new tallies to everyone watching.
+        """
+        if self.flush_timer is not None:
+            self.flush_timer.cancel()
+            self.flush_timer = None
+        # Taken off before the insert, scans received meanwhile go in the next batch
+        (scans, self.pending) = (self.pending, [])
+        if not scans:
+            return
+
+        try:
+            (results, progress) = await database_sync_to_async(self._record)(scans)
+        except Exception:
+            # record_scan_batch is one transaction, none of them were recorded. Rejected, so the handheld resends.
+            log.exception('scan socket flush failed', session_id=self.session_id, rejected_count=len(scans))
+            if send_acks:
+                for scan in scans:
+                    await self.send_json({'type': 'ack', 'scan': scan.get('id'), 'status': 'rejected',
+                                          'error': 'Scan not recorded, send it again'})
+            return
+        if results is None:
+            log.info('scan socket session closed', session_id=self.session_id, rejected_count=len(scans))
+            if send_acks:
+                for scan in scans:
+                    await self.send_json({'type': 'ack', 'scan': scan.get('id'), 'status': 'rejected',
+                                          'error': 'Session not found or already finalized'})
+                await self.close(code=SESSION_CLOSED)
+            return
+
+        if send_acks:
+            for result in results:
+                ack = {key: value for (key, value) in result.items() if key != 'index'}
+                await self.send_json({'type': 'ack', 'scan': scans[result['index']].get('id'), **ack})
+        if progress is not None and progress['locations']:
+            await self.channel_layer.group_send(_group(self.session_id), {'type': 'session.tallies', **progress})
+
+    async def session_tallies(self, event: Dict) -> None:
+        await self.send_json({'type': 'tallies', 'counters': event['counters'], 'locations': event['locations']})
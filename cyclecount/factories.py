@@ -6,11 +6,16 @@ from django.utils import timezone
 from .models import Location, Product, Inventory
 
 
+# factory.Faker has no unique, this one remembers the barcodes it's handed out
+fake = faker.Faker()
+
+
 class LocationFactory(DjangoModelFactory):
     class Meta:
         model = Location
 
-    description = factory.Faker('ean')
+    # Unique column (migration 0008). Not a Sequence, that starts over in every shell the factories are run from
+    description = factory.LazyFunction(lambda: fake.unique.ean())
 
 
 class ProductFactory(DjangoModelFactory):
@@ -18,7 +23,7 @@ class ProductFactory(DjangoModelFactory):
         model = Product
 
     description = factory.Faker('sentence')
-    sku = factory.Faker('ean')
+    sku = factory.LazyFunction(lambda: fake.unique.ean())
 
 
 class InventoryFactory(DjangoModelFactory):
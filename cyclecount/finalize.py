@@ -0,0 +1,131 @@
+import functools
+import itertools
+import random
+import time
+from typing import Callable, List, Optional, Tuple, TypeVar
+
+import structlog
+from django.conf import settings
+from django.db import OperationalError, connection
+from django.db.models import Q, QuerySet
+
+from cyclecount.models import CountSession, CycleCountModification, SessionTally
+
+
+log = structlog.get_logger(__name__)
+
+# (location_id, product_id, counted_qty)
+CountedKey = Tuple[int, int, int]
+
+T = TypeVar('T')
+
+# Inventory writes for a set of keys, safe with any number of sessions finalizing the same locations at once:
+# 1. Missing Inventory rows are created (qty 0) with ON CONFLICT DO NOTHING, so two sessions creating the same row
+#    don't fail, the second waits for the first and then finds it.
+# 2. Every row is locked in a single SELECT ... FOR UPDATE in (location_id, product_id) order, and its qty read
+#    under the lock. A session that got there first has committed by the time we read, so the ledger's old_qty is
+#    its new_qty rather than whatever was there when we started (the lost update).
+# 3. The locked rows are updated.
+# Locks are only ever taken in key order (the inserts too), so two sessions wait on each other rather than
+# deadlocking: whoever has the lowest contended key goes first.
+INSERT_MISSING_INVENTORY_SQL = '''
+INSERT INTO cyclecount_inventory (location_id, product_id, qty, created_at, updated_at)
+SELECT location_id, product_id, 0, now(), now()
+FROM unnest(%s::bigint[], %s::bigint[]) AS counted (location_id, product_id)
+ORDER BY location_id, product_id
+ON CONFLICT (location_id, product_id) DO NOTHING
+'''
+
+LOCK_INVENTORY_SQL = '''
+SELECT inv.id, inv.location_id, inv.product_id, inv.qty
+FROM cyclecount_inventory inv
+JOIN unnest(%s::bigint[], %s::bigint[]) AS counted (location_id, product_id) USING (location_id, product_id)
+ORDER BY inv.location_id, inv.product_id
+FOR UPDATE OF inv
+'''
+
+UPDATE_INVENTORY_SQL = '''
+UPDATE cyclecount_inventory inv SET qty = counted.qty, updated_at = now()
+FROM unnest(%s::bigint[], %s::integer[]) AS counted (id, qty)
+WHERE inv.id = counted.id
+'''
+
+# SQLSTATEs where Postgres rolled the transaction back because of another one, running it again is the fix:
+# serialization_failure, deadlock_detected
+RETRYABLE_SQLSTATES = ('40001', '40P01')
+
+
+def retry_on_conflict(func: Callable[..., T]) -> Callable[..., T]:
+    """
+    Run func again (up to FINALIZE_RETRY_ATTEMPTS times in all, with a random backoff) when its transaction is
+    rolled back by a serialization failure or deadlock. func has to be the whole transaction, retrying part of one
+    that already failed gets nowhere.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs) -> T:
+        for attempt in itertools.count(1):
+            try:
+                return func(*args, **kwargs)
+            except OperationalError as e:
+                sqlstate = getattr(e.__cause__, 'pgcode', None)
+                if sqlstate not in RETRYABLE_SQLSTATES or attempt >= settings.FINALIZE_RETRY_ATTEMPTS:
+                    raise
+                backoff = random.uniform(0, settings.FINALIZE_RETRY_BACKOFF_SECONDS * 2 ** attempt)
+                log.warning('retrying after conflict', function=func.__name__, sqlstate=sqlstate, attempt=attempt,
+                            backoff=round(backoff, 3))
+                time.sleep(backoff)
+    return wrapper
+
+
+def counted_quantities_query(count_session: CountSession) -> QuerySet:
+    # Already summed per location/product as the scans came in. A key where every count was deleted has a
+    # zeroed tally, it isn't counted (same as having no scans at all).
+    return (SessionTally.objects
+            .filter(session=count_session, scan_count__gt=0)
+            .values_list('location_id', 'product_id', 'counted_qty')
+            .order_by('location_id', 'product_id'))
+
+
+def upsert_inventory(counted: List[CountedKey]) -> List[Tuple[int, int, int, int]]:
+    """
+    Set Inventory.qty to the counted qty for every key, creating missing Inventory records. Locks the rows until
+    the end of the transaction.
+    :return: (location_id, product_id, old_qty, new_qty) for every key
+    """
+    if not counted:
+        return []
+    counted_qty = {(location_id, product_id): qty for (location_id, product_id, qty) in counted}
+    location_ids = [location_id for (location_id, _) in counted_qty]
+    product_ids = [product_id for (_, product_id) in counted_qty]
+    with connection.cursor() as cursor:
+        cursor.execute(INSERT_MISSING_INVENTORY_SQL, [location_ids, product_ids])
+        cursor.execute(LOCK_INVENTORY_SQL, [location_ids, product_ids])
+        locked = cursor.fetchall()
+        cursor.execute(UPDATE_INVENTORY_SQL, [[inventory_id for (inventory_id, _, _, _) in locked],
+                                              [counted_qty[(location_id, product_id)]
+                                               for (_, location_id, product_id, _) in locked]])
+    return [(location_id, product_id, old_qty, counted_qty[(location_id, product_id)])
+            for (_, location_id, product_id, old_qty) in locked]
+
+
+def finalize_chunk(count_session: CountSession, associate, after: Optional[Tuple[int, int]],
+                   size: int) -> List[CountedKey]:
+    """
+    Apply the next size counted keys (in location_id, product_id order) after the key `after` of an accepted
+    session to Inventory, and record them in the CycleCountModification ledger. The only way counts reach
+    Inventory: the finalize job calls it in a transaction that also records how far it got (see
+    cyclecount.finalize_jobs).
+    :return: the keys applied, none once the session is done
+    """
+    counted = counted_quantities_query(count_session)
+    if after is not None:
+        (location_id, product_id) = after
+        counted = counted.filter(Q(location_id__gt=location_id) | Q(location_id=location_id,
+                                                                    product_id__gt=product_id))
+    counted_keys = list(counted[:size])
+    CycleCountModification.objects.bulk_create([
+        CycleCountModification(session=count_session, location_id=location_id, product_id=product_id,
+                               old_qty=old_qty, new_qty=new_qty, associate=associate)
+        for (location_id, product_id, old_qty, new_qty) in upsert_inventory(counted_keys)
+    ])
+    return counted_keys
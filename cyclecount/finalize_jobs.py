@@ -0,0 +1,172 @@
+import datetime
+from typing import Optional
+
+import structlog
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from cyclecount.finalize import counted_quantities_query, finalize_chunk, retry_on_conflict
+from cyclecount.models import CountSession, FinalizeJob
+
+
+log = structlog.get_logger(__name__)
+
+'''
+Accepting a session used to apply it to Inventory inside the request, which for a big session outlasts the load
+balancer's timeout and leaves the supervisor guessing whether it went through. Now finalize_session just marks the
+session accepted and queues a FinalizeJob in the same transaction, and manage.py finalize_worker does the rest:
+
+- Workers claim the oldest queued job with SELECT ... FOR UPDATE SKIP LOCKED, so any number of them can run, each
+  on a different session, without waiting on each other.
+- A job is applied FINALIZE_CHUNK_SIZE keys at a time in (location_id, product_id) order, each chunk in its own
+  transaction along with the job's progress (last key applied). A worker that dies loses at most the chunk it was
+  in the middle of, which rolled back, and whoever picks the job up carries on after the last committed key.
+- Every chunk bumps heartbeat_at. A RUNNING job that hasn't for FINALIZE_JOB_STALE_SECONDS is fair game for another
+  worker; the old one (if it was only slow) notices it lost the job at its next chunk and stops.
+- Sessions covering the same locations can finalize at the same time, see finalize.upsert_inventory for the
+  locking. A chunk that still gets rolled back by Postgres (deadlock/serialization failure) is simply run again.
+- A chunk that fails otherwise puts the job back in the queue, up to FINALIZE_JOB_MAX_ATTEMPTS, then it is FAILED
+  with the error for someone to look at.
+'''
+
+
+class JobLost(Exception):
+    # Another worker took the job over, see _apply_next_chunk
+    pass
+
+
+def enqueue_finalize(count_session: CountSession, requested_by) -> FinalizeJob:
+    """
+    Queue the accepted session for finalize_worker. Call it in the transaction that accepts the session, so the
+    worker never sees a job for a session that isn't accepted. Enqueueing a session twice returns the first job.
+    """
+    (job, created) = FinalizeJob.objects.get_or_create(session=count_session,
+                                                       defaults={'requested_by': requested_by})
+    if created:
+        log.info('finalize job queued', job_id=job.id, session_id=count_session.id)
+    return job
+
+
+def _stale_before() -> datetime.datetime:
+    return timezone.now() - datetime.timedelta(seconds=settings.FINALIZE_JOB_STALE_SECONDS)
+
+
+def claim_job(worker: str) -> Optional[FinalizeJob]:
+    """
+    Take the oldest queued job, or a running one whose worker stopped heartbeating.
+    :return: the job, RUNNING under `worker`, or None when there is nothing to do
+    """
+    with transaction.atomic():
+        while True:
+            # Jobs locked by another worker's claim/chunk are skipped, not waited on
+            job = (FinalizeJob.objects
+                   .select_for_update(skip_locked=True)
+                   .filter(Q(state=FinalizeJob.State.QUEUED)
+                           | Q(state=FinalizeJob.State.RUNNING, heartbeat_at__lt=_stale_before()))
+                   .order_by('id')
+                   .first())
+            if job is None:
+                return None
+
+            if job.state == FinalizeJob.State.RUNNING:
+                log.warning('finalize job stale, taking over', job_id=job.id, previous_worker=job.worker,
+                            heartbeat_at=job.heartbeat_at)
+                if job.attempts >= settings.FINALIZE_JOB_MAX_ATTEMPTS:
+                    # Whatever keeps killing its workers will kill us too
+                    job.state = FinalizeJob.State.FAILED
+                    job.error = f'Worker {job.worker} stopped heartbeating, out of attempts'
+                    job.finished_at = timezone.now()
+                    job.save(update_fields=['state', 'error', 'finished_at', 'updated_at'])
+                    continue
+
+            job.state = FinalizeJob.State.RUNNING
+            job.worker = worker
+            job.heartbeat_at = timezone.now()
+            job.attempts += 1
+            if job.keys_total is None:
+                job.keys_total = counted_quantities_query(job.session).count()
+            job.save(update_fields=['state', 'worker', 'heartbeat_at', 'attempts', 'keys_total', 'updated_at'])
+            log.info('finalize job claimed', job_id=job.id, session_id=job.session_id, worker=worker,
+                     attempts=job.attempts, keys_done=job.keys_done, keys_total=job.keys_total)
+            return job
+
+
+@retry_on_conflict
+def _apply_next_chunk(job_id: int, worker: str) -> FinalizeJob:
+    with transaction.atomic():
+        # Only the job row, locking the joined user would line up every session they accepted behind each other
+        job = (FinalizeJob.objects.select_for_update(of=('self',)).select_related('session', 'requested_by')
+               .get(pk=job_id))
+        if job.state != FinalizeJob.State.RUNNING or job.worker != worker:
+            raise JobLost(f'Finalize job {job_id} is {job.state} under {job.worker}')
+
+        after = None if job.last_location_id is None else (job.last_location_id, job.last_product_id)
+        counted = finalize_chunk(job.session, job.requested_by, after, settings.FINALIZE_CHUNK_SIZE)
+        if counted:
+            (job.last_location_id, job.last_product_id, _) = counted[-1]
+            job.keys_done += len(counted)
+        job.heartbeat_at = timezone.now()
+        update_fields = ['last_location_id', 'last_product_id', 'keys_done', 'heartbeat_at', 'updated_at']
+        if len(counted) < settings.FINALIZE_CHUNK_SIZE:
+            job.state = FinalizeJob.State.DONE
+            job.finished_at = job.heartbeat_at
+            job.error = None
+            update_fields += ['state', 'finished_at', 'error']
+        job.save(update_fields=update_fields)
+    return job
+
+
+def _failed(job_id: int, worker: str, error: Exception) -> None:
+    with transaction.atomic():
+        job = FinalizeJob.objects.select_for_update().get(pk=job_id)
+        if job.state != FinalizeJob.State.RUNNING or job.worker != worker:
+            return
+        job.error = f'{type(error).__name__}: {error}'
+        if job.attempts >= settings.FINALIZE_JOB_MAX_ATTEMPTS:
+            job.state = FinalizeJob.State.FAILED
+            job.finished_at = timezone.now()
+        else:
+            job.state = FinalizeJob.State.QUEUED
+        job.worker = None
+        job.heartbeat_at = None
+        job.save(update_fields=['error', 'state', 'finished_at', 'worker', 'heartbeat_at', 'updated_at'])
+
+
+def run_job(job: FinalizeJob, worker: str) -> FinalizeJob.State:
+    """
+    Apply a claimed job chunk by chunk until it is done, it fails or another worker takes it over.
+    :return: the state the job was left in
+    """
+    try:
+        while True:
+            job = _apply_next_chunk(job.id, worker)
+            log.debug('finalize job chunk', job_id=job.id, keys_done=job.keys_done, keys_total=job.keys_total)
+            if job.state == FinalizeJob.State.DONE:
+                log.info('finalize job done', job_id=job.id, session_id=job.session_id, worker=worker,
+                         modification_count=job.keys_done, attempts=job.attempts)
+                return job.state
+    except JobLost as e:
+        log.warning('finalize job lost', job_id=job.id, worker=worker, reason=str(e))
+        return FinalizeJob.State.RUNNING
+    except Exception as e:
+        log.exception('finalize job failed', job_id=job.id, session_id=job.session_id, worker=worker,
+                      attempts=job.attempts)
+        _failed(job.id, worker, e)
+        return FinalizeJob.objects.values_list('state', flat=True).get(pk=job.id)
+
+
+def run_pending_jobs(worker: str, max_jobs: Optional[int] = None) -> int:
+    """
+    Claim and run jobs until the queue is empty (or max_jobs were run).
+    :return: number of jobs run
+    """
+    ran = 0
+    while max_jobs is None or ran < max_jobs:
+        job = claim_job(worker)
+        if job is None:
+            break
+        run_job(job, worker)
+        ran += 1
+    return ran
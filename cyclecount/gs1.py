@@ -0,0 +1,101 @@
+import re
+from typing import Dict, List, NamedTuple, Optional
+
+
+'''
+Just enough of GS1-128 to pull the product and the quantity off a case/pallet label.
+
+Both the human readable form "(02)10012345678902(37)48" and what a scanner actually sends are supported,
+i.e. the AIs run together with an ASCII GS (FNC1) after each variable length field, optionally prefixed
+with the ]C1 symbology identifier.
+
+Reference: https://www.gs1.org/standards/barcodes/application-identifiers
+'''
+
+GROUP_SEPARATOR = '\x1d'
+SYMBOLOGY_IDENTIFIER = ']C1'
+
+# AI -> length of the data for fixed length AIs, or None for variable length (terminated by GS or the end)
+APPLICATION_IDENTIFIERS: Dict[str, Optional[int]] = {
+    '00': 18,  # SSCC
+    '01': 14,  # GTIN
+    '02': 14,  # GTIN of the trade items contained in a logistic unit
+    '10': None,  # Batch/lot
+    '11': 6,  # Production date
+    '13': 6,  # Packaging date
+    '15': 6,  # Best before
+    '17': 6,  # Expiry
+    '21': None,  # Serial
+    '30': None,  # Variable count of items
+    '37': None,  # Count of trade items contained in a logistic unit
+}
+
+HUMAN_READABLE = re.compile(r'\((\d{2})\)([^(]+)')
+# ASCII only, str.isdigit() also takes the likes of '²' (which int() doesn't)
+DIGITS = re.compile(r'[0-9]+')
+
+
+class Gs1Scan(NamedTuple):
+    gtin: str
+    count: int
+
+
+def parse_element_strings(barcode: str) -> Optional[Dict[str, str]]:
+    """
+    :return: AI -> data, or None if this isn't a GS1-128 barcode we understand
+    """
+    if barcode.startswith('('):
+        elements = HUMAN_READABLE.findall(barcode)
+        if ''.join(f'({ai}){data}' for (ai, data) in elements) != barcode:
+            return None
+        return dict(elements) if all(ai in APPLICATION_IDENTIFIERS for (ai, _) in elements) else None
+
+    if barcode.startswith(SYMBOLOGY_IDENTIFIER):
+        barcode = barcode[len(SYMBOLOGY_IDENTIFIER):]
+    elif GROUP_SEPARATOR not in barcode:
+        # Without the symbology identifier or a separator, a plain EAN/UPC would look like a (01)/(02)... string
+        return None
+
+    elements = {}
+    position = 0
+    while position < len(barcode):
+        ai = barcode[position:position + 2]
+        if ai not in APPLICATION_IDENTIFIERS:
+            return None
+        position += 2
+        length = APPLICATION_IDENTIFIERS[ai]
+        if length is None:
+            end = barcode.find(GROUP_SEPARATOR, position)
+            end = len(barcode) if end == -1 else end
+            elements[ai] = barcode[position:end]
+            position = end + 1
+        else:
+            elements[ai] = barcode[position:position + length]
+            if len(elements[ai]) != length:
+                return None
+            position += length
+            if barcode[position:position + 1] == GROUP_SEPARATOR:
+                position += 1
+    return elements
+
+
+def parse_gs1(barcode: str) -> Optional[Gs1Scan]:
+    """
+    A logistic unit label has the GTIN of its contents in (02) and how many in (37). A variable measure
+    trade item has its GTIN in (01) and the count in (30). Anything else with a (01) counts as one.
+    """
+    elements = parse_element_strings(barcode)
+    if not elements:
+        return None
+
+    gtin = elements.get('02') or elements.get('01')
+    count = elements.get('37') or elements.get('30') or '1'
+    if gtin is None or not DIGITS.fullmatch(gtin) or not DIGITS.fullmatch(count) or int(count) < 1:
+        return None
+    return Gs1Scan(gtin=gtin, count=int(count))
+
+
+def gtin_candidates(gtin: str) -> List[str]:
+    # GS1-128 always carries a GTIN-14, our SKUs are mostly EAN-13 (or UPC-A/EAN-8) which it zero pads.
+    return [gtin] + [gtin[-length:] for length in (13, 12, 8)
+                     if len(gtin) > length and set(gtin[:-length]) == {'0'}]
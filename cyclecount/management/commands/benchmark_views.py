@@ -0,0 +1,73 @@
+import json
+import logging
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from cyclecount.benchmarks import run_benchmarks, compare_to_baseline
+from cyclecount.models import Product
+from cyclecount.scale_data import ScaleConfig, generate
+
+
+class Command(BaseCommand):
+    help = ('Benchmark scan, review, finalize and the inventory grid: p50/p95/p99 latency, queries per request '
+            'and throughput, optionally compared against a baseline run')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=20000)
+        parser.add_argument('--locations', type=int, default=10000)
+        parser.add_argument('--scans-per-session', type=int, default=10000)
+        parser.add_argument('--workers', type=int, default=1, help='Processes used to generate the data set')
+        parser.add_argument('--iterations', type=int, default=50, help='Timed requests per scenario')
+        parser.add_argument('--warmup', type=int, default=5, help='Untimed requests per scenario, run first')
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--only', help='Comma separated scenario names')
+        parser.add_argument('--output', help='Write the results to this JSON file')
+        parser.add_argument('--baseline', help='JSON file from an earlier run to compare against')
+        parser.add_argument('--tolerance', type=float, default=0.2,
+                            help='How much slower (p95) than the baseline counts as a regression, 0.2 = 20%%')
+        parser.add_argument('--keepdb', action='store_true',
+                            help='Keep the benchmark database, and reuse its data set on the next run')
+        parser.add_argument('--log', action='store_true', help='Keep the per request logging on while timing')
+
+    def handle(self, *args, **options):
+        # The data set lives in its own database (test_<NAME>, like the test runner's), never the dev one.
+        setup_test_environment()
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, keepdb=options['keepdb'])
+        if not options['log']:
+            logging.disable(logging.INFO)
+        try:
+            if not Product.objects.exists():
+                config = ScaleConfig(products=options['products'], locations=options['locations'], sessions=1,
+                                     scans_per_session=options['scans_per_session'], seed=options['seed'],
+                                     workers=options['workers'])
+                self.stdout.write(f'Generating {config}')
+                generate(config)
+
+            def scenario_done(name: str, result: dict) -> None:
+                self.stdout.write(f'{name:>32}: p50={result["p50_ms"]:.1f}ms p95={result["p95_ms"]:.1f}ms '
+                                  f'p99={result["p99_ms"]:.1f}ms queries={result["queries_per_request"]:g} '
+                                  f'rps={result["throughput_rps"]:g} errors={result["errors"]}')
+
+            only = options['only'].split(',') if options['only'] else None
+            results = run_benchmarks(options['iterations'], options['warmup'], options['seed'], only, scenario_done)
+        finally:
+            logging.disable(logging.NOTSET)
+            connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=options['keepdb'])
+            teardown_test_environment()
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2)
+            self.stdout.write(f'Results written to {options["output"]}')
+
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                regressions = compare_to_baseline(results, json.load(f), options['tolerance'])
+            for regression in regressions:
+                self.stdout.write(regression)
+            if regressions:
+                raise CommandError(f'{len(regressions)} regressions against {options["baseline"]}')
+            self.stdout.write(f'No regressions against {options["baseline"]}')
@@ -0,0 +1,36 @@
+import os
+import socket
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from cyclecount.finalize_jobs import run_pending_jobs
+
+
+class Command(BaseCommand):
+    help = ('Apply accepted sessions to Inventory, from the queue filled by cyclecount:finalize_session. '
+            'Run as many as you like, each finalizes a different session.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--worker-id', default=f'{socket.gethostname()}-{os.getpid()}',
+                            help='Name recorded on the jobs this worker runs (default: hostname-pid)')
+        parser.add_argument('--once', action='store_true',
+                            help='Run whatever is queued, then exit instead of waiting for more')
+        parser.add_argument('--poll-seconds', type=float, default=settings.FINALIZE_WORKER_POLL_SECONDS,
+                            help='How long to wait when the queue is empty')
+
+    def handle(self, *args, **options):
+        worker = options['worker_id']
+        self.stdout.write(f'finalize_worker {worker} started')
+        while True:
+            # Long running, drop connections that went bad (e.g. a DB restart) before touching the queue
+            close_old_connections()
+            ran = run_pending_jobs(worker)
+            if ran:
+                self.stdout.write(f'Ran {ran} finalize jobs')
+            if options['once']:
+                break
+            if not ran:
+                time.sleep(options['poll_seconds'])
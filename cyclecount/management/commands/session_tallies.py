@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from cyclecount.tallies import find_tally_mismatches, find_counter_mismatches, rebuild_tallies
+
+
+class Command(BaseCommand):
+    help = ('Check the SessionTally rows and CountSession counters against the IndividualCounts they summarize, '
+            'or rebuild them')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--session', type=int, action='append', dest='session_ids',
+                            help='Only this CountSession id, can be repeated (default: every session)')
+        parser.add_argument('--rebuild', action='store_true',
+                            help='Recompute the tallies from IndividualCount instead of only checking them')
+
+    def handle(self, *args, **options):
+        session_ids = options['session_ids']
+        if options['rebuild']:
+            rows = rebuild_tallies(session_ids)
+            self.stdout.write(f'Rebuilt {rows} tally rows')
+
+        mismatches = find_tally_mismatches(session_ids)
+        for mismatch in mismatches:
+            self.stdout.write(
+                f'session:{mismatch.session_id} location:{mismatch.location_id} product:{mismatch.product_id} '
+                f'expected qty:{mismatch.expected_qty} scans:{mismatch.expected_scan_count} '
+                f'tallied qty:{mismatch.tallied_qty} scans:{mismatch.tallied_scan_count}'
+            )
+        counter_mismatches = find_counter_mismatches(session_ids)
+        for mismatch in counter_mismatches:
+            self.stdout.write(f'session:{mismatch.session_id} counters expected (total, active, locations, skus):'
+                              f'{mismatch.expected} stored:{mismatch.stored}')
+        if mismatches or counter_mismatches:
+            raise CommandError(f'{len(mismatches)} tally rows and {len(counter_mismatches)} sessions out of date, '
+                               f'run with --rebuild to fix them')
+        self.stdout.write('Tallies are consistent')
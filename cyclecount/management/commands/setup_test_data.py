@@ -1,25 +1,40 @@
-import random
 from django.core.management.base import BaseCommand
 
-from cyclecount.factories import LocationFactory, ProductFactory, InventoryFactory
+from cyclecount.scale_data import ScaleConfig, generate, truncate
 
 
 class Command(BaseCommand):
-    help = 'Generate test data'
+    help = 'Generate test data (products, locations, inventory and open count sessions) at a configurable scale'
 
-    def handle(self, *args, **kwargs):
-        self.stdout.write("Creating new data...")
+    def add_arguments(self, parser):
+        defaults = ScaleConfig()
+        parser.add_argument('--products', type=int, default=defaults.products)
+        parser.add_argument('--locations', type=int, default=defaults.locations)
+        parser.add_argument('--fill-ratio', type=float, default=defaults.fill_ratio,
+                            help='Share of locations that hold any inventory')
+        parser.add_argument('--max-products-per-location', type=int, default=defaults.max_products_per_location)
+        parser.add_argument('--associates', type=int, default=defaults.associates)
+        parser.add_argument('--sessions', type=int, default=defaults.sessions, help='Open count sessions to create')
+        parser.add_argument('--scans-per-session', type=int, default=defaults.scans_per_session)
+        parser.add_argument('--seed', type=int, default=defaults.seed,
+                            help='The same seed and scale always generate the same data')
+        parser.add_argument('--batch-size', type=int, default=defaults.batch_size)
+        parser.add_argument('--method', choices=['copy', 'bulk'], default=defaults.method,
+                            help='Load with Postgres COPY or bulk_create')
+        parser.add_argument('--workers', type=int, default=defaults.workers,
+                            help='Processes to split the generation over')
+        parser.add_argument('--truncate', action='store_true',
+                            help='Empty every cyclecount table (except users) first')
 
-        # First make the products we can pick from.
-        products = []
-        for _ in range(200000):
-            products.append(ProductFactory())
+    def handle(self, *args, **options):
+        config = ScaleConfig(**{field: options[field] for field in ScaleConfig._fields})
+        if options['truncate']:
+            self.stdout.write('Truncating...')
+            truncate()
 
-        for _ in range(100000):
-            location = LocationFactory()
-            inventory_fks = set()
-            for _ in range(0, random.randint(0, 4)):
-                inventory_fks.add(random.choice(products))
+        self.stdout.write(f'Creating new data... {config}')
 
-            for product in inventory_fks:
-                InventoryFactory(product=product, location=location)
+        def phase_done(phase: str, rows: int, seconds: float) -> None:
+            self.stdout.write(f'{phase}: {rows} rows in {seconds:.1f}s ({rows / max(seconds, 0.001):.0f} rows/s)')
+
+        generate(config, phase_done)
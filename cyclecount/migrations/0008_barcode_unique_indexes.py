@@ -0,0 +1,39 @@
+# Generated by Django 4.1.4 on 2026-10-18 15:59
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def check_no_duplicate_barcodes(apps, schema_editor):
+    # Merging two locations/products means moving their inventory and counts over, which needs someone to decide
+    # which one is right. Stop with the list instead of failing on the index.
+    duplicates = []
+    for (model_name, field) in (('Location', 'description'), ('Product', 'sku')):
+        model = apps.get_model('cyclecount', model_name)
+        values = (model.objects.values(field).annotate(row_count=Count('id')).filter(row_count__gt=1)
+                  .order_by(field).values_list(field, flat=True))
+        duplicates += [f'{model_name}.{field} {value!r}' for value in values[:20]]
+    if duplicates:
+        raise RuntimeError('Barcodes have to be unique before migrating, merge or rename the duplicates: '
+                           + ', '.join(duplicates))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cyclecount', '0007_alter_inventory_unique_together'),
+    ]
+
+    operations = [
+        migrations.RunPython(check_no_duplicate_barcodes, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='location',
+            name='description',
+            field=models.CharField(max_length=200, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='product',
+            name='sku',
+            field=models.CharField(max_length=200, unique=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.1.4 on 2026-10-18 16:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cyclecount', '0008_barcode_unique_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='individualcount',
+            name='client_scanned_at',
+            field=models.DateTimeField(null=True),
+        ),
+    ]
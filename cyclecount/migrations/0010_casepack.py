@@ -0,0 +1,23 @@
+# Generated by Django 4.1.4 on 2026-10-18 16:10
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cyclecount', '0009_individualcount_client_scanned_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CasePack',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('barcode', models.CharField(max_length=200, unique=True)),
+                ('qty', models.PositiveIntegerField()),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='cyclecount.product')),
+            ],
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 4.1.4 on 2026-10-18 16:20
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+# Sessions opened before SessionTally existed, review and finalize only read the tallies.
+BACKFILL_SQL = '''
+INSERT INTO cyclecount_sessiontally (session_id, location_id, product_id, counted_qty, scan_count, last_scanned_at)
+SELECT session_id, location_id, product_id, SUM(qty), COUNT(*), MAX(created_at)
+FROM cyclecount_individualcount
+WHERE state = 'Active'
+GROUP BY session_id, location_id, product_id;
+'''
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cyclecount', '0010_casepack'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SessionTally',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('counted_qty', models.IntegerField(default=0)),
+                ('scan_count', models.IntegerField(default=0)),
+                ('last_scanned_at', models.DateTimeField(null=True)),
+                ('location', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='cyclecount.location')),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='cyclecount.product')),
+                ('session', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='cyclecount.countsession')),
+            ],
+            options={
+                'unique_together': {('session', 'location', 'product')},
+            },
+        ),
+        migrations.RunSQL(BACKFILL_SQL, migrations.RunSQL.noop),
+    ]
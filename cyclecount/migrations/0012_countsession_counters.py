@@ -0,0 +1,61 @@
+# Generated by Django 4.1.4 on 2026-10-18 16:40
+
+from django.db import migrations, models
+
+
+# The tallies were backfilled by 0011, the counters are worked out from IndividualCount.
+BACKFILL_SQL = '''
+UPDATE cyclecount_countsession s
+SET total_scans = counts.total_scans, active_scans = counts.active_scans,
+    distinct_locations = counts.distinct_locations, distinct_skus = counts.distinct_skus,
+    last_scan_at = counts.last_scan_at
+FROM (
+    SELECT session_id, COUNT(*) AS total_scans, COUNT(*) FILTER (WHERE state = 'Active') AS active_scans,
+           COUNT(DISTINCT location_id) FILTER (WHERE state = 'Active') AS distinct_locations,
+           COUNT(DISTINCT product_id) FILTER (WHERE state = 'Active') AS distinct_skus,
+           MAX(created_at) AS last_scan_at
+    FROM cyclecount_individualcount
+    GROUP BY session_id
+) counts
+WHERE s.id = counts.session_id;
+'''
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cyclecount', '0011_sessiontally'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='countsession',
+            name='active_scans',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='countsession',
+            name='distinct_locations',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='countsession',
+            name='distinct_skus',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='countsession',
+            name='last_scan_at',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddField(
+            model_name='countsession',
+            name='total_scans',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='sessiontally',
+            index=models.Index(fields=['session', 'product'], name='sessiontally_session_product'),
+        ),
+        migrations.RunSQL(BACKFILL_SQL, migrations.RunSQL.noop),
+    ]
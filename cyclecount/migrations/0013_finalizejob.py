@@ -0,0 +1,38 @@
+# Generated by Django 4.1.4 on 2026-10-18 17:05
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cyclecount', '0012_countsession_counters'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FinalizeJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('state', models.CharField(choices=[('Queued', 'Queued'), ('Running', 'Running'), ('Done', 'Done'), ('Failed', 'Failed')], default='Queued', max_length=10)),
+                ('attempts', models.IntegerField(default=0)),
+                ('worker', models.CharField(max_length=200, null=True)),
+                ('heartbeat_at', models.DateTimeField(null=True)),
+                ('keys_total', models.IntegerField(null=True)),
+                ('keys_done', models.IntegerField(default=0)),
+                ('last_location_id', models.BigIntegerField(null=True)),
+                ('last_product_id', models.BigIntegerField(null=True)),
+                ('error', models.TextField(null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('finished_at', models.DateTimeField(null=True)),
+                ('requested_by', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+                ('session', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, to='cyclecount.countsession')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['state', 'id'], name='finalizejob_state_id')],
+            },
+        ),
+    ]
@@ -0,0 +1,59 @@
+# Generated by Django 4.1.4 on 2026-10-18 17:40
+
+from django.db import migrations, models
+
+
+# Every write to an IndividualCount takes the next sync_seq, after locking its session. Writers to a session
+# already take turns on that row (the scan insert and the tally counters lock it anyway), so a session's numbers
+# are handed out in commit order: a handheld that has seen N of a session has seen everything before N as well.
+SYNC_TRIGGER_SQL = '''
+CREATE SEQUENCE cyclecount_individualcount_sync_seq;
+
+UPDATE cyclecount_individualcount SET sync_seq = nextval('cyclecount_individualcount_sync_seq');
+
+CREATE FUNCTION cyclecount_individualcount_sync() RETURNS trigger AS $$
+BEGIN
+    PERFORM 1 FROM cyclecount_countsession WHERE id = NEW.session_id FOR NO KEY UPDATE;
+    NEW.sync_seq := nextval('cyclecount_individualcount_sync_seq');
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER cyclecount_individualcount_sync BEFORE INSERT OR UPDATE ON cyclecount_individualcount
+FOR EACH ROW EXECUTE FUNCTION cyclecount_individualcount_sync();
+'''
+
+DROP_SYNC_TRIGGER_SQL = '''
+DROP TRIGGER cyclecount_individualcount_sync ON cyclecount_individualcount;
+DROP FUNCTION cyclecount_individualcount_sync();
+DROP SEQUENCE cyclecount_individualcount_sync_seq;
+'''
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cyclecount', '0013_finalizejob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='individualcount',
+            name='client_key',
+            field=models.CharField(max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='individualcount',
+            name='sync_seq',
+            field=models.BigIntegerField(editable=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='individualcount',
+            index=models.Index(fields=['session', 'sync_seq'], name='individualcount_session_sync'),
+        ),
+        migrations.AddConstraint(
+            model_name='individualcount',
+            constraint=models.UniqueConstraint(fields=('session', 'client_key'), name='individualcount_session_client_key'),
+        ),
+        migrations.RunSQL(SYNC_TRIGGER_SQL, DROP_SYNC_TRIGGER_SQL),
+    ]
@@ -4,12 +4,21 @@ from django.contrib.auth.models import AbstractUser
 
 
 class Location(models.Model):
-    description = models.CharField(max_length=200)
+    # This is the barcode scanned on the location label, see cyclecount.barcodes
+    description = models.CharField(max_length=200, unique=True)
 
 
 class Product(models.Model):
     description = models.CharField(max_length=200)
-    sku = models.CharField(max_length=200)
+    # This is the barcode scanned on the product, see cyclecount.barcodes
+    sku = models.CharField(max_length=200, unique=True)
+
+
+class CasePack(models.Model):
+    # A barcode for a pack of some product (inner pack, case, ...) - scanning it counts qty units of the product.
+    product = models.ForeignKey(Product, on_delete=models.CASCADE)
+    barcode = models.CharField(max_length=200, unique=True)
+    qty = models.PositiveIntegerField()
 
 
 class Inventory(models.Model):
@@ -39,8 +48,17 @@ class CountSession(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    # Progress counters, maintained along with the SessionTally rows (see cyclecount.tallies) so listing
+    # sessions doesn't need to count IndividualCounts. Don't save() a stale instance over them.
+    total_scans = models.IntegerField(default=0)
+    active_scans = models.IntegerField(default=0)
+    # Locations / products with at least one ACTIVE scan
+    distinct_locations = models.IntegerField(default=0)
+    distinct_skus = models.IntegerField(default=0)
+    last_scan_at = models.DateTimeField(null=True)
+
     def count_of_individual_counts(self) -> int:
-        return IndividualCount.objects.filter(session=self).count()
+        return self.total_scans
 
 
 class IndividualCount(models.Model):
@@ -54,9 +72,43 @@ class IndividualCount(models.Model):
     product = models.ForeignKey(Product, on_delete=models.CASCADE)
     qty = models.IntegerField(default=1)
     state = models.CharField(max_length=10, choices=CountState.choices, default=CountState.ACTIVE)
+    # When the handheld says the scan happened, scans can be buffered on the device and submitted in batches.
+    client_scanned_at = models.DateTimeField(null=True)
+    # Idempotency key the handheld gives the scan, a scan submitted again (retried after a dropped connection) is
+    # only recorded once per session. See cyclecount.sync
+    client_key = models.CharField(max_length=64, null=True)
+    # Set on every insert/update by a trigger (migration 0014), the cursor handhelds pull changes with
+    sync_seq = models.BigIntegerField(null=True, editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['session', 'client_key'], name='individualcount_session_client_key'),
+        ]
+        indexes = [
+            # Changes of a session since a cursor, see sync.CHANGES_SQL
+            models.Index(fields=['session', 'sync_seq'], name='individualcount_session_sync'),
+        ]
+
+
+class SessionTally(models.Model):
+    # Running totals of the ACTIVE IndividualCounts of a session per (location, product), maintained as scans are
+    # recorded/deleted so review and finalize don't have to read every IndividualCount. See cyclecount.tallies
+    session = models.ForeignKey(CountSession, on_delete=models.CASCADE)
+    location = models.ForeignKey(Location, on_delete=models.CASCADE)
+    product = models.ForeignKey(Product, on_delete=models.CASCADE)
+    counted_qty = models.IntegerField(default=0)
+    scan_count = models.IntegerField(default=0)
+    last_scanned_at = models.DateTimeField(null=True)
+
+    class Meta:
+        unique_together = ('session', 'location', 'product')
+        indexes = [
+            # distinct_skus upkeep looks up the other tallies of a product
+            models.Index(fields=['session', 'product'], name='sessiontally_session_product'),
+        ]
+
 
 class CycleCountModification(models.Model):
     # TODO - still not sure how I want to model the final approval of counts that triggers the finally inventory count
@@ -70,6 +122,42 @@ class CycleCountModification(models.Model):
     updated_at = models.DateTimeField(auto_now=True)
 
 
+class FinalizeJob(models.Model):
+    # Applying an accepted session to Inventory, done by manage.py finalize_worker rather than in the request.
+    # See cyclecount.finalize_jobs
+    class State(models.TextChoices):
+        QUEUED = 'Queued'
+        RUNNING = 'Running'
+        DONE = 'Done'
+        FAILED = 'Failed'
+
+    # One job per session, enqueueing again is a no-op
+    session = models.OneToOneField(CountSession, on_delete=models.CASCADE)
+    requested_by = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    state = models.CharField(max_length=10, choices=State.choices, default=State.QUEUED)
+    attempts = models.IntegerField(default=0)
+    # The worker holding the job, and when it last showed signs of life. A RUNNING job that stops heartbeating is
+    # picked up by another worker (see FINALIZE_JOB_STALE_SECONDS).
+    worker = models.CharField(max_length=200, null=True)
+    heartbeat_at = models.DateTimeField(null=True)
+    # Progress, keys are applied in (location_id, product_id) order and the last applied key is committed with them,
+    # so a job that is picked up again carries on after it.
+    keys_total = models.IntegerField(null=True)
+    keys_done = models.IntegerField(default=0)
+    last_location_id = models.BigIntegerField(null=True)
+    last_product_id = models.BigIntegerField(null=True)
+    error = models.TextField(null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    finished_at = models.DateTimeField(null=True)
+
+    class Meta:
+        indexes = [
+            # The queue, see finalize_jobs.claim_job
+            models.Index(fields=['state', 'id'], name='finalizejob_state_id'),
+        ]
+
+
 # https://learndjango.com/tutorials/django-best-practices-referencing-user-model
 # https://docs.djangoproject.com/en/4.0/topics/auth/customizing/#auth-custom-user
 class CustomUser(AbstractUser):
@@ -0,0 +1,112 @@
+from typing import Dict, List, Tuple
+
+from django.db.models import F, OuterRef, Q, QuerySet, Subquery
+from django.db.models.functions import Coalesce
+
+from cyclecount.models import CountSession, IndividualCount, Inventory, SessionTally
+
+
+'''
+Queries behind the session review tables. Each returns values() rows with just the columns the tables show,
+sorting and filtering are applied in the DB so a page of a huge session costs about the same as a small one.
+'''
+
+
+class ReviewQueryError(ValueError):
+    pass
+
+
+# (field, 'asc' | 'desc') as sent by the table, and field -> the filter value
+Sorters = List[Tuple[str, str]]
+Filters = Dict[str, str]
+
+# Sortable field -> the column it sorts on
+PROPOSED_MODIFICATION_SORTS = {
+    'location_description': 'location_description',
+    'sku': 'sku',
+    'qty': 'qty',
+    'cyclecount_qty': 'cyclecount_qty',
+    'variance': 'variance',
+}
+INDIVIDUAL_COUNT_SORTS = {
+    'username': 'username',
+    'location_description': 'location_description',
+    'sku': 'sku',
+    'qty': 'qty',
+    'state': 'state',
+    'created_at': 'id',  # Same order as created_at, but on the primary key
+}
+
+VARIANCE_SIGNS = {
+    'positive': Q(variance__gt=0),
+    'negative': Q(variance__lt=0),
+    'zero': Q(variance=0),
+}
+
+
+def proposed_modifications(count_session: CountSession) -> QuerySet:
+    """
+    What finalizing the session would do to Inventory, one row per counted (location, product), in one query.
+    The tallies are already summed per key, Inventory is LEFT JOINed in (through the unique location/product
+    index) as a correlated subquery, 0 when there is no Inventory record yet.
+    :return: values() rows of location_id, product_id, location_description, sku, qty (current), cyclecount_qty
+             and variance (cyclecount_qty - qty)
+    """
+    current_qty = (Inventory.objects
+                   .filter(location_id=OuterRef('location_id'), product_id=OuterRef('product_id'))
+                   .values('qty')[:1])
+    return (SessionTally.objects
+            .filter(session=count_session, scan_count__gt=0)
+            .annotate(location_description=F('location__description'), sku=F('product__sku'),
+                      cyclecount_qty=F('counted_qty'), qty=Coalesce(Subquery(current_qty), 0))
+            .annotate(variance=F('cyclecount_qty') - F('qty'))
+            .values('location_id', 'product_id', 'location_description', 'sku', 'qty', 'cyclecount_qty', 'variance')
+            .order_by('location_id', 'product_id'))
+
+
+def individual_counts(count_session: CountSession) -> QuerySet:
+    """
+    :return: values() rows of id, username, location_description, sku, qty, state and created_at for every scan
+    """
+    return (IndividualCount.objects
+            .filter(session=count_session)
+            .annotate(username=F('associate__username'), location_description=F('location__description'),
+                      sku=F('product__sku'))
+            .values('id', 'username', 'location_description', 'sku', 'qty', 'state', 'created_at')
+            .order_by('id'))
+
+
+def _sorted(rows: QuerySet, sorters: Sorters, sorts: Dict[str, str], tie_breakers: Tuple[str, ...]) -> QuerySet:
+    ordering = []
+    for (field, direction) in sorters:
+        if field not in sorts or direction not in ('asc', 'desc'):
+            raise ReviewQueryError(f'Can not sort by {field} {direction}')
+        ordering.append(('-' if direction == 'desc' else '') + sorts[field])
+    # Always end on a unique column, otherwise OFFSET pagination can repeat or skip rows between pages.
+    return rows.order_by(*ordering, *tie_breakers) if ordering else rows
+
+
+def filter_proposed_modifications(rows: QuerySet, filters: Filters, sorters: Sorters = ()) -> QuerySet:
+    for (field, value) in filters.items():
+        if field == 'variance':
+            if value not in VARIANCE_SIGNS:
+                raise ReviewQueryError(f'variance must be one of {", ".join(VARIANCE_SIGNS)}')
+            rows = rows.filter(VARIANCE_SIGNS[value])
+        elif field in ('location_description', 'sku'):
+            rows = rows.filter(**{f'{field}__icontains': value})
+        else:
+            raise ReviewQueryError(f'Can not filter by {field}')
+    return _sorted(rows, sorters, PROPOSED_MODIFICATION_SORTS, ('location_id', 'product_id'))
+
+
+def filter_individual_counts(rows: QuerySet, filters: Filters, sorters: Sorters = ()) -> QuerySet:
+    for (field, value) in filters.items():
+        if field == 'username':
+            rows = rows.filter(username=value)
+        elif field == 'state':
+            rows = rows.filter(state=value)
+        elif field in ('location_description', 'sku'):
+            rows = rows.filter(**{f'{field}__icontains': value})
+        else:
+            raise ReviewQueryError(f'Can not filter by {field}')
+    return _sorted(rows, sorters, INDIVIDUAL_COUNT_SORTS, ('id',))
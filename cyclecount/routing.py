@@ -0,0 +1,9 @@
+from django.urls import path
+
+from cyclecount import consumers
+
+
+# WebSocket routes, served by CycleCounter/asgi.py
+websocket_urlpatterns = [
+    path('ws/scan/<int:session_id>', consumers.ScanConsumer.as_asgi(), name='scan_socket'),
+]
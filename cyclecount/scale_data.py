@@ -0,0 +1,319 @@
+import io
+import multiprocessing
+import random
+import time
+from datetime import datetime, timedelta
+from itertools import islice
+from typing import Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Sequence, Tuple, Type
+
+import structlog
+from django.contrib.auth.hashers import make_password
+from django.db import connection, connections, transaction
+from django.db.models import Max, Model
+from django.utils import timezone
+
+from cyclecount.models import (CustomUser, Location, Product, CasePack, Inventory, CountSession, IndividualCount,
+                               SessionTally, CycleCountModification)
+from cyclecount.tallies import rebuild_tallies
+
+
+log = structlog.get_logger(__name__)
+
+'''
+Scale data for load testing: products, locations, inventory, associates and open count sessions full of scans.
+
+Everything is derived from the seed and the row's index, e.g. the inventory of location 1234 is always the same
+for a given seed no matter which worker generates it or in what order, so a run can be split over processes and
+reproduced exactly. Products and locations get explicit ids (inventory and scans refer to them without reading
+anything back), the other tables take ids from their sequences.
+
+Rows are written with COPY (or bulk_create, for databases/drivers without it) in batches of batch_size.
+'''
+
+COLORS = ['Red', 'Blue', 'Green', 'Black', 'White', 'Yellow', 'Grey', 'Orange']
+ADJECTIVES = ['Heavy duty', 'Compact', 'Deluxe', 'Economy', 'Premium', 'Outdoor', 'Cordless', 'Classic']
+NOUNS = ['widget', 'bracket', 'hinge', 'lamp', 'fan', 'hose', 'drill', 'kettle', 'bin', 'shelf', 'cable', 'valve']
+SIZES = ['6in', '12in', '1L', '5L', '250g', '1kg', '10 pack', '50 pack']
+ZONES = 'ABCDEFGHJK'
+
+
+class ScaleConfig(NamedTuple):
+    products: int = 200000
+    locations: int = 100000
+    # Share of locations holding any inventory, and how many different products those hold
+    fill_ratio: float = 0.7
+    max_products_per_location: int = 4
+    associates: int = 20
+    # Open sessions, each counting a run of consecutive locations (an aisle or three)
+    sessions: int = 3
+    scans_per_session: int = 10000
+    seed: int = 1
+    batch_size: int = 50000
+    method: str = 'copy'
+    workers: int = 1
+
+
+def ean13(number: int) -> str:
+    # 12 digits + check digit, prefix 2 is for restricted/in-store numbering so these won't clash with real GTINs
+    digits = f'2{number:011d}'
+    check = (10 - sum(int(d) * (3 if i % 2 else 1) for (i, d) in enumerate(digits)) % 10) % 10
+    return digits + str(check)
+
+
+def location_barcode(index: int) -> str:
+    # zone-aisle-bay-level, e.g. C-014-07-2
+    (index, level) = divmod(index, 5)
+    (index, bay) = divmod(index, 20)
+    (zone, aisle) = divmod(index, 100)
+    return f'{ZONES[zone % len(ZONES)]}{zone // len(ZONES) or ""}-{aisle:03d}-{bay:02d}-{level}'
+
+
+def product_description(seed: int, index: int) -> str:
+    # A multiplicative hash of the index rather than a Random per product, cheap and the same in any shard.
+    h = ((index + 1) * 2654435761 + seed * 40503) % 4294967291
+    return (f'{ADJECTIVES[h % len(ADJECTIVES)]} {COLORS[(h >> 3) % len(COLORS)].lower()} '
+            f'{NOUNS[(h >> 6) % len(NOUNS)]} {SIZES[(h >> 10) % len(SIZES)]}')
+
+
+def location_inventory(config: ScaleConfig, location_index: int) -> List[Tuple[int, int]]:
+    """
+    :return: (product_index, qty) of everything stocked at the location, the same on every call for a given seed
+    """
+    rng = random.Random(config.seed * 1000003 + location_index)
+    if rng.random() >= config.fill_ratio:
+        return []
+    product_indexes = rng.sample(range(config.products), min(rng.randint(1, config.max_products_per_location),
+                                                             config.products))
+    return [(product_index, rng.randint(0, 20)) for product_index in product_indexes]
+
+
+class IdBase(NamedTuple):
+    # Generated product/location index 0 gets id product/location + 0
+    product: int
+    location: int
+    associates: List[int]
+    # (session_id, location index where its associates start counting)
+    sessions: List[Tuple[int, int]] = []
+
+
+def _batched(rows: Iterable[tuple], size: int) -> Iterator[List[tuple]]:
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+
+def _copy_value(value) -> str:
+    # Our generated values never contain tabs, newlines or backslashes, so no escaping needed.
+    return r'\N' if value is None else str(value)
+
+
+def load_rows(model: Type[Model], columns: Sequence[str], rows: Iterable[tuple], config: ScaleConfig) -> int:
+    """
+    Write rows (tuples in the order of columns, which are attnames) in batches of config.batch_size.
+    :return: number of rows written
+    """
+    table = model._meta.db_table
+    count = 0
+    started = time.perf_counter()
+    for batch in _batched(rows, config.batch_size):
+        if config.method == 'copy':
+            buffer = io.StringIO()
+            for row in batch:
+                buffer.write('\t'.join(_copy_value(value) for value in row))
+                buffer.write('\n')
+            buffer.seek(0)
+            with connection.cursor() as cursor:
+                cursor.copy_expert(f'COPY {table} ({", ".join(columns)}) FROM STDIN', buffer)
+        else:
+            # Note auto_now(_add) fields get the current time here rather than the generated one.
+            model.objects.bulk_create([model(**dict(zip(columns, row))) for row in batch])
+        count += len(batch)
+        elapsed = time.perf_counter() - started
+        log.info('scale_data batch', table=table, rows=count,
+                 rows_per_second=int(count / elapsed) if elapsed else None)
+    return count
+
+
+def _product_rows(config: ScaleConfig, ids: IdBase, start: int, stop: int) -> Iterator[tuple]:
+    for index in range(start, stop):
+        # Barcodes come from the id, so generating more data on top of an existing data set doesn't collide.
+        yield ids.product + index, product_description(config.seed, index), ean13(ids.product + index)
+
+
+def _location_rows(ids: IdBase, start: int, stop: int) -> Iterator[tuple]:
+    for index in range(start, stop):
+        yield ids.location + index, location_barcode(ids.location + index)
+
+
+def _inventory_rows(config: ScaleConfig, ids: IdBase, start: int, stop: int, now: datetime) -> Iterator[tuple]:
+    for location_index in range(start, stop):
+        for (product_index, qty) in location_inventory(config, location_index):
+            yield ids.location + location_index, ids.product + product_index, qty, now, now
+
+
+def _scan_rows(config: ScaleConfig, ids: IdBase, session_index: int, started_at: datetime) -> Iterator[tuple]:
+    """
+    What associates walking the aisle would scan: every product at each location, mostly the right amount,
+    sometimes off by a bit, missed, or with a product that isn't supposed to be there. Small quantities are
+    scanned unit by unit, bigger ones with qty entry. The odd scan is a mistake that got deleted and redone.
+    """
+    (session_id, first_location) = ids.sessions[session_index]
+    rng = random.Random(f'{config.seed}-session-{session_index}')
+    active = IndividualCount.CountState.ACTIVE
+    deleted = IndividualCount.CountState.DELETED
+    scanned_at = started_at
+    scans = 0
+    location_index = first_location
+    # Stops early if it went round every location (a warehouse with too little stock for that many scans)
+    while scans < config.scans_per_session and location_index < first_location + config.locations:
+        associate_id = ids.associates[(location_index // 20) % len(ids.associates)]
+        stock = location_inventory(config, location_index % config.locations)
+        counted = []
+        for (product_index, qty) in stock:
+            roll = rng.random()
+            if roll < 0.03:
+                continue  # Missed it, or it really isn't there
+            counted.append((product_index, max(qty + rng.randint(-2, 2), 0) if roll < 0.13 else qty))
+        if config.products and rng.random() < 0.02:
+            counted.append((rng.randrange(config.products), rng.randint(1, 5)))
+
+        location_id = ids.location + location_index % config.locations
+        for (product_index, qty) in counted:
+            product_id = ids.product + product_index
+            scan_quantities = [1] * qty if qty <= 3 else [qty]
+            for scan_qty in scan_quantities:
+                scanned_at += timedelta(seconds=rng.uniform(1, 4))
+                states = [deleted, active] if rng.random() < 0.01 else [active]
+                for state in states:
+                    yield (associate_id, session_id, location_id, product_id,
+                           scan_qty + 1 if state == deleted else scan_qty, state, None, scanned_at, scanned_at)
+                scans += len(states)
+        location_index += 1
+
+
+INVENTORY_COLUMNS = ('location_id', 'product_id', 'qty', 'created_at', 'updated_at')
+SCAN_COLUMNS = ('associate_id', 'session_id', 'location_id', 'product_id', 'qty', 'state', 'client_scanned_at',
+                'created_at', 'updated_at')
+
+
+def _shard_range(total: int, shard: int, shards: int) -> Tuple[int, int]:
+    return total * shard // shards, total * (shard + 1) // shards
+
+
+def _load_catalog_shard(config: ScaleConfig, ids: IdBase, shard: int, shards: int, now: datetime) -> int:
+    with transaction.atomic():
+        products = load_rows(Product, ('id', 'description', 'sku'),
+                             _product_rows(config, ids, *_shard_range(config.products, shard, shards)), config)
+        locations = load_rows(Location, ('id', 'description'),
+                              _location_rows(ids, *_shard_range(config.locations, shard, shards)), config)
+    return products + locations
+
+
+def _load_inventory_shard(config: ScaleConfig, ids: IdBase, shard: int, shards: int, now: datetime) -> int:
+    (start, stop) = _shard_range(config.locations, shard, shards)
+    with transaction.atomic():
+        return load_rows(Inventory, INVENTORY_COLUMNS, _inventory_rows(config, ids, start, stop, now), config)
+
+
+def _load_scans_shard(config: ScaleConfig, ids: IdBase, shard: int, shards: int, now: datetime) -> int:
+    scans = 0
+    (start, stop) = _shard_range(len(ids.sessions), shard, shards)
+    for session_index in range(start, stop):
+        started_at = now - timedelta(seconds=config.scans_per_session * 3)
+        with transaction.atomic():
+            scans += load_rows(IndividualCount, SCAN_COLUMNS, _scan_rows(config, ids, session_index, started_at),
+                               config)
+    return scans
+
+
+def _run_shard(args) -> int:
+    (function, config, ids, shard, shards, now) = args
+    # Forked from the parent, which may have had a connection open. Each worker needs its own.
+    connections.close_all()
+    try:
+        return function(config, ids, shard, shards, now)
+    finally:
+        connections.close_all()
+
+
+def _run_sharded(function, config: ScaleConfig, ids: IdBase, now: datetime) -> int:
+    if config.workers <= 1:
+        return function(config, ids, 0, 1, now)
+    connections.close_all()
+    with multiprocessing.get_context('fork').Pool(config.workers) as pool:
+        return sum(pool.map(_run_shard, [(function, config, ids, shard, config.workers, now)
+                                         for shard in range(config.workers)]))
+
+
+def _next_id(model: Type[Model]) -> int:
+    return (model.objects.aggregate(max_id=Max('id'))['max_id'] or 0) + 1
+
+
+def _reset_sequence(model: Type[Model]) -> None:
+    table = model._meta.db_table
+    with connection.cursor() as cursor:
+        cursor.execute(f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+                       f"GREATEST((SELECT MAX(id) FROM {table}), 1))")
+
+
+def truncate() -> None:
+    # Everything but the users
+    tables = [model._meta.db_table for model in (CycleCountModification, SessionTally, IndividualCount,
+                                                 CountSession, Inventory, CasePack, Location, Product)]
+    with connection.cursor() as cursor:
+        cursor.execute(f'TRUNCATE {", ".join(tables)} RESTART IDENTITY CASCADE')
+
+
+def _associates(config: ScaleConfig) -> List[int]:
+    usernames = [f'associate-{index:04d}' for index in range(config.associates)]
+    password = make_password('associate')
+    CustomUser.objects.bulk_create([CustomUser(username=username, password=password) for username in usernames],
+                                   ignore_conflicts=True)
+    return list(CustomUser.objects.filter(username__in=usernames).order_by('username').values_list('id', flat=True))
+
+
+def generate(config: ScaleConfig, phase_done: Optional[Callable[[str, int, float], None]] = None) -> Dict[str, int]:
+    """
+    Generate and load a data set. phase_done(phase, rows, seconds) is called after each phase, for reporting.
+    :return: phase -> rows written
+    """
+    now = timezone.now()
+    totals: Dict[str, int] = {}
+
+    def run_phase(phase: str, work: Callable[[], int]) -> None:
+        started = time.perf_counter()
+        totals[phase] = work()
+        if phase_done is not None:
+            phase_done(phase, totals[phase], time.perf_counter() - started)
+
+    ids = IdBase(product=_next_id(Product), location=_next_id(Location), associates=_associates(config))
+    totals['associates'] = len(ids.associates)
+
+    def catalog() -> int:
+        rows = _run_sharded(_load_catalog_shard, config, ids, now)
+        _reset_sequence(Product)
+        _reset_sequence(Location)
+        return rows
+    run_phase('products and locations', catalog)
+    run_phase('inventory', lambda: _run_sharded(_load_inventory_shard, config, ids, now))
+
+    def scans() -> int:
+        rng = random.Random(f'{config.seed}-sessions')
+        count_sessions = CountSession.objects.bulk_create([
+            CountSession(created_by_id=rng.choice(ids.associates)) for _ in range(config.sessions)
+        ])
+        session_ids = [count_session.id for count_session in count_sessions]
+        session_ids_and_starts = [(session_id, rng.randrange(config.locations)) for session_id in session_ids]
+        rows = _run_sharded(_load_scans_shard, config, ids._replace(sessions=session_ids_and_starts), now)
+        # Tallies and session counters in one set based pass per session, rather than row by row.
+        rebuild_tallies(session_ids)
+        return rows
+    if config.sessions and ids.associates and config.locations:
+        run_phase('count sessions', scans)
+
+    log.info('scale_data generated', seed=config.seed, **{phase.replace(' ', '_'): rows
+                                                          for (phase, rows) in totals.items()})
+    return totals
@@ -0,0 +1,110 @@
+import threading
+import time
+from typing import Any, Callable, Dict, NamedTuple, Optional, Tuple
+
+import structlog
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+from cyclecount.models import CountSession, Location
+
+
+log = structlog.get_logger(__name__)
+
+'''
+Every page of the scan loop needs the session (is it still open?) and the location being counted, and neither
+changes while associates are scanning: a session closes once, at finalize, and locations are set up ahead of time.
+So instead of loading them per request they're cached, in process for SCAN_CONTEXT_TTL_SECONDS, behind a shared
+tier in Django's cache (SCAN_CONTEXT_SHARED_ALIAS) so other processes pick up a change without waiting for it.
+
+- Saving a CountSession or Location (finalize_session included) drops it from this process and the shared tier,
+  again once the transaction commits, see cyclecount.signals.
+- Other processes can still have a session as open in memory for up to the TTL after it was finalized. That's only
+  ever used to show the scan pages; the insert of a scan re-checks the session itself (scans.INSERT_SCAN_SQL), so a
+  scan arriving after finalize is rejected whatever the cache says.
+'''
+
+
+class SessionContext(NamedTuple):
+    id: int
+    is_open: bool
+
+
+class LocationContext(NamedTuple):
+    id: int
+    description: str
+
+
+class ContextCache:
+    """
+    pk -> small immutable value, in process with a TTL and in the shared cache. Ids that don't exist aren't cached
+    (they may be about to).
+    """
+
+    def __init__(self, name: str, load: Callable[[int], Optional[Any]]):
+        self.name = name
+        self.load = load
+        # pk -> (expires_at, value)
+        self._values: Dict[int, Tuple[float, Any]] = {}
+        self._lock = threading.Lock()
+
+    def _shared_key(self, pk: int) -> str:
+        return f'scan-context:{self.name}:{pk}'
+
+    def get(self, pk: int) -> Optional[Any]:
+        entry = self._values.get(pk)
+        if entry is not None and entry[0] > time.monotonic():
+            return entry[1]
+
+        shared = caches[settings.SCAN_CONTEXT_SHARED_ALIAS] if settings.SCAN_CONTEXT_SHARED_ALIAS else None
+        value = shared.get(self._shared_key(pk)) if shared is not None else None
+        if value is None:
+            value = self.load(pk)
+            if value is None:
+                return None
+            if shared is not None:
+                shared.set(self._shared_key(pk), value, timeout=settings.SCAN_CONTEXT_TTL_SECONDS)
+        with self._lock:
+            if len(self._values) >= settings.SCAN_CONTEXT_MAX_ENTRIES:
+                self._values.clear()
+            self._values[pk] = (time.monotonic() + settings.SCAN_CONTEXT_TTL_SECONDS, value)
+        return value
+
+    def invalidate(self, pk: int) -> None:
+        with self._lock:
+            self._values.pop(pk, None)
+        if settings.SCAN_CONTEXT_SHARED_ALIAS:
+            caches[settings.SCAN_CONTEXT_SHARED_ALIAS].delete(self._shared_key(pk))
+
+    def invalidate_on_commit(self, pk: int) -> None:
+        # Dropped right away for the rest of this transaction, and again once it commits: a request that loaded
+        # the row in the meantime saw (and cached) the old version.
+        self.invalidate(pk)
+        transaction.on_commit(lambda: self.invalidate(pk))
+
+    def clear(self) -> None:
+        with self._lock:
+            self._values.clear()
+
+
+def _load_session(session_id: int) -> Optional[SessionContext]:
+    row = CountSession.objects.filter(pk=session_id).values_list('id', 'final_state').first()
+    return None if row is None else SessionContext(id=row[0], is_open=row[1] is None)
+
+
+def _load_location(location_id: int) -> Optional[LocationContext]:
+    row = Location.objects.filter(pk=location_id).values_list('id', 'description').first()
+    return None if row is None else LocationContext(*row)
+
+
+session_contexts = ContextCache('session', _load_session)
+location_contexts = ContextCache('location', _load_location)
+
+
+def open_session(session_id: int) -> Optional[SessionContext]:
+    """
+    :return: the session, if it exists and (as far as the cache knows) hasn't been finalized
+    """
+    session = session_contexts.get(session_id)
+    return session if session is not None and session.is_open else None
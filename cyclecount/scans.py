@@ -0,0 +1,305 @@
+from datetime import datetime
+from typing import Iterable, List, Dict, Optional, Type
+
+import structlog
+from django.db import connection, transaction
+from django.utils import timezone
+from pydantic import BaseModel, Field, ValidationError
+
+from cyclecount.barcodes import ProductScan, location_resolver, resolve_product_barcodes, resolve_product_barcode
+from cyclecount.models import CountSession, IndividualCount
+from cyclecount.scan_context import open_session
+from cyclecount.tallies import add_to_tallies
+
+
+log = structlog.get_logger(__name__)
+
+
+# What's been counted so far at a location, newest first
+LOCATION_TALLIES_SQL = '''
+SELECT t.product_id, p.sku, t.counted_qty, t.scan_count
+FROM cyclecount_sessiontally t
+JOIN cyclecount_product p ON p.id = t.product_id
+WHERE t.session_id = %s AND t.location_id = %s AND t.scan_count > 0
+ORDER BY t.last_scanned_at DESC, t.product_id
+'''
+
+
+# A single scan, inserted only if its session is still open. Checking final_state in the same statement (under the
+# same FOR NO KEY UPDATE lock as lock_open_session) saves loading the session first, and it's what makes the cached
+# open/finalized state in scan_context safe to use everywhere else.
+INSERT_SCAN_SQL = '''
+INSERT INTO cyclecount_individualcount
+    (associate_id, session_id, location_id, product_id, qty, state, client_scanned_at, created_at, updated_at)
+SELECT %(associate_id)s, s.id, %(location_id)s, %(product_id)s, %(qty)s, %(state)s, %(client_scanned_at)s,
+       %(now)s, %(now)s
+FROM cyclecount_countsession s
+WHERE s.id = %(session_id)s AND s.final_state IS NULL
+FOR NO KEY UPDATE OF s
+RETURNING id
+'''
+
+
+# A batch of scans, skipping the ones whose client_key the session already has (resubmitted after a dropped
+# connection). Rows come back in the order they were inserted, see insert_scans.
+INSERT_SCANS_SQL = '''
+INSERT INTO cyclecount_individualcount
+    (associate_id, session_id, location_id, product_id, qty, state, client_scanned_at, client_key, created_at,
+     updated_at)
+SELECT u.*, %s::timestamptz, %s::timestamptz
+FROM unnest(%s::bigint[], %s::bigint[], %s::bigint[], %s::bigint[], %s::integer[], %s::varchar[], %s::timestamptz[],
+            %s::varchar[]) AS u
+ON CONFLICT (session_id, client_key) DO NOTHING
+RETURNING id, client_key
+'''
+
+
+# Most units a single scan can count: IndividualCount.qty (and the tallies it adds up to) is a 32 bit integer. The
+# qty typed in is capped at MAX_SCAN_QTY, which still leaves room for a case pack/GS1 multiplier; a scan whose
+# qty times the multiplier goes past MAX_COUNTED_QTY is rejected.
+MAX_SCAN_QTY = 100000
+MAX_COUNTED_QTY = 2 ** 31 - 1
+
+
+def counted_qty(scan_qty: int, product_scan: ProductScan) -> Optional[int]:
+    """
+    :return: units counted by scanning the barcode scan_qty times, None if that's more than a count can hold
+    """
+    qty = scan_qty * product_scan.qty
+    return qty if qty <= MAX_COUNTED_QTY else None
+
+
+class ScanIn(BaseModel):
+    location: str
+    sku: str
+    qty: int = Field(default=1, ge=1, le=MAX_SCAN_QTY)
+    client_timestamp: Optional[datetime] = None
+    # Idempotency key, a uuid the handheld makes up when the scan happens. Optional, scans without one are
+    # recorded every time they're submitted.
+    key: Optional[str] = Field(default=None, min_length=1, max_length=64)
+
+
+class SingleScanIn(BaseModel):
+    location: str
+    # Left out when the associate has only scanned the location so far
+    sku: Optional[str] = None
+    qty: int = Field(default=1, ge=1, le=MAX_SCAN_QTY)
+    client_timestamp: Optional[datetime] = None
+
+
+def lock_open_session(session_id: int) -> bool:
+    """
+    Check the CountSession is still open, holding a FOR NO KEY UPDATE lock on it until the end of the transaction.
+
+    The scan goes on to update the session's counters, taking the lock up front (rather than FOR SHARE and then
+    upgrading it) keeps two batches for the same session from deadlocking. finalize_session (FOR UPDATE) has to
+    wait for the scan, and a scan that was waiting on finalize sees the final_state it set.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT final_state FROM cyclecount_countsession WHERE id = %s FOR NO KEY UPDATE', [session_id])
+        row = cursor.fetchone()
+    return row is not None and row[0] is None
+
+
+def insert_scan(individual_count: IndividualCount) -> bool:
+    """
+    Insert a new IndividualCount unless its session is finalized, in one statement. Like bulk_create no signals
+    are sent, call add_to_tallies in the same transaction.
+    :return: False (and nothing inserted) if the session doesn't exist or is finalized
+    """
+    now = timezone.now()
+    with connection.cursor() as cursor:
+        cursor.execute(INSERT_SCAN_SQL, {
+            'associate_id': individual_count.associate_id, 'session_id': individual_count.session_id,
+            'location_id': individual_count.location_id, 'product_id': individual_count.product_id,
+            'qty': individual_count.qty, 'state': individual_count.state,
+            'client_scanned_at': individual_count.client_scanned_at, 'now': now,
+        })
+        row = cursor.fetchone()
+    if row is None:
+        return False
+    individual_count.id = row[0]
+    individual_count.created_at = individual_count.updated_at = now
+    individual_count._state.adding = False
+    return True
+
+
+def insert_scans(individual_counts: List[IndividualCount]) -> Dict[str, int]:
+    """
+    Insert new IndividualCounts (setting their ids) like bulk_create, except those whose client_key is already
+    taken in the session, including by an earlier scan of the same batch. Like bulk_create no signals are sent,
+    call add_to_tallies for the inserted ones in the same transaction.
+    :return: client_key -> id of the scan already recorded with it, for the ones that weren't inserted
+    """
+    if not individual_counts:
+        return {}
+    now = timezone.now()
+    with connection.cursor() as cursor:
+        cursor.execute(INSERT_SCANS_SQL, [now, now] + [
+            [getattr(individual_count, column) for individual_count in individual_counts]
+            for column in ('associate_id', 'session_id', 'location_id', 'product_id', 'qty', 'state',
+                           'client_scanned_at', 'client_key')
+        ])
+        inserted = cursor.fetchall()
+
+    # The rows that were skipped are missing from what came back, the rest is in order
+    duplicates: Dict[int, List[IndividualCount]] = {}
+    returned = iter(inserted)
+    row = next(returned, None)
+    for individual_count in individual_counts:
+        if row is not None and row[1] == individual_count.client_key:
+            individual_count.id = row[0]
+            individual_count.created_at = individual_count.updated_at = now
+            individual_count._state.adding = False
+            row = next(returned, None)
+        else:
+            duplicates.setdefault(individual_count.session_id, []).append(individual_count)
+
+    existing: Dict[str, int] = {}
+    for (session_id, skipped) in duplicates.items():
+        existing.update(IndividualCount.objects
+                        .filter(session_id=session_id, client_key__in={scan.client_key for scan in skipped})
+                        .values_list('client_key', 'id'))
+    return existing
+
+
+def _rejected(index: int, error: str) -> Dict:
+    return {'index': index, 'status': 'rejected', 'error': error}
+
+
+def _validation_error(e: ValidationError) -> str:
+    error = e.errors()[0]
+    return f"{'.'.join(str(part) for part in error['loc'])}: {error['msg']}"
+
+
+def record_scan_batch(session_id: int, associate, raw_scans: List[Dict],
+                      scan_model: Type[ScanIn] = ScanIn) -> Optional[List[Dict]]:
+    """
+    Validate a batch of scans (as scan_model) and insert the valid ones with a single statement. Scans with a key
+    the session already has aren't inserted again, they come back as duplicates with the id they were recorded under.
+    :return: a result per scan in the order submitted, or None if the session doesn't exist or is finalized
+    """
+    results: List[Optional[Dict]] = [None] * len(raw_scans)
+    scans: Dict[int, ScanIn] = {}
+    for (index, raw_scan) in enumerate(raw_scans):
+        try:
+            scans[index] = scan_model(**raw_scan)
+        except TypeError:
+            results[index] = _rejected(index, 'Scan must be an object')
+        except ValidationError as e:
+            results[index] = _rejected(index, _validation_error(e))
+
+    location_ids = location_resolver.resolve_many({scan.location for scan in scans.values()})
+    product_scans = resolve_product_barcodes({scan.sku for scan in scans.values()})
+
+    new_counts: Dict[int, IndividualCount] = {}
+    for (index, scan) in scans.items():
+        if scan.client_timestamp is not None and timezone.is_naive(scan.client_timestamp):
+            scan.client_timestamp = timezone.make_aware(scan.client_timestamp)
+        if location_ids[scan.location] is None:
+            results[index] = _rejected(index, 'Invalid location')
+        elif product_scans[scan.sku] is None:
+            results[index] = _rejected(index, 'Invalid product')
+        elif counted_qty(scan.qty, product_scans[scan.sku]) is None:
+            results[index] = _rejected(index, 'qty: too many units for one scan')
+        else:
+            # qty is how many times the barcode was counted, a case/GS1 barcode stands for many units.
+            product_scan = product_scans[scan.sku]
+            new_counts[index] = IndividualCount(
+                associate=associate, session_id=session_id, location_id=location_ids[scan.location],
+                product_id=product_scan.product_id, qty=counted_qty(scan.qty, product_scan),
+                client_scanned_at=scan.client_timestamp, client_key=scan.key,
+                state=IndividualCount.CountState.ACTIVE
+            )
+
+    with transaction.atomic():
+        if not lock_open_session(session_id):
+            return None
+        existing = insert_scans(list(new_counts.values()))
+        # No post_save for these, so the SessionTally rows are bumped here instead.
+        add_to_tallies(individual_count for individual_count in new_counts.values() if individual_count.id)
+
+    created_count = 0
+    for (index, individual_count) in new_counts.items():
+        if individual_count.id is not None:
+            results[index] = {'index': index, 'status': 'created', 'id': individual_count.id}
+            created_count += 1
+        else:
+            # Recorded before, the handheld just didn't hear about it
+            results[index] = {'index': index, 'status': 'duplicate', 'id': existing[individual_count.client_key]}
+
+    log.info('record_scan_batch', session_id=session_id, associate=associate.id,
+             submitted_count=len(raw_scans), created_count=created_count)
+    return results
+
+
+def location_tallies(session_id: int, location_id: int) -> List[Dict]:
+    with connection.cursor() as cursor:
+        cursor.execute(LOCATION_TALLIES_SQL, [session_id, location_id])
+        return [{'product_id': product_id, 'sku': sku, 'counted_qty': counted_qty, 'scan_count': scan_count}
+                for (product_id, sku, counted_qty, scan_count) in cursor.fetchall()]
+
+
+def session_progress(session_id: int, location_ids: Iterable[int]) -> Dict:
+    """
+    What the live view of a session shows after scans came in: the session's counters and the tallies of the
+    locations that were scanned (usually one or two per batch, a query each).
+    """
+    counters = (CountSession.objects.filter(pk=session_id)
+                .values('total_scans', 'active_scans', 'distinct_locations', 'distinct_skus').first())
+    # String keys, this goes out as JSON
+    return {'counters': counters,
+            'locations': {str(location_id): location_tallies(session_id, location_id)
+                          for location_id in sorted(set(location_ids))}}
+
+
+def record_scan(session_id: int, associate, raw_scan: Dict) -> Optional[Dict]:
+    """
+    A single scan from the scan page. With just a location it checks the location, with a sku as well it records
+    the count. Barcodes and the session come from caches, so a scan is the (guarded) insert and the tally upkeep,
+    plus the location's tallies for the page to show.
+    :return: {'status': 'created' | 'location' | 'rejected', ...}, or None if the session doesn't exist or is
+             finalized
+    """
+    try:
+        scan = SingleScanIn(**raw_scan)
+    except TypeError:
+        return {'status': 'rejected', 'error': 'Scan must be an object'}
+    except ValidationError as e:
+        return {'status': 'rejected', 'error': _validation_error(e)}
+
+    location_id = location_resolver.resolve(scan.location)
+    if location_id is None:
+        return {'status': 'rejected', 'error': 'Invalid location'}
+    product_scan = None
+    if scan.sku is not None:
+        product_scan = resolve_product_barcode(scan.sku)
+        if product_scan is None:
+            return {'status': 'rejected', 'error': 'Invalid product'}
+        if counted_qty(scan.qty, product_scan) is None:
+            return {'status': 'rejected', 'error': 'qty: too many units for one scan'}
+    if scan.client_timestamp is not None and timezone.is_naive(scan.client_timestamp):
+        scan.client_timestamp = timezone.make_aware(scan.client_timestamp)
+
+    if product_scan is None:
+        # Nothing written, the cached session is good enough
+        if open_session(session_id) is None:
+            return None
+        return {'status': 'location', 'location_id': location_id,
+                'tallies': location_tallies(session_id, location_id)}
+
+    individual_count = IndividualCount(
+        associate=associate, session_id=session_id, location_id=location_id,
+        product_id=product_scan.product_id, qty=counted_qty(scan.qty, product_scan),
+        client_scanned_at=scan.client_timestamp, state=IndividualCount.CountState.ACTIVE
+    )
+    with transaction.atomic():
+        if not insert_scan(individual_count):
+            return None
+        add_to_tallies([individual_count])
+        tallies = location_tallies(session_id, location_id)
+
+    log.info('record_scan', session_id=session_id, associate=associate.id, location=location_id,
+             product=individual_count.product_id, qty=individual_count.qty)
+    return {'status': 'created', 'id': individual_count.id, 'location_id': location_id,
+            'product_id': individual_count.product_id, 'qty': individual_count.qty, 'tallies': tallies}
@@ -0,0 +1,104 @@
+from collections import Counter
+from typing import Dict, Optional, Tuple
+
+import structlog
+from django.db import transaction
+from django.db.models.signals import post_init, post_save, post_delete
+from django.dispatch import receiver
+
+from cyclecount.barcodes import location_resolver, product_resolver, case_pack_resolver
+from cyclecount.models import CountSession, Location, Product, CasePack, IndividualCount
+from cyclecount.scan_context import session_contexts, location_contexts
+from cyclecount.tallies import TallyKey, TallyDelta, apply_tally_deltas
+from inventory.product_cache import product_cache
+
+
+log = structlog.get_logger(__name__)
+
+# Stands in for the snapshot when the instance was loaded without the fields a tally needs (e.g. .only('id')).
+UNKNOWN = 'unknown'
+
+
+@receiver([post_save, post_delete], sender=Location)
+def invalidate_location_barcode(sender, instance: Location, **kwargs) -> None:
+    location_resolver.invalidate_on_commit(instance)
+
+
+@receiver([post_save, post_delete], sender=Location)
+def invalidate_location_context(sender, instance: Location, **kwargs) -> None:
+    location_contexts.invalidate_on_commit(instance.pk)
+
+
+@receiver([post_save, post_delete], sender=CountSession)
+def invalidate_session_context(sender, instance: CountSession, **kwargs) -> None:
+    # finalize_session setting final_state is the one that matters
+    session_contexts.invalidate_on_commit(instance.pk)
+
+
+@receiver([post_save, post_delete], sender=Product)
+def invalidate_product_barcode(sender, instance: Product, **kwargs) -> None:
+    product_resolver.invalidate_on_commit(instance)
+    # The inventory grid's product cache (both tiers), after the commit so a reader can't cache the old row again.
+    # Taken now, delete() clears instance.pk.
+    product_id = instance.pk
+    transaction.on_commit(lambda: product_cache().invalidate(product_id))
+
+
+@receiver([post_save, post_delete], sender=CasePack)
+def invalidate_case_pack_barcode(sender, instance: CasePack, **kwargs) -> None:
+    case_pack_resolver.invalidate_on_commit(instance)
+
+
+def _tally_contribution(instance: IndividualCount):
+    """
+    What this IndividualCount, as stored in the DB, adds to its SessionTally.
+    :return: (key, qty), None if it doesn't count, or UNKNOWN if a field we need was deferred
+    """
+    if instance.pk is None:
+        return None
+    # Read through __dict__, touching a deferred field would cost a query per instance.
+    values = instance.__dict__
+    if any(field not in values for field in ('state', 'session_id', 'location_id', 'product_id', 'qty')):
+        return UNKNOWN
+    if values['state'] != IndividualCount.CountState.ACTIVE:
+        return None
+    return (values['session_id'], values['location_id'], values['product_id']), values['qty']
+
+
+@receiver(post_init, sender=IndividualCount)
+def snapshot_tally_contribution(sender, instance: IndividualCount, **kwargs) -> None:
+    instance._tally_contribution = _tally_contribution(instance)
+
+
+@receiver(post_save, sender=IndividualCount)
+def update_session_tally(sender, instance: IndividualCount, created: bool, raw: bool = False, **kwargs) -> None:
+    if raw:  # loaddata, rebuild the tallies after loading fixtures
+        return
+    old: Optional[Tuple[TallyKey, int]] = None if created else instance._tally_contribution
+    new = _tally_contribution(instance)
+    instance._tally_contribution = new
+    if old == new and not created:
+        return
+    if UNKNOWN in (old, new):
+        log.warning('update_session_tally skipped, fields deferred', individual_count=instance.pk)
+        return
+
+    # Covers a new scan, a scan marked DELETED (or back), a qty change and a scan moved to another key.
+    deltas: Dict[TallyKey, TallyDelta] = {}
+    if old is not None:
+        deltas[old[0]] = TallyDelta(-old[1], -1)
+    if new is not None:
+        (key, qty) = new
+        previous = deltas.get(key, TallyDelta(0, 0))
+        deltas[key] = TallyDelta(previous.qty + qty, previous.scan_count + 1, instance.created_at)
+    apply_tally_deltas(deltas, Counter({instance.session_id: 1}) if created else None)
+
+
+@receiver(post_delete, sender=IndividualCount)
+def remove_from_session_tally(sender, instance: IndividualCount, **kwargs) -> None:
+    old = getattr(instance, '_tally_contribution', None)
+    if old == UNKNOWN or 'session_id' not in instance.__dict__:
+        log.warning('remove_from_session_tally skipped, fields deferred', individual_count=instance.pk)
+        return
+    deltas = {old[0]: TallyDelta(-old[1], -1)} if old is not None else {}
+    apply_tally_deltas(deltas, Counter({instance.session_id: -1}))
@@ -0,0 +1,136 @@
+from typing import Any, Dict, List, NamedTuple, Optional
+
+import structlog
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+from pydantic import BaseModel, Field, ValidationError
+
+from cyclecount.models import CountSession, IndividualCount
+from cyclecount.scans import ScanIn, lock_open_session, record_scan_batch, _validation_error
+from cyclecount.tallies import TallyKey, TallyDelta, apply_tally_deltas
+
+
+log = structlog.get_logger(__name__)
+
+'''
+Store and forward for handhelds that lose the network (freezer aisles): they keep scanning at full speed into a
+local queue and sync it with the session whenever they get through, POST api/sync/<session_id>.
+
+- Every scan carries a key the handheld made up (a uuid), unique per session in IndividualCount.client_key. A
+  sync that timed out is simply sent again, scans already recorded come back as duplicates instead of being
+  counted twice. A scan without a key is rejected.
+- Scans the handheld deleted (an undo) are sent as their keys and marked DELETED.
+- The handheld then gets the changes of the session since its cursor - scans recorded or deleted by anyone,
+  including its own, which it recognises by key - and the new cursor. The cursor is IndividualCount.sync_seq,
+  set by a trigger in commit order per session (migration 0014), so nothing is skipped or sent twice.
+- Changes come SYNC_PAGE_SIZE at a time, "more" says to sync again right away.
+'''
+
+CHANGES_SQL = '''
+SELECT id, client_key, associate_id, location_id, product_id, qty, state, client_scanned_at, sync_seq
+FROM cyclecount_individualcount
+WHERE session_id = %s AND sync_seq > %s
+ORDER BY sync_seq
+LIMIT %s
+'''
+
+
+class SyncScanIn(ScanIn):
+    # Required here, a scan without one would be recorded again by every retried sync
+    key: str = Field(min_length=1, max_length=64)
+
+
+class SyncIn(BaseModel):
+    cursor: int = Field(default=0, ge=0)
+    # Checked one by one by record_scan_batch (as SyncScanIn), a bad scan doesn't fail the others
+    scans: List[Any] = Field(default_factory=list)
+    deletes: List[str] = Field(default_factory=list)
+
+
+class SyncError(ValueError):
+    pass
+
+
+class Changes(NamedTuple):
+    changes: List[Dict]
+    cursor: int
+    more: bool
+
+
+def changes_since(session_id: int, cursor: int, limit: int) -> Changes:
+    """
+    :return: up to `limit` scans of the session added or changed after `cursor`, oldest change first
+    """
+    with connection.cursor() as db_cursor:
+        db_cursor.execute(CHANGES_SQL, [session_id, cursor, limit + 1])
+        rows = db_cursor.fetchall()
+    page = rows[:limit]
+    changes = [{'id': scan_id, 'key': key, 'associate_id': associate_id, 'location_id': location_id,
+                'product_id': product_id, 'qty': qty, 'state': state, 'client_timestamp': client_scanned_at}
+               for (scan_id, key, associate_id, location_id, product_id, qty, state, client_scanned_at, _) in page]
+    return Changes(changes, page[-1][-1] if page else cursor, len(rows) > limit)
+
+
+def delete_scans(session_id: int, keys: List[str]) -> Optional[List[Dict]]:
+    """
+    Mark the session's scans with these keys DELETED. Deleting a scan twice is fine.
+    :return: a result per key, or None if the session doesn't exist or is finalized
+    """
+    with transaction.atomic():
+        if not lock_open_session(session_id):
+            return None
+        scans = list(IndividualCount.objects.filter(session_id=session_id, client_key__in=set(keys))
+                     .values_list('id', 'client_key', 'location_id', 'product_id', 'qty', 'state'))
+        active = [scan for scan in scans if scan[5] == IndividualCount.CountState.ACTIVE]
+        if active:
+            IndividualCount.objects.filter(id__in=[scan[0] for scan in active]).update(
+                state=IndividualCount.CountState.DELETED, updated_at=timezone.now())
+            # update() skips the signal that keeps the tallies, same as marking them DELETED one by one
+            deltas: Dict[TallyKey, TallyDelta] = {}
+            for (_, _, location_id, product_id, qty, _) in active:
+                previous = deltas.get((session_id, location_id, product_id), TallyDelta(0, 0))
+                deltas[(session_id, location_id, product_id)] = TallyDelta(previous.qty - qty,
+                                                                           previous.scan_count - 1)
+            apply_tally_deltas(deltas)
+
+    ids = {key: scan_id for (scan_id, key, *_) in scans}
+    return [{'key': key, 'status': 'deleted', 'id': ids[key]} if key in ids else {'key': key, 'status': 'not_found'}
+            for key in keys]
+
+
+def sync_session(session_id: int, associate, raw_sync) -> Optional[Dict]:
+    """
+    Record the handheld's new scans and deletes, then send it the session's changes since its cursor.
+    Uploads need an open session, a handheld can still pull the changes of a finalized one.
+    :return: {"results": [...], "deletes": [...], "changes": [...], "cursor": N, "more": bool}, or None if the
+             session doesn't exist (or is finalized and there was something to upload)
+    """
+    try:
+        sync = SyncIn(**raw_sync)
+    except TypeError:
+        raise SyncError('Expected a JSON object')
+    except ValidationError as e:
+        raise SyncError(_validation_error(e))
+    if max(len(sync.scans), len(sync.deletes)) > settings.SCAN_BATCH_MAX_SIZE:
+        raise SyncError(f'At most {settings.SCAN_BATCH_MAX_SIZE} scans and deletes per sync')
+
+    results: List[Dict] = []
+    if sync.scans:
+        results = record_scan_batch(session_id, associate, sync.scans, scan_model=SyncScanIn)
+        if results is None:
+            return None
+    deletes: List[Dict] = []
+    if sync.deletes:
+        deletes = delete_scans(session_id, sync.deletes)
+        if deletes is None:
+            return None
+    if not sync.scans and not sync.deletes and not CountSession.objects.filter(pk=session_id).exists():
+        return None
+
+    changes = changes_since(session_id, sync.cursor, settings.SYNC_PAGE_SIZE)
+    log.info('sync_session', session_id=session_id, associate=associate.id, uploaded_count=len(sync.scans),
+             deleted_count=len(sync.deletes), cursor=sync.cursor, new_cursor=changes.cursor,
+             change_count=len(changes.changes))
+    return {'results': results, 'deletes': deletes, 'changes': changes.changes, 'cursor': changes.cursor,
+            'more': changes.more}
@@ -0,0 +1,279 @@
+from collections import Counter
+from datetime import datetime
+from typing import Dict, Iterable, List, NamedTuple, Optional, Sequence, Set, Tuple
+
+import structlog
+from django.db import connection, transaction
+from django.db.models import F, Value
+from django.db.models.functions import Greatest
+
+from cyclecount.models import CountSession, IndividualCount, SessionTally
+
+
+log = structlog.get_logger(__name__)
+
+'''
+SessionTally holds, per (session, location, product), the sum of qty and number of the ACTIVE IndividualCounts.
+It is kept up to date as counts are written, so reviewing or finalizing a session reads one row per key
+instead of every scan:
+
+* IndividualCount.save()/delete() - cyclecount.signals works out what the change did to the tally
+  (new scan, qty changed, marked DELETED, moved to another key) and applies the difference.
+* bulk_create doesn't send signals, so whoever bulk creates counts calls add_to_tallies (see scans.py).
+* QuerySet.update()/delete() on IndividualCount bypass both, use rebuild_tallies afterwards.
+
+The progress counters on CountSession (total/active scans, distinct locations/SKUs, last scan) are updated in
+the same place and the same transaction.
+
+`manage.py session_tallies` reports any drift, `--rebuild` recomputes the tallies and counters from IndividualCount.
+'''
+
+# (session_id, location_id, product_id)
+TallyKey = Tuple[int, int, int]
+
+
+class TallyDelta(NamedTuple):
+    qty: int
+    scan_count: int
+    scanned_at: Optional[datetime] = None
+
+
+UPSERT_TALLIES_SQL = '''
+INSERT INTO cyclecount_sessiontally (session_id, location_id, product_id, counted_qty, scan_count, last_scanned_at)
+SELECT * FROM unnest(%s::bigint[], %s::bigint[], %s::bigint[], %s::integer[], %s::integer[], %s::timestamptz[])
+ON CONFLICT (session_id, location_id, product_id) DO UPDATE SET
+    counted_qty = cyclecount_sessiontally.counted_qty + EXCLUDED.counted_qty,
+    scan_count = cyclecount_sessiontally.scan_count + EXCLUDED.scan_count,
+    last_scanned_at = GREATEST(cyclecount_sessiontally.last_scanned_at, EXCLUDED.last_scanned_at)
+RETURNING session_id, location_id, product_id, scan_count
+'''
+
+# How many tallies of each of the given locations and products of a session still have ACTIVE scans
+ACTIVE_TALLIES_SQL = '''
+SELECT 'location_id', location_id, COUNT(*) FILTER (WHERE scan_count > 0)
+FROM cyclecount_sessiontally
+WHERE session_id = %s AND location_id = ANY(%s)
+GROUP BY location_id
+UNION ALL
+SELECT 'product_id', product_id, COUNT(*) FILTER (WHERE scan_count > 0)
+FROM cyclecount_sessiontally
+WHERE session_id = %s AND product_id = ANY(%s)
+GROUP BY product_id
+'''
+
+ACTIVE_TOTALS_SQL = '''
+SELECT session_id, location_id, product_id, SUM(qty) AS counted_qty, COUNT(*) AS scan_count,
+       MAX(created_at) AS last_scanned_at
+FROM cyclecount_individualcount
+WHERE state = %s AND session_id = ANY(%s)
+GROUP BY session_id, location_id, product_id
+'''
+
+REBUILD_TALLIES_SQL = f'''
+INSERT INTO cyclecount_sessiontally (session_id, location_id, product_id, counted_qty, scan_count, last_scanned_at)
+{ACTIVE_TOTALS_SQL}
+'''
+
+# A key with no ACTIVE counts left may or may not still have a (zeroed) tally row, both are consistent.
+MISMATCHED_TALLIES_SQL = f'''
+WITH expected AS ({ACTIVE_TOTALS_SQL}), tallied AS (
+    SELECT session_id, location_id, product_id, counted_qty, scan_count
+    FROM cyclecount_sessiontally
+    WHERE session_id = ANY(%s)
+)
+SELECT session_id, location_id, product_id,
+       COALESCE(expected.counted_qty, 0), COALESCE(expected.scan_count, 0),
+       COALESCE(tallied.counted_qty, 0), COALESCE(tallied.scan_count, 0)
+FROM expected FULL OUTER JOIN tallied USING (session_id, location_id, product_id)
+WHERE COALESCE(expected.counted_qty, 0) <> COALESCE(tallied.counted_qty, 0)
+   OR COALESCE(expected.scan_count, 0) <> COALESCE(tallied.scan_count, 0)
+ORDER BY session_id, location_id, product_id
+'''
+
+SESSION_COUNTERS_SQL = '''
+SELECT s.id, COUNT(ic.id), COUNT(ic.id) FILTER (WHERE ic.state = %s),
+       COUNT(DISTINCT ic.location_id) FILTER (WHERE ic.state = %s),
+       COUNT(DISTINCT ic.product_id) FILTER (WHERE ic.state = %s), MAX(ic.created_at)
+FROM cyclecount_countsession s LEFT JOIN cyclecount_individualcount ic ON ic.session_id = s.id
+WHERE s.id = ANY(%s)
+GROUP BY s.id
+'''
+
+REBUILD_SESSION_COUNTERS_SQL = f'''
+UPDATE cyclecount_countsession s
+SET total_scans = counts.total_scans, active_scans = counts.active_scans,
+    distinct_locations = counts.distinct_locations, distinct_skus = counts.distinct_skus,
+    last_scan_at = counts.last_scan_at
+FROM ({SESSION_COUNTERS_SQL}) counts (session_id, total_scans, active_scans, distinct_locations, distinct_skus,
+                                      last_scan_at)
+WHERE s.id = counts.session_id
+'''
+
+MISMATCHED_SESSION_COUNTERS_SQL = f'''
+SELECT s.id, counts.total_scans, counts.active_scans, counts.distinct_locations, counts.distinct_skus,
+       s.total_scans, s.active_scans, s.distinct_locations, s.distinct_skus
+FROM cyclecount_countsession s
+JOIN ({SESSION_COUNTERS_SQL}) counts (session_id, total_scans, active_scans, distinct_locations, distinct_skus,
+                                      last_scan_at) ON counts.session_id = s.id
+WHERE (s.total_scans, s.active_scans, s.distinct_locations, s.distinct_skus)
+   <> (counts.total_scans, counts.active_scans, counts.distinct_locations, counts.distinct_skus)
+ORDER BY s.id
+'''
+
+
+class CounterMismatch(NamedTuple):
+    session_id: int
+    # (total_scans, active_scans, distinct_locations, distinct_skus)
+    expected: Tuple[int, int, int, int]
+    stored: Tuple[int, int, int, int]
+
+
+class TallyMismatch(NamedTuple):
+    session_id: int
+    location_id: int
+    product_id: int
+    expected_qty: int
+    expected_scan_count: int
+    tallied_qty: int
+    tallied_scan_count: int
+
+
+def _bump_session_counters(session_id: int, last_scan_at: Optional[datetime] = None, **increments: int) -> None:
+    changes = {field: F(field) + increment for (field, increment) in increments.items() if increment}
+    if last_scan_at is not None:
+        changes['last_scan_at'] = Greatest(F('last_scan_at'), Value(last_scan_at))
+    if changes:
+        CountSession.objects.filter(id=session_id).update(**changes)
+    else:
+        # Nothing to count, but the row lock is still taken first (see apply_tally_deltas).
+        CountSession.objects.select_for_update(no_key=True).filter(id=session_id).exists()
+
+
+def _distinct_changes(session_id: int, started: Set[TallyKey], stopped: Set[TallyKey]) -> Dict[str, int]:
+    """
+    How many locations and products started or stopped having ACTIVE scans, given the tallies of the session that
+    just went from 0 to some scans (started) or back to 0 (stopped).
+    :return: {'distinct_locations': change, 'distinct_skus': change}
+    """
+    started_by_value = {column: Counter(key[position] for key in started if key[0] == session_id)
+                        for (column, position) in (('location_id', 1), ('product_id', 2))}
+    stopped_by_value = {column: Counter(key[position] for key in stopped if key[0] == session_id)
+                        for (column, position) in (('location_id', 1), ('product_id', 2))}
+    values = {column: sorted(started_by_value[column].keys() | stopped_by_value[column].keys())
+              for column in ('location_id', 'product_id')}
+    with connection.cursor() as cursor:
+        cursor.execute(ACTIVE_TALLIES_SQL, [session_id, values['location_id'], session_id, values['product_id']])
+        active_now = {(column, value): count for (column, value, count) in cursor.fetchall()}
+
+    changes = {}
+    for (column, counter) in (('location_id', 'distinct_locations'), ('product_id', 'distinct_skus')):
+        changes[counter] = 0
+        for value in values[column]:
+            now = active_now.get((column, value), 0)
+            before = now - started_by_value[column][value] + stopped_by_value[column][value]
+            changes[counter] += (now > 0) - (before > 0)
+    return changes
+
+
+def apply_tally_deltas(deltas: Dict[TallyKey, TallyDelta], created_scans: Optional[Counter] = None) -> None:
+    """
+    Add the deltas to the tallies (one statement for any number of keys, creating missing rows) and to the
+    counters of their sessions.
+    :param created_scans: session_id -> how many IndividualCount rows were inserted (or removed, negative)
+    """
+    deltas = {key: delta for (key, delta) in deltas.items() if delta.qty or delta.scan_count}
+    created_scans = created_scans or Counter()
+    session_ids = sorted({key[0] for key in deltas} | {session_id for (session_id, n) in created_scans.items() if n})
+
+    # Every path locks the CountSession row (by updating its counters) before any of its tally rows, so a
+    # single scan and a batch for the same session can't each end up waiting on a lock the other holds.
+    for session_id in session_ids:
+        session_deltas = [delta for (key, delta) in deltas.items() if key[0] == session_id]
+        _bump_session_counters(
+            session_id, total_scans=created_scans[session_id],
+            active_scans=sum(delta.scan_count for delta in session_deltas),
+            last_scan_at=max((delta.scanned_at for delta in session_deltas if delta.scanned_at), default=None),
+        )
+    if not deltas:
+        return
+
+    # Keys are applied in sorted order so two transactions touching the same keys lock them in the same order.
+    keys = sorted(deltas.keys())
+    with connection.cursor() as cursor:
+        cursor.execute(UPSERT_TALLIES_SQL, [
+            [key[0] for key in keys], [key[1] for key in keys], [key[2] for key in keys],
+            [deltas[key].qty for key in keys], [deltas[key].scan_count for key in keys],
+            [deltas[key].scanned_at for key in keys],
+        ])
+        scan_counts = {(row[0], row[1], row[2]): row[3] for row in cursor.fetchall()}
+
+    # Only a tally going from no scans to some, or back, can change the distinct location/SKU counts.
+    started = {key for (key, count) in scan_counts.items() if count > 0 >= count - deltas[key].scan_count}
+    stopped = {key for (key, count) in scan_counts.items() if count <= 0 < count - deltas[key].scan_count}
+    for session_id in sorted({key[0] for key in started | stopped}):
+        _bump_session_counters(session_id, **_distinct_changes(session_id, started, stopped))
+
+
+def add_to_tallies(individual_counts: Iterable[IndividualCount]) -> None:
+    """
+    Count freshly inserted IndividualCounts, for callers that bypass the post_save signal (bulk_create).
+    Should run in the same transaction as the insert.
+    """
+    deltas: Dict[TallyKey, TallyDelta] = {}
+    created_scans: Counter = Counter()
+    for individual_count in individual_counts:
+        created_scans[individual_count.session_id] += 1
+        if individual_count.state != IndividualCount.CountState.ACTIVE:
+            continue
+        key = (individual_count.session_id, individual_count.location_id, individual_count.product_id)
+        previous = deltas.get(key, TallyDelta(0, 0))
+        scanned_at = max(filter(None, (previous.scanned_at, individual_count.created_at)), default=None)
+        deltas[key] = TallyDelta(previous.qty + individual_count.qty, previous.scan_count + 1, scanned_at)
+    apply_tally_deltas(deltas, created_scans)
+
+
+def _all_session_ids() -> List[int]:
+    return list(CountSession.objects.order_by('id').values_list('id', flat=True))
+
+
+def find_tally_mismatches(session_ids: Optional[Sequence[int]] = None) -> List[TallyMismatch]:
+    """
+    Compare the tallies against a full GROUP BY of the ACTIVE IndividualCounts.
+    :return: every (session, location, product) where the two disagree, empty when consistent
+    """
+    session_ids = list(session_ids) if session_ids is not None else _all_session_ids()
+    with connection.cursor() as cursor:
+        cursor.execute(MISMATCHED_TALLIES_SQL, [IndividualCount.CountState.ACTIVE, session_ids, session_ids])
+        return [TallyMismatch(*row) for row in cursor.fetchall()]
+
+
+def find_counter_mismatches(session_ids: Optional[Sequence[int]] = None) -> List[CounterMismatch]:
+    # last_scan_at isn't checked, it only ever moves forward and an edit can legitimately leave it behind.
+    session_ids = list(session_ids) if session_ids is not None else _all_session_ids()
+    active = IndividualCount.CountState.ACTIVE
+    with connection.cursor() as cursor:
+        cursor.execute(MISMATCHED_SESSION_COUNTERS_SQL, [active, active, active, session_ids])
+        return [CounterMismatch(row[0], tuple(row[1:5]), tuple(row[5:9])) for row in cursor.fetchall()]
+
+
+def rebuild_tallies(session_ids: Optional[Sequence[int]] = None) -> int:
+    """
+    Throw away the tallies of the sessions and recompute them, and the session counters, from IndividualCount,
+    a session at a time.
+    :return: number of tally rows written
+    """
+    session_ids = list(session_ids) if session_ids is not None else _all_session_ids()
+    rows = 0
+    for session_id in session_ids:
+        with transaction.atomic():
+            # FOR UPDATE waits out (and then holds off) scans, which take the session FOR NO KEY UPDATE.
+            if not CountSession.objects.select_for_update().filter(id=session_id).exists():
+                continue
+            SessionTally.objects.filter(session_id=session_id).delete()
+            with connection.cursor() as cursor:
+                cursor.execute(REBUILD_TALLIES_SQL, [IndividualCount.CountState.ACTIVE, [session_id]])
+                rows += cursor.rowcount
+                active = IndividualCount.CountState.ACTIVE
+                cursor.execute(REBUILD_SESSION_COUNTERS_SQL, [active, active, active, [session_id]])
+    log.info('rebuild_tallies', session_count=len(session_ids), tally_count=rows)
+    return rows
@@ -0,0 +1,73 @@
+from django.db import IntegrityError
+from django.test import TestCase
+
+from cyclecount.barcodes import BarcodeResolver, location_resolver, product_resolver
+from cyclecount.models import Location, Product
+
+
+class BarcodeResolverTests(TestCase):
+    location = None
+    product = None
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.location = Location(description='test-location-desc')
+        cls.location.save()
+        cls.product = Product(description='test-product-01', sku='test-sku-01')
+        cls.product.save()
+
+    def setUp(self):
+        location_resolver.clear()
+        product_resolver.clear()
+
+    def test_resolve_is_served_from_memory_after_first_lookup(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(self.location.id, location_resolver.resolve('test-location-desc'))
+            self.assertEqual(self.location.id, location_resolver.resolve('test-location-desc'))
+        with self.assertNumQueries(1):
+            self.assertIsNone(product_resolver.resolve('unknown-sku'))
+            self.assertIsNone(product_resolver.resolve('unknown-sku'))
+
+    def test_warm(self):
+        self.assertEqual(1, product_resolver.warm())
+        with self.assertNumQueries(0):
+            self.assertEqual(self.product.id, product_resolver.resolve('test-sku-01'))
+
+    def test_save_and_delete_invalidate(self):
+        self.assertIsNone(product_resolver.resolve('test-sku-02'))
+        product_02 = Product(description='test-product-02', sku='test-sku-02')
+        product_02.save()
+        self.assertEqual(product_02.id, product_resolver.resolve('test-sku-02'))
+
+        product_02.sku = 'test-sku-02-renamed'
+        product_02.save()
+        self.assertIsNone(product_resolver.resolve('test-sku-02'))
+        self.assertEqual(product_02.id, product_resolver.resolve('test-sku-02-renamed'))
+
+        product_02.delete()
+        self.assertIsNone(product_resolver.resolve('test-sku-02-renamed'))
+
+    def test_ttl(self):
+        resolver = BarcodeResolver(Location, 'description', ttl_seconds=0)
+        with self.assertNumQueries(2):
+            resolver.resolve('test-location-desc')
+            resolver.resolve('test-location-desc')
+
+    def test_misses_expire_sooner(self):
+        resolver = BarcodeResolver(Location, 'description', negative_ttl_seconds=0)
+        with self.assertNumQueries(3):
+            resolver.resolve('test-location-desc')
+            resolver.resolve('test-location-desc')
+            resolver.resolve('unknown-location')
+            resolver.resolve('unknown-location')
+
+    def test_invalidated_again_on_commit(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            product_02 = Product.objects.create(description='test-product-02', sku='test-sku-02')
+            # What another request that looked it up before we committed would have cached
+            product_resolver._values['test-sku-02'] = (float('inf'), None)
+        self.assertEqual(product_02.id, product_resolver.resolve('test-sku-02'))
+
+    def test_barcodes_are_unique(self):
+        with self.assertRaises(IntegrityError):
+            Product(description='duplicate', sku='test-sku-01').save()
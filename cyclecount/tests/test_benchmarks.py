@@ -0,0 +1,29 @@
+from django.test import TestCase
+
+from cyclecount.benchmarks import run_benchmarks, compare_to_baseline
+from cyclecount.scale_data import ScaleConfig, generate
+
+
+class BenchmarkTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        generate(ScaleConfig(products=100, locations=50, associates=2, sessions=1, scans_per_session=50))
+
+    def test_run_benchmarks(self):
+        results = run_benchmarks(iterations=3, warmup=1, seed=1,
+                                 only=['scan_product', 'session_review', 'proposed_modifications_page'])
+
+        self.assertEqual(['scan_product', 'session_review', 'proposed_modifications_page'],
+                         list(results['scenarios']))
+        for (name, result) in results['scenarios'].items():
+            with self.subTest(name=name):
+                self.assertEqual(0, result['errors'])
+                self.assertEqual(3, result['iterations'])
+                self.assertLessEqual(result['p50_ms'], result['p99_ms'])
+        self.assertEqual(3, results['scenarios']['session_review']['max_queries'])
+
+        self.assertEqual([], compare_to_baseline(results, results, tolerance=0))
+        slower = {'scenarios': {'session_review': dict(results['scenarios']['session_review'], p95_ms=0.001,
+                                                       queries_per_request=2)}}
+        self.assertEqual(2, len(compare_to_baseline(results, slower, tolerance=0.2)))
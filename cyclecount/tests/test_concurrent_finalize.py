@@ -0,0 +1,150 @@
+import random
+import threading
+import time
+from typing import Dict, List, Tuple
+from unittest.mock import patch
+
+from django.db import OperationalError, connection
+from django.test import SimpleTestCase, TransactionTestCase, override_settings
+
+from cyclecount.finalize import retry_on_conflict, upsert_inventory
+from cyclecount.finalize_jobs import enqueue_finalize, run_pending_jobs
+from cyclecount.models import CustomUser, CountSession, Location, Product, IndividualCount, Inventory, \
+    CycleCountModification, FinalizeJob
+from cyclecount.tallies import add_to_tallies
+
+
+class PostgresError(Exception):
+    # Stands in for the psycopg2 error Django's OperationalError wraps
+    def __init__(self, pgcode: str):
+        super().__init__(pgcode)
+        self.pgcode = pgcode
+
+
+def postgres_error(pgcode: str) -> OperationalError:
+    error = OperationalError(pgcode)
+    error.__cause__ = PostgresError(pgcode)
+    return error
+
+
+@patch('cyclecount.finalize.time.sleep')
+class RetryOnConflictTests(SimpleTestCase):
+
+    def test_retries_deadlocks_and_serialization_failures(self, sleep):
+        outcomes = [postgres_error('40P01'), postgres_error('40001'), 'done']
+
+        @retry_on_conflict
+        def chunk():
+            outcome = outcomes.pop(0)
+            if isinstance(outcome, Exception):
+                raise outcome
+            return outcome
+
+        self.assertEqual('done', chunk())
+        self.assertEqual(2, sleep.call_count)
+
+    @override_settings(FINALIZE_RETRY_ATTEMPTS=3)
+    def test_gives_up(self, sleep):
+        calls = []
+
+        @retry_on_conflict
+        def chunk():
+            calls.append(1)
+            raise postgres_error('40P01')
+
+        with self.assertRaises(OperationalError):
+            chunk()
+        self.assertEqual(3, len(calls))
+
+    def test_other_errors_are_not_retried(self, sleep):
+        calls = []
+
+        @retry_on_conflict
+        def chunk():
+            calls.append(1)
+            raise postgres_error('57014')  # query_canceled
+
+        with self.assertRaises(OperationalError):
+            chunk()
+        self.assertEqual(1, len(calls))
+
+
+# Small chunks so the sessions' transactions interleave, and no retries: a deadlock fails the job
+@override_settings(FINALIZE_CHUNK_SIZE=4, FINALIZE_RETRY_ATTEMPTS=1)
+class ConcurrentFinalizeTests(TransactionTestCase):
+    SESSIONS = 8
+    LOCATIONS = 40
+    KEYS_PER_SESSION = 25
+    STOCKED_QTY = 100
+
+    def setUp(self):
+        rng = random.Random(21)
+        user = CustomUser.objects.create_user('concurrent-finalize', 'concurrent@test.com', 'test-pw')
+        product = Product.objects.create(description='concurrent-product', sku='concurrent-sku')
+        locations = Location.objects.bulk_create([Location(description=f'concurrent-{i}')
+                                                  for i in range(self.LOCATIONS)])
+        # Half of what gets counted is already stocked, the rest is created by whichever session gets there first
+        Inventory.objects.bulk_create([Inventory(location=location, product=product, qty=self.STOCKED_QTY)
+                                       for location in locations[::2]])
+        for session_number in range(self.SESSIONS):
+            count_session = CountSession.objects.create(created_by=user, completed_by=user,
+                                                        final_state=CountSession.FinalState.ACCEPTED)
+            # Every session counts a different qty, so the ledger shows whose count each old_qty came from
+            add_to_tallies(IndividualCount.objects.bulk_create([
+                IndividualCount(associate=user, session=count_session, location=location, product=product,
+                                qty=session_number + 1)
+                for location in rng.sample(locations, self.KEYS_PER_SESSION)
+            ]))
+            enqueue_finalize(count_session, user)
+        self.product = product
+
+    def run_workers(self) -> List[BaseException]:
+        start = threading.Barrier(self.SESSIONS)
+        errors: List[BaseException] = []
+
+        def worker(number: int):
+            try:
+                start.wait(10)
+                run_pending_jobs(f'stress-worker-{number}')
+            except BaseException as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=worker, args=(number,)) for number in range(self.SESSIONS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(60)
+        return errors
+
+    def test_no_lost_updates_or_deadlocks(self):
+        def slow_upsert(counted):
+            # Hold the row locks a little longer, so the other sessions pile up behind them
+            changes = upsert_inventory(counted)
+            time.sleep(0.005)
+            return changes
+
+        with patch('cyclecount.finalize.upsert_inventory', side_effect=slow_upsert):
+            self.assertEqual([], self.run_workers())
+
+        jobs = list(FinalizeJob.objects.values_list('state', 'attempts', 'error'))
+        self.assertEqual([(FinalizeJob.State.DONE, 1, None)] * self.SESSIONS, jobs)
+
+        # Per key, the ledger in the order the sessions got the row lock
+        ledger: Dict[Tuple[int, int], List[Tuple[int, int]]] = {}
+        for (location_id, product_id, old_qty, new_qty) in (CycleCountModification.objects.order_by('id')
+                                                            .values_list('location_id', 'product_id', 'old_qty',
+                                                                         'new_qty')):
+            ledger.setdefault((location_id, product_id), []).append((old_qty, new_qty))
+        inventory = {(location_id, product_id): qty for (location_id, product_id, qty)
+                     in Inventory.objects.values_list('location_id', 'product_id', 'qty')}
+
+        self.assertEqual(self.SESSIONS * self.KEYS_PER_SESSION, sum(len(changes) for changes in ledger.values()))
+        for (key, changes) in ledger.items():
+            with self.subTest(key=key):
+                # Each session saw the qty the one before it left, and the last one's count is what stuck
+                self.assertIn(changes[0][0], (0, self.STOCKED_QTY))
+                self.assertEqual([new_qty for (_, new_qty) in changes[:-1]],
+                                 [old_qty for (old_qty, _) in changes[1:]])
+                self.assertEqual(changes[-1][1], inventory[key])
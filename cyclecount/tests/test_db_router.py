@@ -0,0 +1,66 @@
+from django.db import connections
+from django.test import TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from cyclecount.models import CustomUser, CountSession, Location, Product, Inventory
+
+
+@override_settings(REPLICA_DATABASE_ALIAS='replica')
+class ReplicaRouterTests(TransactionTestCase):
+    # The replica alias is a test mirror of default, i.e. a second connection to the same (committed) data
+    databases = {'default', 'replica'}
+
+    def setUp(self):
+        self.user = CustomUser.objects.create_user('router', 'router@test.com', 'test-pw')
+        self.count_session = CountSession.objects.create(created_by=self.user)
+        Inventory.objects.create(location=Location.objects.create(description='router-location'),
+                                 product=Product.objects.create(description='router-product', sku='router-sku'),
+                                 qty=3)
+        self.client.force_login(self.user)
+
+    def get(self, url: str, **params):
+        with CaptureQueriesContext(connections['default']) as primary, \
+                CaptureQueriesContext(connections['replica']) as replica:
+            response = self.client.get(url, params)
+            content = b''.join(response.streaming_content) if response.streaming else response.content
+        self.assertEqual(200, response.status_code)
+        return content, [query['sql'] for query in primary], [query['sql'] for query in replica]
+
+    def assertTables(self, tables, queries):
+        self.assertEqual(set(tables), {table for query in queries for table in
+                                       ('django_session', 'cyclecount_customuser', 'cyclecount_countsession',
+                                        'cyclecount_inventory') if f'FROM "{table}"' in query})
+
+    def test_read_only_views_read_from_replica(self):
+        # The login (session and user) is loaded from the primary, what the view reads from the replica
+        (content, primary, replica) = self.get(reverse('inventory:inventory_table_db'), page=1, size=10)
+        self.assertIn(b'router-sku', content)
+        self.assertTables(['django_session', 'cyclecount_customuser'], primary)
+        self.assertTables(['cyclecount_inventory'], replica)
+
+        (content, primary, replica) = self.get(reverse('cyclecount:list_active_sessions'))
+        self.assertIn(reverse('cyclecount:session_review', args=(self.count_session.id,)).encode(), content)
+        self.assertTables(['django_session', 'cyclecount_customuser'], primary)
+        self.assertTables(['cyclecount_countsession'], replica)
+
+        # Streamed after the view returned
+        (content, primary, replica) = self.get(reverse('inventory:inventory_export'))
+        self.assertIn(b'router-sku', content)
+        self.assertTables(['cyclecount_inventory'], replica)
+        self.assertTables(['django_session', 'cyclecount_customuser'], primary)
+
+    def test_pinned_to_primary_after_a_write(self):
+        response = self.client.post(reverse('cyclecount:finalize_session', args=(self.count_session.id,)),
+                                    {'choice': CountSession.FinalState.CANCELED})
+        self.assertIn('primary_pin', response.cookies)
+
+        (content, primary, replica) = self.get(reverse('cyclecount:list_active_sessions'))
+        self.assertNotIn(reverse('cyclecount:session_review', args=(self.count_session.id,)).encode(), content)
+        self.assertEqual([], replica)
+
+    @override_settings(REPLICA_DATABASE_ALIAS=None)
+    def test_disabled(self):
+        (_, primary, replica) = self.get(reverse('inventory:inventory_table_db'), page=1, size=10)
+        self.assertTables(['django_session', 'cyclecount_customuser', 'cyclecount_inventory'], primary)
+        self.assertEqual([], replica)
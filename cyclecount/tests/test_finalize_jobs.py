@@ -0,0 +1,154 @@
+import datetime
+import threading
+from unittest.mock import patch
+
+from django.db import connection, transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+
+from cyclecount.finalize_jobs import enqueue_finalize, claim_job, run_job, run_pending_jobs, _apply_next_chunk
+from cyclecount.models import CustomUser, CountSession, Location, Product, IndividualCount, Inventory, \
+    CycleCountModification, FinalizeJob
+from cyclecount.tallies import add_to_tallies
+
+
+def accepted_session(user: CustomUser, product: Product, keys: int, prefix: str) -> CountSession:
+    # Accepted (like finalize_session leaves it) with `keys` counted locations, the first one already stocked
+    count_session = CountSession.objects.create(created_by=user, completed_by=user,
+                                                final_state=CountSession.FinalState.ACCEPTED)
+    locations = Location.objects.bulk_create([Location(description=f'{prefix}-{i}') for i in range(keys)])
+    add_to_tallies(IndividualCount.objects.bulk_create([
+        IndividualCount(associate=user, session=count_session, location=location, product=product, qty=2)
+        for location in locations
+    ]))
+    Inventory.objects.create(location=locations[0], product=product, qty=7)
+    return count_session
+
+
+@override_settings(FINALIZE_CHUNK_SIZE=2, FINALIZE_JOB_MAX_ATTEMPTS=2)
+class FinalizeJobTests(TestCase):
+    user: CustomUser = None
+    product: Product = None
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create_user('finalize-jobs', 'jobs@test.com', 'test-pw')
+        cls.product = Product.objects.create(description='job-product', sku='job-sku')
+
+    def assertFinalized(self, count_session: CountSession, keys: int):
+        modifications = CycleCountModification.objects.filter(session=count_session)
+        # Every key exactly once, however many workers had a go at it
+        self.assertEqual(keys, modifications.count())
+        self.assertEqual(keys, modifications.values('location_id').distinct().count())
+        self.assertEqual([(7, 2)], list(modifications.filter(old_qty=7).values_list('old_qty', 'new_qty')))
+        self.assertEqual(keys, Inventory.objects.filter(product=self.product, qty=2).count())
+
+    def make_stale(self, job: FinalizeJob):
+        FinalizeJob.objects.filter(pk=job.id).update(heartbeat_at=job.heartbeat_at - datetime.timedelta(hours=1))
+
+    def test_enqueue_is_idempotent(self):
+        count_session = accepted_session(self.user, self.product, 1, 'idempotent')
+        job = enqueue_finalize(count_session, self.user)
+        self.assertEqual(job, enqueue_finalize(count_session, self.user))
+        self.assertEqual(1, run_pending_jobs('worker-a'))
+        self.assertEqual(0, run_pending_jobs('worker-a'))
+
+    def test_runs_in_chunks(self):
+        count_session = accepted_session(self.user, self.product, 5, 'chunks')
+        enqueue_finalize(count_session, self.user)
+        self.assertEqual(1, run_pending_jobs('worker-a'))
+
+        job = FinalizeJob.objects.get(session=count_session)
+        self.assertEqual((FinalizeJob.State.DONE, 5, 5, 1), (job.state, job.keys_total, job.keys_done, job.attempts))
+        self.assertIsNotNone(job.finished_at)
+        self.assertFinalized(count_session, 5)
+
+    def test_stale_job_resumes_after_last_chunk(self):
+        count_session = accepted_session(self.user, self.product, 5, 'resume')
+        enqueue_finalize(count_session, self.user)
+        job = claim_job('worker-a')
+        # worker-a gets a chunk in, then dies
+        _apply_next_chunk(job.id, 'worker-a')
+        self.assertIsNone(claim_job('worker-b'))  # Still heartbeating as far as anyone knows
+
+        self.make_stale(FinalizeJob.objects.get(pk=job.id))
+        taken_over = claim_job('worker-b')
+        self.assertEqual((job.id, 2, 2), (taken_over.id, taken_over.attempts, taken_over.keys_done))
+        self.assertEqual(FinalizeJob.State.DONE, run_job(taken_over, 'worker-b'))
+        self.assertFinalized(count_session, 5)
+
+        # worker-a wasn't dead after all, it finds the job gone and leaves it alone
+        self.assertEqual(FinalizeJob.State.RUNNING, run_job(job, 'worker-a'))
+        self.assertFinalized(count_session, 5)
+
+    def test_failed_chunk_is_retried_then_failed(self):
+        count_session = accepted_session(self.user, self.product, 3, 'failing')
+        enqueue_finalize(count_session, self.user)
+        with patch('cyclecount.finalize_jobs.finalize_chunk', side_effect=ValueError('bad chunk')):
+            self.assertEqual(2, run_pending_jobs('worker-a'))
+
+        job = FinalizeJob.objects.get(session=count_session)
+        self.assertEqual((FinalizeJob.State.FAILED, 2, 0), (job.state, job.attempts, job.keys_done))
+        self.assertEqual('ValueError: bad chunk', job.error)
+        self.assertEqual(0, CycleCountModification.objects.filter(session=count_session).count())
+
+    def test_stale_job_out_of_attempts_fails(self):
+        count_session = accepted_session(self.user, self.product, 3, 'dying')
+        enqueue_finalize(count_session, self.user)
+        for worker in ('worker-a', 'worker-b'):
+            self.make_stale(claim_job(worker))
+        self.assertIsNone(claim_job('worker-c'))
+        self.assertEqual(FinalizeJob.State.FAILED, FinalizeJob.objects.get(session=count_session).state)
+
+    def test_finalize_status(self):
+        count_session = CountSession.objects.create(created_by=self.user)
+        IndividualCount.objects.create(associate=self.user, session=count_session,
+                                       location=Location.objects.create(description='status-location'),
+                                       product=self.product)
+        self.client.force_login(self.user)
+        response = self.client.post(reverse('cyclecount:finalize_session', args=(count_session.id,)),
+                                    {'choice': CountSession.FinalState.ACCEPTED})
+        self.assertRedirects(response, reverse('cyclecount:finalize_status', args=(count_session.id,)))
+
+        url = reverse('cyclecount:finalize_status_json', args=(count_session.id,))
+        self.assertEqual(FinalizeJob.State.QUEUED, self.client.get(url).json()['state'])
+        self.assertContains(self.client.get(response.url), FinalizeJob.State.QUEUED)
+
+        run_pending_jobs('worker-a')
+        status = self.client.get(url).json()
+        self.assertEqual((FinalizeJob.State.DONE, 1, 1), (status['state'], status['keys_total'], status['keys_done']))
+        self.assertContains(self.client.get(reverse('cyclecount:session_review', args=(count_session.id,))),
+                            response.url)
+
+
+class FinalizeJobConcurrencyTests(TransactionTestCase):
+
+    def test_workers_skip_locked_jobs(self):
+        user = CustomUser.objects.create_user('finalize-parallel', 'parallel@test.com', 'test-pw')
+        product = Product.objects.create(description='parallel-product', sku='parallel-sku')
+        jobs = [enqueue_finalize(accepted_session(user, product, 3, f'parallel-{i}'), user) for i in range(2)]
+
+        # Another worker in the middle of claiming the first job
+        locked = threading.Event()
+        release = threading.Event()
+
+        def hold_first_job():
+            try:
+                with transaction.atomic():
+                    FinalizeJob.objects.select_for_update().get(pk=jobs[0].id)
+                    locked.set()
+                    release.wait(10)
+            finally:
+                connection.close()
+
+        holder = threading.Thread(target=hold_first_job)
+        holder.start()
+        try:
+            self.assertTrue(locked.wait(10))
+            # Doesn't wait for the lock, takes the next job
+            self.assertEqual(jobs[1].id, claim_job('worker-b').id)
+        finally:
+            release.set()
+            holder.join()
+
+        self.assertEqual(jobs[0].id, claim_job('worker-a').id)
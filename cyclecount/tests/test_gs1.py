@@ -0,0 +1,30 @@
+from django.test import SimpleTestCase
+
+from cyclecount.gs1 import parse_gs1, parse_element_strings, gtin_candidates, Gs1Scan
+
+
+class Gs1Tests(SimpleTestCase):
+
+    def test_human_readable(self):
+        self.assertEqual(Gs1Scan('10012345678902', 48), parse_gs1('(02)10012345678902(37)48'))
+        self.assertEqual(Gs1Scan('00012345678905', 1), parse_gs1('(01)00012345678905(17)250101(10)LOT7'))
+        self.assertEqual(Gs1Scan('00012345678905', 12), parse_gs1('(01)00012345678905(30)12'))
+
+    def test_raw_scanner_output(self):
+        # Variable length fields end with a GS, unless they are last
+        self.assertEqual(Gs1Scan('10012345678902', 480), parse_gs1(']C10210012345678902' '37480\x1d' '10LOT7'))
+        self.assertEqual({'02': '10012345678902', '37': '480'}, parse_element_strings('0210012345678902\x1d37480'))
+
+    def test_not_gs1(self):
+        self.assertIsNone(parse_gs1('0012345678905'))  # plain EAN-13
+        self.assertIsNone(parse_gs1('test-sku-01'))
+        self.assertIsNone(parse_gs1('(99)whatever'))
+        self.assertIsNone(parse_gs1('(02)10012345678902(37)0'))
+        self.assertIsNone(parse_gs1('(01)00012345678905(30)²'))
+        self.assertIsNone(parse_gs1('(01)0001234567890²(30)5'))
+        self.assertIsNone(parse_gs1(']C101123'))  # truncated GTIN
+        self.assertIsNone(parse_gs1('(10)LOT7'))  # no GTIN
+
+    def test_gtin_candidates(self):
+        self.assertEqual(['00012345678905', '0012345678905', '012345678905'], gtin_candidates('00012345678905'))
+        self.assertEqual(['10012345678902'], gtin_candidates('10012345678902'))
@@ -2,7 +2,7 @@ from django.test import TestCase
 from django.urls import reverse
 from django.test import Client
 
-from cyclecount.models import CustomUser, CountSession, Location, Product, IndividualCount
+from cyclecount.models import CustomUser, CountSession, Location, Product, IndividualCount, CasePack
 
 
 class CycleCountNoAuthTests(TestCase):
@@ -88,6 +88,17 @@ class CycleCountTests(TestCase):
 
         counts = CountSession.objects.filter(created_by=self.user).count()
         self.assertEqual(counts, 2, 'New CountSession was created')
+        new_session = CountSession.objects.filter(created_by=self.user).latest('id')
+        self.assertEqual(response.url, reverse('cyclecount:scan_page', args=(new_session.id,)))
+
+    def test_scan_page(self):
+        response = self.logged_in_client.get(reverse('cyclecount:scan_page', args=(self.session.id,)))
+        self.assertContains(response, reverse('cyclecount:scan', args=(self.session.id,)))
+
+        count_session = CountSession.objects.create(created_by=self.user,
+                                                    final_state=CountSession.FinalState.CANCELED)
+        response = self.logged_in_client.get(reverse('cyclecount:scan_page', args=(count_session.id,)))
+        self.assertEqual(response.status_code, 404)
 
     def test_scan_prompt_location(self):
         url = reverse('cyclecount:scan_prompt_location', args=(self.session.id,))
@@ -126,3 +137,50 @@ class CycleCountTests(TestCase):
 
         new_counts = IndividualCount.objects.filter(session=self.session, associate=self.user).count()
         self.assertEqual(new_counts, 1, 'New IndividualCount was created')
+
+    def test_scan_location_invalid_barcode(self):
+        url = reverse('cyclecount:scan_location', args=(self.session.id,))
+        response = self.logged_in_client.post(url, {'location-barcode': 'not-a-location'})
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'Invalid location')
+
+    def test_scan_product_invalid_barcode(self):
+        url = reverse('cyclecount:scan_product', args=(self.session.id, self.location.id))
+        response = self.logged_in_client.post(url, {'sku': 'not-a-sku'})
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'Invalid product')
+        self.assertEqual(0, IndividualCount.objects.filter(session=self.session).count())
+
+    def test_scan_product_with_qty(self):
+        url = reverse('cyclecount:scan_product', args=(self.session.id, self.location.id))
+        response = self.logged_in_client.post(url, {'sku': self.product.sku, 'qty': '12'})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(12, IndividualCount.objects.get(session=self.session).qty)
+
+        for qty in ('0', '²', 'abc', '3000000000'):
+            with self.subTest(qty=qty):
+                response = self.logged_in_client.post(url, {'sku': self.product.sku, 'qty': qty})
+                self.assertContains(response, 'Invalid quantity')
+        self.assertEqual(1, IndividualCount.objects.filter(session=self.session).count())
+
+    def test_scan_product_case_pack_and_gs1(self):
+        product = Product(description='test-product-ean', sku='0012345678905')
+        product.save()
+        CasePack(product=product, barcode='test-case-of-24', qty=24).save()
+        CasePack(product=product, barcode='10012345678902', qty=12).save()
+
+        url = reverse('cyclecount:scan_product', args=(self.session.id, self.location.id))
+        self.logged_in_client.post(url, {'sku': 'test-case-of-24', 'qty': '2'})
+        # GTIN-14 of the EAN-13 sku, 30 units on the label
+        self.logged_in_client.post(url, {'sku': '(01)00012345678905(30)30'})
+        # Pallet label of 40 cases of 12
+        self.logged_in_client.post(url, {'sku': '(02)10012345678902(37)40'})
+
+        quantities = IndividualCount.objects.filter(session=self.session, product=product).order_by('id')
+        self.assertEqual([48, 30, 480], [individual_count.qty for individual_count in quantities])
+
+        # Within the qty limit, but too many units once multiplied by the case
+        CasePack(product=product, barcode='test-case-of-100000', qty=100000).save()
+        response = self.logged_in_client.post(url, {'sku': 'test-case-of-100000', 'qty': '100000'})
+        self.assertContains(response, 'Invalid quantity')
+        self.assertEqual(3, quantities.count())
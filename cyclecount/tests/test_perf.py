@@ -0,0 +1,40 @@
+from django.db import connection
+from django.test import TestCase
+from django.urls import reverse
+
+from CycleCounter.perf import QueryStats, normalize_sql, add_sql_stats_to_request_finished
+from cyclecount.models import CustomUser, CountSession, Product
+
+
+class SqlStatsTests(TestCase):
+
+    def test_normalize_sql(self):
+        self.assertEqual('SELECT "id" FROM "t" WHERE "id" IN (...) AND "name" = ? LIMIT ?',
+                         normalize_sql('SELECT "id"\n  FROM "t" WHERE "id" IN (%s, %s,%s) AND "name" = \'it\'\'s\' '
+                                       'LIMIT 21'))
+
+    def test_duplicates(self):
+        stats = QueryStats()
+        with connection.execute_wrapper(stats):
+            for product_id in range(4):
+                list(Product.objects.filter(id=product_id))
+            CountSession.objects.count()
+
+        summary = stats.summary()
+        self.assertEqual(5, summary['count'])
+        self.assertEqual(1, len(summary['duplicates']))
+        self.assertEqual(4, summary['duplicates'][0]['count'])
+        self.assertIn('FROM "cyclecount_product"', summary['duplicates'][0]['sql'])
+        self.assertEqual(2, len(summary['slowest']))
+
+    def test_request_finished(self):
+        user = CustomUser.objects.create_user('perf', 'perf@test.com', 'test-pw')
+        count_session = CountSession.objects.create(created_by=user)
+        self.client.force_login(user)
+
+        response = self.client.get(reverse('cyclecount:session_review', args=(count_session.id,)))
+        log_kwargs = {}
+        add_sql_stats_to_request_finished(request=response.wsgi_request, log_kwargs=log_kwargs)
+
+        self.assertEqual(3, log_kwargs['sql']['count'])
+        self.assertEqual([], log_kwargs['sql']['duplicates'])
@@ -0,0 +1,185 @@
+import itertools
+import json
+from typing import Callable, List
+from unittest.mock import patch
+
+from django.db import connection
+from django.http import HttpResponse
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from cyclecount.barcodes import location_resolver, product_resolver, case_pack_resolver
+from cyclecount.finalize_jobs import run_pending_jobs
+from cyclecount.models import CustomUser, CountSession, Location, Product, IndividualCount, Inventory, SessionTally, \
+    CycleCountModification
+from cyclecount.scan_context import session_contexts, location_contexts
+from cyclecount.tallies import add_to_tallies
+
+
+'''
+Query budgets: every view makes a fixed number of queries, however much data is behind it. Each test builds the
+same request against a small and a large data set and checks both make the same number of queries, and no more
+than the view's budget. A view that starts looping over rows (N+1) fails the first check, a view that picks up
+an extra query fails the budget - if that extra query is on purpose, bump the budget in the same change.
+
+Budgets include the session and user lookups from the login (2 queries).
+'''
+
+# Request to measure, built (along with its data) for a given size
+BuildRequest = Callable[[int], Callable[[], HttpResponse]]
+
+_barcodes = itertools.count()
+
+
+class QueryBudgetTests(TestCase):
+    user: CustomUser = None
+    product: Product = None
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create_superuser('budget', 'budget@test.com', 'test-pw')
+        cls.product = Product.objects.create(description='budget-product', sku='budget-sku')
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def assertQueryBudget(self, budget: int, build_request: BuildRequest, small: int = 10, large: int = 1000):
+        counts: List[int] = []
+        for size in (small, large):
+            request = build_request(size)
+            # Both runs start cold, a barcode cached by the first run isn't a query saved
+            location_resolver.clear()
+            product_resolver.clear()
+            case_pack_resolver.clear()
+            session_contexts.clear()
+            location_contexts.clear()
+            with CaptureQueriesContext(connection) as captured:
+                response = request()
+            self.assertLess(response.status_code, 400, f'size {size}')
+            counts.append(len(captured))
+        queries = '\n'.join(query['sql'] for query in captured.captured_queries)
+        self.assertEqual(counts[0], counts[1], f'Queries grow with the data ({small}: {counts[0]}, {large}: '
+                                               f'{counts[1]}), queries for {large}:\n{queries}')
+        self.assertLessEqual(counts[1], budget, f'Over the budget of {budget}:\n{queries}')
+
+    def locations(self, count: int) -> List[Location]:
+        return Location.objects.bulk_create([Location(description=f'budget-location-{next(_barcodes)}')
+                                             for _ in range(count)])
+
+    def session_with_keys(self, keys: int, scans_per_key: int = 1) -> CountSession:
+        # A session with `keys` counted (location, product), half of them already in Inventory
+        count_session = CountSession.objects.create(created_by=self.user)
+        locations = self.locations(keys)
+        add_to_tallies(IndividualCount.objects.bulk_create([
+            IndividualCount(associate=self.user, session=count_session, location=location, product=self.product)
+            for location in locations for _ in range(scans_per_key)
+        ]))
+        Inventory.objects.bulk_create([Inventory(location=location, product=self.product, qty=3)
+                                       for location in locations[::2]])
+        return count_session
+
+    def test_list_active_sessions(self):
+        def build_request(size):
+            for _ in range(size):
+                self.session_with_keys(1)
+            return lambda: self.client.get(reverse('cyclecount:list_active_sessions'))
+        self.assertQueryBudget(3, build_request, small=1, large=50)
+
+    def test_session_review(self):
+        def build_request(size):
+            count_session = self.session_with_keys(size // 10, scans_per_key=10)
+            return lambda: self.client.get(reverse('cyclecount:session_review', args=(count_session.id,)))
+        self.assertQueryBudget(3, build_request)
+
+    def test_proposed_modifications_page(self):
+        def build_request(size):
+            count_session = self.session_with_keys(size)
+            url = reverse('cyclecount:proposed_modifications_page', args=(count_session.id,))
+            return lambda: self.client.get(url, {'page': 1, 'size': 100, 'sort[0][field]': 'variance',
+                                                 'sort[0][dir]': 'asc'})
+        # Small sessions fit on one page, large ones need the COUNT for last_page
+        self.assertQueryBudget(5, build_request, small=200)
+
+    def test_individual_counts_page(self):
+        def build_request(size):
+            count_session = self.session_with_keys(size // 10, scans_per_key=10)
+            url = reverse('cyclecount:individual_counts_page', args=(count_session.id,))
+            return lambda: self.client.get(url, {'page': 2, 'size': 5, 'filter[0][field]': 'state',
+                                                 'filter[0][value]': IndividualCount.CountState.ACTIVE})
+        self.assertQueryBudget(5, build_request)
+
+    def test_finalize_session(self):
+        def build_request(size):
+            count_session = self.session_with_keys(size)
+            url = reverse('cyclecount:finalize_session', args=(count_session.id,))
+            return lambda: self.client.post(url, {'choice': CountSession.FinalState.ACCEPTED})
+        # Only queues the job, see test_finalize_jobs for the worker
+        self.assertQueryBudget(10, build_request, small=1, large=500)
+        run_pending_jobs('budget-worker')
+        self.assertEqual(501, CycleCountModification.objects.count())
+
+    def test_scan_location(self):
+        def build_request(size):
+            count_session = self.session_with_keys(size)
+            location = self.locations(1)[0]
+            url = reverse('cyclecount:scan_location', args=(count_session.id,))
+            return lambda: self.client.post(url, {'location-barcode': location.description})
+        self.assertQueryBudget(4, build_request)
+
+    def test_scan_product(self):
+        def build_request(size):
+            count_session = self.session_with_keys(size)
+            location = self.locations(1)[0]
+            url = reverse('cyclecount:scan_product', args=(count_session.id, location.id))
+            return lambda: self.client.post(url, {'sku': self.product.sku})
+        # Cold caches and a new location, 7 for a repeat scan (see test_scan_context)
+        self.assertQueryBudget(12, build_request)
+
+    def test_scan(self):
+        def build_request(size):
+            count_session = self.session_with_keys(size)
+            location = self.locations(1)[0]
+            url = reverse('cyclecount:scan', args=(count_session.id,))
+            body = json.dumps({'location': location.description, 'sku': self.product.sku})
+            return lambda: self.client.post(url, body, content_type='application/json')
+        # Cold barcode caches and a new location (distinct counters looked up), 8 for a repeat scan
+        self.assertQueryBudget(12, build_request)
+
+    def test_scan_batch(self):
+        def build_request(size):
+            count_session = self.session_with_keys(1)
+            scans = [{'location': location.description, 'sku': self.product.sku} for location in self.locations(size)]
+            url = reverse('cyclecount:scan_batch', args=(count_session.id,))
+            return lambda: self.client.post(url, json.dumps({'scans': scans}), content_type='application/json')
+        self.assertQueryBudget(12, build_request, small=1, large=500)
+
+    def test_inventory_table_db(self):
+        def build_request(size):
+            Inventory.objects.bulk_create([Inventory(location=location, product=self.product, qty=1)
+                                           for location in self.locations(size)])
+            return lambda: self.client.get(reverse('inventory:inventory_table_db'), {'page': 2, 'size': 5})
+        self.assertQueryBudget(5, build_request)
+
+    def test_inventory_table_api(self):
+        def build_request(size):
+            Inventory.objects.bulk_create([Inventory(location=location, product=self.product, qty=1)
+                                           for location in self.locations(size)])
+            return lambda: self.client.get(reverse('inventory:inventory_table_api'), {'page': 2, 'size': 5})
+        # Product lookups go to the product service, not the database
+        with patch('inventory.views.ProductClient.get_products', return_value={}):
+            self.assertQueryBudget(5, build_request)
+
+    def test_admin_changelists(self):
+        for model in (CountSession, IndividualCount, SessionTally, Inventory, CycleCountModification):
+            with self.subTest(model=model.__name__):
+                def build_request(size):
+                    count_session = self.session_with_keys(size)
+                    CycleCountModification.objects.bulk_create([
+                        CycleCountModification(session=count_session, location_id=location_id,
+                                               product=self.product, old_qty=0, new_qty=1, associate=self.user)
+                        for location_id in Location.objects.order_by('-id').values_list('id', flat=True)[:size]
+                    ])
+                    url = reverse(f'admin:cyclecount_{model._meta.model_name}_changelist')
+                    return lambda: self.client.get(url)
+                self.assertQueryBudget(5, build_request, small=5, large=300)
@@ -0,0 +1,92 @@
+import json
+from typing import Dict, Iterator, List, Tuple
+
+from django.db import connection
+from django.db.models import QuerySet
+from django.test import TestCase
+
+from cyclecount.barcodes import location_resolver, product_resolver, case_pack_resolver
+from cyclecount.finalize import counted_quantities_query
+from cyclecount.models import CountSession, IndividualCount, Inventory, Location, Product
+from cyclecount.review import proposed_modifications, individual_counts, filter_proposed_modifications
+from cyclecount.scale_data import ScaleConfig, generate
+from cyclecount.tallies import ACTIVE_TALLIES_SQL
+
+
+'''
+EXPLAIN checks for the hot queries: barcode lookups, the session aggregates behind review/finalize and inventory
+paging. With sequential scans switched off the planner only picks one when there is no index it can use, so a
+Seq Scan in the plan means a query stopped matching its index (e.g. a filter on a new expression, or a dropped
+index) - on the real tables that's a full scan per scan/page.
+'''
+
+
+def plan_nodes(plan: Dict) -> Iterator[Tuple[str, str]]:
+    # (node type, relation) for every node of an EXPLAIN (FORMAT JSON) plan
+    yield plan['Node Type'], plan.get('Relation Name')
+    for child in plan.get('Plans', []):
+        yield from plan_nodes(child)
+
+
+class QueryPlanTests(TestCase):
+    count_session: CountSession = None
+
+    @classmethod
+    def setUpTestData(cls):
+        generate(ScaleConfig(products=3000, locations=2000, associates=3, sessions=1, scans_per_session=3000))
+        cls.count_session = CountSession.objects.get()
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+    def explain(self, sql: str, params) -> Dict:
+        with connection.cursor() as cursor:
+            # SET LOCAL, the test transaction is rolled back at the end of the test
+            cursor.execute('SET LOCAL enable_seqscan = off')
+            cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+            plan = cursor.fetchone()[0]
+        return (json.loads(plan) if isinstance(plan, str) else plan)[0]['Plan']
+
+    def assertUsesIndexes(self, sql: str, params=()):
+        plan = self.explain(sql, params)
+        seq_scans: List[str] = [relation for (node_type, relation) in plan_nodes(plan) if node_type == 'Seq Scan']
+        self.assertEqual([], seq_scans, f'Sequential scan in:\n{sql}\n{json.dumps(plan, indent=1)}')
+
+    def assertQuerySetUsesIndexes(self, queryset: QuerySet):
+        self.assertUsesIndexes(*queryset.query.sql_with_params())
+
+    def test_barcode_lookups(self):
+        location = Location.objects.first()
+        product = Product.objects.first()
+        for (resolver, barcode) in ((location_resolver, location.description), (product_resolver, product.sku),
+                                    (case_pack_resolver, product.sku)):
+            with self.subTest(model=resolver.model.__name__):
+                self.assertQuerySetUsesIndexes(resolver._query(**{resolver.field: barcode}))
+                self.assertQuerySetUsesIndexes(resolver._query(**{f'{resolver.field}__in': [barcode, 'other']}))
+
+    def test_session_aggregates(self):
+        location_ids = list(Location.objects.values_list('id', flat=True)[:3])
+        product_ids = list(Product.objects.values_list('id', flat=True)[:3])
+        self.assertUsesIndexes(ACTIVE_TALLIES_SQL, [self.count_session.id, location_ids, self.count_session.id,
+                                                    product_ids])
+
+        tallies = proposed_modifications(self.count_session)
+        self.assertQuerySetUsesIndexes(tallies[:100])
+        self.assertQuerySetUsesIndexes(filter_proposed_modifications(tallies, {'variance': 'negative'},
+                                                                     [('variance', 'asc')])[:100])
+        self.assertQuerySetUsesIndexes(individual_counts(self.count_session)[200:300])
+        self.assertQuerySetUsesIndexes(individual_counts(self.count_session).filter(
+            state=IndividualCount.CountState.ACTIVE)[:100])
+        self.assertQuerySetUsesIndexes(CountSession.objects.filter(created_by=self.count_session.created_by,
+                                                                   final_state__isnull=True))
+        self.assertQuerySetUsesIndexes(counted_quantities_query(self.count_session))
+
+    def test_inventory_paging(self):
+        inventory = Inventory.objects.select_related('product', 'location')
+        self.assertQuerySetUsesIndexes(inventory.order_by('id')[500:600])
+        self.assertQuerySetUsesIndexes(inventory.filter(id__gt=500).order_by('id')[:100])
+        self.assertQuerySetUsesIndexes(inventory.filter(id__lt=500).order_by('-id')[:100])
+
+    def test_unindexed_query_fails(self):
+        # Product.description has no index, make sure the check would notice
+        with self.assertRaises(AssertionError):
+            self.assertQuerySetUsesIndexes(Product.objects.filter(description='nothing'))
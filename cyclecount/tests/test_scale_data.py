@@ -0,0 +1,34 @@
+from django.test import TestCase
+
+from cyclecount.models import Product, Location, Inventory, CountSession, IndividualCount
+from cyclecount.scale_data import ScaleConfig, generate, ean13, location_barcode, location_inventory
+from cyclecount.tallies import find_tally_mismatches, find_counter_mismatches
+
+
+class ScaleDataTests(TestCase):
+    config = ScaleConfig(products=300, locations=200, associates=3, sessions=2, scans_per_session=150, batch_size=64)
+
+    def test_barcodes(self):
+        self.assertEqual('2000000000015', ean13(1))
+        self.assertEqual(['A-000-00-0', 'A-000-01-0', 'B-000-00-0', 'A1-000-00-0'],
+                         [location_barcode(index) for index in (0, 5, 10000, 100000)])
+
+    def test_generate(self):
+        for method in ('copy', 'bulk'):
+            with self.subTest(method=method):
+                config = self.config._replace(method=method)
+                totals = generate(config)
+
+                self.assertEqual(500, totals['products and locations'])
+                self.assertEqual(sum(len(location_inventory(config, index)) for index in range(config.locations)),
+                                 totals['inventory'])
+                self.assertGreaterEqual(totals['count sessions'], 2 * config.scans_per_session)
+                self.assertEqual([], find_tally_mismatches())
+                self.assertEqual([], find_counter_mismatches())
+
+        # The second run went on top of the first, with new barcodes
+        self.assertEqual(600, Product.objects.count())
+        self.assertEqual(400, Location.objects.count())
+        self.assertEqual(4, CountSession.objects.filter(final_state__isnull=True, total_scans__gte=150).count())
+        self.assertTrue(IndividualCount.objects.filter(state=IndividualCount.CountState.DELETED).exists())
+        self.assertTrue(Inventory.objects.exists())
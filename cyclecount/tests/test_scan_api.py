@@ -0,0 +1,190 @@
+import json
+
+from django.test import TestCase, Client
+from django.urls import reverse
+
+from cyclecount.barcodes import location_resolver, product_resolver, case_pack_resolver
+from cyclecount.models import CustomUser, CountSession, Location, Product, IndividualCount, CasePack
+
+
+class ScanBatchTests(TestCase):
+    USERNAME: str = 'cycle_count_test'
+    PASSWORD: str = 'test-pw'
+    user: CustomUser = None
+    location: Location = None
+    product: Product = None
+    session: CountSession = None
+    logged_in_client: Client = None
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create_user(cls.USERNAME, 'cc@test.com', cls.PASSWORD)
+        cls.location = Location(description='test-location-desc')
+        cls.location.save()
+        cls.product = Product(description='test-product-01', sku='test-sku-01')
+        cls.product.save()
+        cls.session = CountSession(created_by=cls.user)
+        cls.session.save()
+        cls.logged_in_client = Client()
+        cls.logged_in_client.login(username=cls.USERNAME, password=cls.PASSWORD)
+
+    def setUp(self):
+        location_resolver.clear()
+        product_resolver.clear()
+        case_pack_resolver.clear()
+
+    def post_scans(self, session: CountSession, scans) -> dict:
+        url = reverse('cyclecount:scan_batch', args=(session.id,))
+        return self.logged_in_client.post(url, json.dumps({'scans': scans}), content_type='application/json')
+
+    def test_scan_batch_no_auth(self):
+        url = reverse('cyclecount:scan_batch', args=(self.session.id,))
+        response = self.client.post(url, json.dumps({'scans': []}), content_type='application/json')
+        self.assertRedirects(response, f'/accounts/login/?next=/cycle-count/api/scan-batch/{self.session.id}', status_code=302)
+
+    def test_scan_batch(self):
+        response = self.post_scans(self.session, [
+            {'location': self.location.description, 'sku': self.product.sku},
+            {'location': self.location.description, 'sku': self.product.sku, 'qty': 6,
+             'client_timestamp': '2023-01-20T17:30:00Z'},
+            {'location': 'not-a-location', 'sku': self.product.sku},
+            {'location': self.location.description, 'sku': 'not-a-sku'},
+            {'location': self.location.description, 'sku': self.product.sku, 'qty': 0},
+            'not-an-object',
+        ])
+        self.assertEqual(response.status_code, 200)
+        body = response.json()
+        self.assertEqual(2, body['created_count'])
+        self.assertEqual(['created', 'created', 'rejected', 'rejected', 'rejected', 'rejected'],
+                         [result['status'] for result in body['results']])
+        self.assertEqual('Invalid location', body['results'][2]['error'])
+        self.assertEqual('Invalid product', body['results'][3]['error'])
+        self.assertTrue(body['results'][4]['error'].startswith('qty'))
+
+        individual_count = IndividualCount.objects.get(pk=body['results'][1]['id'])
+        self.assertEqual((6, self.user.id, self.location.id, self.product.id),
+                         (individual_count.qty, individual_count.associate_id, individual_count.location_id,
+                          individual_count.product_id))
+        self.assertEqual('2023-01-20T17:30:00+00:00', individual_count.client_scanned_at.isoformat())
+
+    def test_scan_batch_qty_too_large(self):
+        CasePack(product=self.product, barcode='test-case-of-100000', qty=100000).save()
+        response = self.post_scans(self.session, [
+            {'location': self.location.description, 'sku': self.product.sku},
+            {'location': self.location.description, 'sku': self.product.sku, 'qty': 3000000000},
+            {'location': self.location.description, 'sku': 'test-case-of-100000', 'qty': 100000},
+        ])
+        # The oversized ones are rejected, not the whole batch
+        self.assertEqual(response.status_code, 200)
+        results = response.json()['results']
+        self.assertEqual(['created', 'rejected', 'rejected'], [result['status'] for result in results])
+        self.assertTrue(all(result['error'].startswith('qty') for result in results[1:]))
+
+    def test_scan_batch_query_count_independent_of_batch_size(self):
+        scans = [{'location': self.location.description, 'sku': self.product.sku}] * 50
+        # session + user lookups, 2 barcode lookups, savepoint, session lock, bulk insert, session counters,
+        # tally upsert, new locations/SKUs lookup + counters, release
+        with self.assertNumQueries(12):
+            response = self.post_scans(self.session, scans)
+        self.assertEqual(50, response.json()['created_count'])
+
+    def test_scan_batch_case_pack(self):
+        CasePack(product=self.product, barcode='test-case-of-6', qty=6).save()
+        response = self.post_scans(self.session, [{'location': self.location.description, 'sku': 'test-case-of-6',
+                                                   'qty': 3}])
+        individual_count = IndividualCount.objects.get(pk=response.json()['results'][0]['id'])
+        self.assertEqual((self.product.id, 18), (individual_count.product_id, individual_count.qty))
+
+    def test_scan_batch_finalized_session(self):
+        count_session = CountSession(created_by=self.user, final_state=CountSession.FinalState.ACCEPTED)
+        count_session.save()
+        response = self.post_scans(count_session, [{'location': self.location.description, 'sku': self.product.sku}])
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(0, IndividualCount.objects.filter(session=count_session).count())
+
+    def test_scan_batch_bad_request(self):
+        url = reverse('cyclecount:scan_batch', args=(self.session.id,))
+        response = self.logged_in_client.post(url, 'not json', content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        with self.settings(SCAN_BATCH_MAX_SIZE=1):
+            response = self.post_scans(self.session, [{}, {}])
+        self.assertEqual(response.status_code, 400)
+
+
+class ScanTests(TestCase):
+    user: CustomUser = None
+    location: Location = None
+    product: Product = None
+    session: CountSession = None
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create_user('scan_test', 'scan@test.com', 'test-pw')
+        cls.location = Location.objects.create(description='test-scan-location')
+        cls.product = Product.objects.create(description='test-scan-product', sku='test-scan-sku')
+        cls.session = CountSession.objects.create(created_by=cls.user)
+
+    def setUp(self):
+        location_resolver.clear()
+        product_resolver.clear()
+        case_pack_resolver.clear()
+        self.client.force_login(self.user)
+
+    def post_scan(self, scan, session: CountSession = None):
+        url = reverse('cyclecount:scan', args=((session or self.session).id,))
+        return self.client.post(url, json.dumps(scan), content_type='application/json')
+
+    def test_scan_no_auth(self):
+        self.client.logout()
+        response = self.post_scan({'location': self.location.description})
+        self.assertRedirects(response, f'/accounts/login/?next=/cycle-count/api/scan/{self.session.id}',
+                             status_code=302)
+
+    def test_scan(self):
+        response = self.post_scan({'location': self.location.description})
+        self.assertEqual({'status': 'location', 'location_id': self.location.id, 'tallies': []}, response.json())
+
+        self.post_scan({'location': self.location.description, 'sku': self.product.sku})
+        response = self.post_scan({'location': self.location.description, 'sku': self.product.sku, 'qty': 4})
+        self.assertEqual(200, response.status_code)
+        body = response.json()
+        self.assertEqual(('created', self.location.id, self.product.id, 4),
+                         (body['status'], body['location_id'], body['product_id'], body['qty']))
+        self.assertEqual([{'product_id': self.product.id, 'sku': self.product.sku, 'counted_qty': 5, 'scan_count': 2}],
+                         body['tallies'])
+        self.assertEqual(self.user.id, IndividualCount.objects.get(pk=body['id']).associate_id)
+        self.session.refresh_from_db()
+        self.assertEqual((2, 2, 1, 1), (self.session.total_scans, self.session.active_scans,
+                                        self.session.distinct_locations, self.session.distinct_skus))
+
+    def test_scan_rejected(self):
+        CasePack(product=self.product, barcode='test-scan-case-of-100000', qty=100000).save()
+        for (scan, error) in (({'location': 'not-a-location'}, 'Invalid location'),
+                              ({'location': self.location.description, 'sku': 'not-a-sku'}, 'Invalid product'),
+                              ({'location': self.location.description, 'sku': self.product.sku, 'qty': 0}, 'qty'),
+                              ({'location': self.location.description, 'sku': self.product.sku, 'qty': 3000000000},
+                               'qty'),
+                              ({'location': self.location.description, 'sku': 'test-scan-case-of-100000',
+                                'qty': 100000}, 'qty: too many'),
+                              ('not-an-object', 'Scan must be an object')):
+            with self.subTest(error=error):
+                response = self.post_scan(scan)
+                self.assertEqual(400, response.status_code)
+                self.assertTrue(response.json()['error'].startswith(error))
+        self.assertEqual(0, IndividualCount.objects.count())
+
+        url = reverse('cyclecount:scan', args=(self.session.id,))
+        self.assertEqual(400, self.client.post(url, 'not json', content_type='application/json').status_code)
+
+    def test_scan_finalized_session(self):
+        count_session = CountSession.objects.create(created_by=self.user, final_state=CountSession.FinalState.CANCELED)
+        response = self.post_scan({'location': self.location.description, 'sku': self.product.sku}, count_session)
+        self.assertEqual(404, response.status_code)
+        self.assertEqual(0, IndividualCount.objects.count())
+
+    def test_scan_query_count(self):
+        self.post_scan({'location': self.location.description, 'sku': self.product.sku})
+        # Barcodes and the session are cached by now: session + user lookups, savepoint, insert (checks the session
+        # is open), session counters, tally upsert, location tallies, release
+        with self.assertNumQueries(8):
+            self.post_scan({'location': self.location.description, 'sku': self.product.sku})
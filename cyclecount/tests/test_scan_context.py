@@ -0,0 +1,130 @@
+import json
+import threading
+import time
+
+from django.db import connection, transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+
+from cyclecount.models import CustomUser, CountSession, Location, Product, IndividualCount
+from cyclecount.scan_context import SessionContext, LocationContext, session_contexts, location_contexts, \
+    open_session
+from cyclecount.scans import insert_scan
+
+
+class ScanContextTests(TestCase):
+    user: CustomUser = None
+    location: Location = None
+    product: Product = None
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create_user('scan-context', 'context@test.com', 'test-pw')
+        cls.location = Location.objects.create(description='context-location')
+        cls.product = Product.objects.create(description='context-product', sku='context-sku')
+
+    def setUp(self):
+        session_contexts.clear()
+        location_contexts.clear()
+        self.session = CountSession.objects.create(created_by=self.user)
+        self.client.force_login(self.user)
+
+    def finalize_behind_the_cache(self):
+        # Like a finalize in another process, which this process' in-memory cache hasn't heard about
+        CountSession.objects.filter(pk=self.session.id).update(final_state=CountSession.FinalState.ACCEPTED)
+
+    def test_cached(self):
+        self.assertEqual(SessionContext(self.session.id, True), open_session(self.session.id))
+        self.assertEqual(LocationContext(self.location.id, 'context-location'), location_contexts.get(self.location.id))
+        with self.assertNumQueries(0):
+            open_session(self.session.id)
+            location_contexts.get(self.location.id)
+        # Missing rows aren't cached
+        with self.assertNumQueries(2):
+            self.assertIsNone(open_session(-1))
+            self.assertIsNone(open_session(-1))
+
+    def test_finalize_invalidates(self):
+        open_session(self.session.id)
+        url = reverse('cyclecount:finalize_session', args=(self.session.id,))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(url, {'choice': CountSession.FinalState.CANCELED})
+        self.assertIsNone(open_session(self.session.id))
+        self.assertEqual(404, self.client.get(reverse('cyclecount:scan_page', args=(self.session.id,))).status_code)
+
+    def test_location_save_invalidates(self):
+        location_contexts.get(self.location.id)
+        self.location.description = 'context-location-renamed'
+        self.location.save()
+        self.assertEqual('context-location-renamed', location_contexts.get(self.location.id).description)
+
+    def test_scan_after_finalize_rejected_with_stale_cache(self):
+        self.assertIsNotNone(open_session(self.session.id))
+        self.finalize_behind_the_cache()
+        self.assertIsNotNone(open_session(self.session.id))  # Still open as far as the cache knows
+
+        url = reverse('cyclecount:scan_product', args=(self.session.id, self.location.id))
+        self.assertEqual(404, self.client.post(url, {'sku': self.product.sku}).status_code)
+        body = json.dumps({'location': self.location.description, 'sku': self.product.sku})
+        response = self.client.post(reverse('cyclecount:scan', args=(self.session.id,)), body,
+                                    content_type='application/json')
+        self.assertEqual(404, response.status_code)
+        self.assertEqual(0, IndividualCount.objects.count())
+        self.session.refresh_from_db()
+        self.assertEqual(0, self.session.total_scans)
+
+    def test_scan_product_with_warm_cache(self):
+        url = reverse('cyclecount:scan_product', args=(self.session.id, self.location.id))
+        self.client.post(url, {'sku': self.product.sku})
+        # session + user lookups, savepoint, insert, session counters, tally upsert, release
+        with self.assertNumQueries(7):
+            self.client.post(url, {'sku': self.product.sku})
+        self.assertEqual(2, IndividualCount.objects.filter(session=self.session).count())
+
+    @override_settings(SCAN_CONTEXT_SHARED_ALIAS='default')
+    def test_shared_tier(self):
+        open_session(self.session.id)
+        # Another process, with nothing in memory yet
+        session_contexts.clear()
+        with self.assertNumQueries(0):
+            self.assertIsNotNone(open_session(self.session.id))
+
+        self.session.final_state = CountSession.FinalState.CANCELED
+        self.session.save()
+        session_contexts.clear()
+        self.assertIsNone(open_session(self.session.id))
+
+
+class InsertScanConcurrencyTests(TransactionTestCase):
+
+    def test_scan_waiting_on_finalize_is_rejected(self):
+        user = CustomUser.objects.create_user('insert-scan', 'insert@test.com', 'test-pw')
+        location = Location.objects.create(description='insert-location')
+        product = Product.objects.create(description='insert-product', sku='insert-sku')
+        count_session = CountSession.objects.create(created_by=user)
+
+        locked = threading.Event()
+
+        def finalize():
+            try:
+                with transaction.atomic():
+                    locked_session = CountSession.objects.select_for_update().get(pk=count_session.id)
+                    locked.set()
+                    locked_session.final_state = CountSession.FinalState.ACCEPTED
+                    locked_session.save(update_fields=['final_state'])
+                    # The scan below is waiting on our lock by now
+                    time.sleep(0.2)
+            finally:
+                connection.close()
+
+        finalizer = threading.Thread(target=finalize)
+        finalizer.start()
+        try:
+            self.assertTrue(locked.wait(10))
+            with transaction.atomic():
+                inserted = insert_scan(IndividualCount(associate=user, session=count_session, location=location,
+                                                       product=product, qty=1))
+        finally:
+            finalizer.join()
+        self.assertFalse(inserted)
+        self.assertEqual(0, IndividualCount.objects.count())
@@ -0,0 +1,123 @@
+from unittest.mock import patch
+
+from channels.auth import AuthMiddlewareStack
+from channels.db import database_sync_to_async
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.test import TransactionTestCase, override_settings
+
+from cyclecount.consumers import SESSION_CLOSED
+from cyclecount.models import CustomUser, CountSession, Location, Product, IndividualCount
+from cyclecount.routing import websocket_urlpatterns
+from cyclecount.scan_context import session_contexts
+
+
+application = AuthMiddlewareStack(URLRouter(websocket_urlpatterns))
+
+
+# Database access from the consumer runs in another thread, so these can't run in a TestCase transaction
+@override_settings(SCAN_SOCKET_BATCH_SIZE=3, SCAN_SOCKET_FLUSH_SECONDS=10)
+class ScanSocketTests(TransactionTestCase):
+
+    def setUp(self):
+        session_contexts.clear()
+        self.user = CustomUser.objects.create_user('scan-socket', 'socket@test.com', 'test-pw')
+        self.location = Location.objects.create(description='socket-location')
+        self.product = Product.objects.create(description='socket-product', sku='socket-sku')
+        self.session = CountSession.objects.create(created_by=self.user)
+        self.client.force_login(self.user)
+
+    def communicator(self, session: CountSession = None, logged_in: bool = True) -> WebsocketCommunicator:
+        headers = []
+        if logged_in:
+            cookie = self.client.cookies[settings.SESSION_COOKIE_NAME].value
+            headers.append((b'cookie', f'{settings.SESSION_COOKIE_NAME}={cookie}'.encode()))
+        return WebsocketCommunicator(application, f'/ws/scan/{(session or self.session).id}', headers=headers)
+
+    def scan(self, scan_id: int, sku: str = None, **extra):
+        return {'type': 'scan', 'id': scan_id, 'location': self.location.description, 'sku': sku or self.product.sku,
+                **extra}
+
+    async def connected(self, **kwargs) -> WebsocketCommunicator:
+        communicator = self.communicator(**kwargs)
+        (connected, _) = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def test_refused(self):
+        closed = await database_sync_to_async(CountSession.objects.create)(
+            created_by=self.user, final_state=CountSession.FinalState.CANCELED)
+        for communicator in (self.communicator(logged_in=False), self.communicator(session=closed)):
+            (connected, _) = await communicator.connect()
+            self.assertFalse(connected)
+
+    async def test_batch_acked_and_broadcast(self):
+        handheld = await self.connected()
+        supervisor = await self.connected()
+
+        for scan in (self.scan(1), self.scan(2, qty=4), self.scan(3, sku='not-a-sku')):
+            await handheld.send_json_to(scan)
+        acks = [await handheld.receive_json_from() for _ in range(3)]
+        self.assertEqual([(1, 'created'), (2, 'created'), (3, 'rejected')],
+                         [(ack['scan'], ack['status']) for ack in acks])
+        self.assertEqual('Invalid product', acks[2]['error'])
+
+        tallies = [{'product_id': self.product.id, 'sku': self.product.sku, 'counted_qty': 5, 'scan_count': 2}]
+        for communicator in (handheld, supervisor):
+            update = await communicator.receive_json_from()
+            self.assertEqual('tallies', update['type'])
+            self.assertEqual({str(self.location.id): tallies}, update['locations'])
+            self.assertEqual(2, update['counters']['total_scans'])
+
+        ids = await database_sync_to_async(lambda: set(IndividualCount.objects.values_list('id', flat=True)))()
+        self.assertEqual({acks[0]['id'], acks[1]['id']}, ids)
+        await handheld.disconnect()
+        await supervisor.disconnect()
+
+    @override_settings(SCAN_SOCKET_BATCH_SIZE=50, SCAN_SOCKET_FLUSH_SECONDS=0.01)
+    async def test_flushed_after_delay(self):
+        handheld = await self.connected()
+        await handheld.send_json_to(self.scan(1))
+        self.assertEqual('created', (await handheld.receive_json_from())['status'])
+        self.assertEqual('tallies', (await handheld.receive_json_from())['type'])
+        await handheld.disconnect()
+
+    @override_settings(SCAN_SOCKET_BATCH_SIZE=50, SCAN_SOCKET_FLUSH_SECONDS=0.01)
+    async def test_timed_flush_fails(self):
+        handheld = await self.connected()
+        with patch('cyclecount.consumers.record_scan_batch', side_effect=RuntimeError('database went away')):
+            await handheld.send_json_to(self.scan(1))
+            await handheld.send_json_to(self.scan(2))
+            acks = [await handheld.receive_json_from() for _ in range(2)]
+        self.assertEqual([(1, 'rejected'), (2, 'rejected')], [(ack['scan'], ack['status']) for ack in acks])
+
+        # The socket carries on, the resent scan goes in
+        await handheld.send_json_to(self.scan(1))
+        self.assertEqual('created', (await handheld.receive_json_from())['status'])
+        await handheld.disconnect()
+        self.assertEqual(1, await database_sync_to_async(IndividualCount.objects.count)())
+
+    async def test_disconnect_flushes(self):
+        handheld = await self.connected()
+        await handheld.send_json_to(self.scan(1))
+        self.assertTrue(await handheld.receive_nothing())
+        await handheld.disconnect()
+        self.assertEqual(1, await database_sync_to_async(IndividualCount.objects.count)())
+
+    async def test_session_finalized(self):
+        handheld = await self.connected()
+        await database_sync_to_async(CountSession.objects.filter(pk=self.session.id).update)(
+            final_state=CountSession.FinalState.ACCEPTED)
+        for scan_id in range(3):
+            await handheld.send_json_to(self.scan(scan_id))
+        for _ in range(3):
+            self.assertEqual('rejected', (await handheld.receive_json_from())['status'])
+        self.assertEqual({'type': 'websocket.close', 'code': SESSION_CLOSED}, await handheld.receive_output())
+        self.assertEqual(0, await database_sync_to_async(IndividualCount.objects.count)())
+
+    async def test_not_a_scan(self):
+        handheld = await self.connected()
+        await handheld.send_json_to(['not', 'a', 'scan'])
+        self.assertEqual('error', (await handheld.receive_json_from())['type'])
+        await handheld.disconnect()
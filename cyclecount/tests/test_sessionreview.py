@@ -4,6 +4,8 @@ from django.urls import reverse
 
 from cyclecount.models import CustomUser, CountSession, Location, Product, IndividualCount, Inventory, \
     CycleCountModification
+from cyclecount.finalize_jobs import run_pending_jobs
+from cyclecount.tallies import add_to_tallies
 
 
 class SessionReviewTests(TestCase):
@@ -56,6 +58,12 @@ class SessionReviewTests(TestCase):
         cls.logged_in_client = Client()
         cls.logged_in_client.login(username=cls.USERNAME, password=cls.PASSWORD)
 
+    def location_quantities(self, **params):
+        url = reverse('cyclecount:proposed_modifications_page', args=(self.count_session.id,))
+        response = self.logged_in_client.get(url, params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()['data']
+
     def test_no_auth(self):
         response = self.client.get(reverse('cyclecount:list_active_sessions'))
         self.assertRedirects(response, '/accounts/login/?next=/cycle-count/list-active-sessions/', status_code=302)
@@ -86,21 +94,22 @@ class SessionReviewTests(TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertContains(response, reverse('cyclecount:finalize_session', args=(self.count_session.id,)))
 
-        location_quantities = response.context['location_quantities']
         self.assertEqual(
-            location_quantities[(self.location_01.id, self.product_01.id)],
-            {
-                'location': self.location_01,
-                'product': self.product_01,
+            self.location_quantities(),
+            [{
+                'location_id': self.location_01.id,
+                'product_id': self.product_01.id,
+                'location_description': self.location_01.description,
+                'sku': self.product_01.sku,
                 'cyclecount_qty': 1,
-                'qty': 0
-            }
+                'qty': 0,
+                'variance': 1,
+            }]
         )
         # self.assert???(response.content.decode(), 'cycle_count_test test-location-00-empty-desc test-sku-01 1 Active')
 
     def test_session_review_with_unusual_cyclecount_qty(self):
-        # This is a somewhat unusual case, as we currently don't have a way to generate individual count records
-        # with a quantity greater than 1, but the column allow for it, so adding some basic checks.
+        # Individual counts with a quantity greater than 1 come from qty entry and case pack / GS1 scans.
         self.individual_count_01.qty = 2
         self.individual_count_01.save()
 
@@ -109,16 +118,21 @@ class SessionReviewTests(TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertContains(response, reverse('cyclecount:finalize_session', args=(self.count_session.id,)))
 
-        location_quantities = response.context['location_quantities']
-        self.assertEqual(
-            location_quantities[(self.location_01.id, self.product_01.id)],
-            {
-                'location': self.location_01,
-                'product': self.product_01,
-                'cyclecount_qty': 2,
-                'qty': 0
-            }
-        )
+        self.assertEqual(2, self.location_quantities()[0]['cyclecount_qty'])
+
+    def test_session_review_ignores_deleted_counts(self):
+        IndividualCount(
+            associate=self.user, session=self.count_session, location=self.location_01, product=self.product_01,
+            qty=5, state=IndividualCount.CountState.DELETED
+        ).save()
+
+        url = reverse('cyclecount:session_review', args=(self.count_session.id,))
+        response = self.logged_in_client.get(url)
+        self.assertEqual(response.status_code, 200)
+        # The page loads its grid from here, which leaves the deleted count out of the new qty
+        self.assertContains(response, reverse('cyclecount:proposed_modifications_page', args=(self.count_session.id,)))
+
+        self.assertEqual(1, self.location_quantities()[0]['cyclecount_qty'])
 
     def finalize_session_helper(self, final_state: CountSession.FinalState) -> None:
         """
@@ -129,9 +143,14 @@ class SessionReviewTests(TestCase):
         url = reverse('cyclecount:finalize_session', args=(self.count_session.id,))
         response = self.logged_in_client.post(url, {'choice': final_state})
         self.assertEqual(response.status_code, 302)
-        self.assertEqual(response.url, reverse('cyclecount:list_active_sessions'))
+        if final_state == CountSession.FinalState.ACCEPTED:
+            self.assertEqual(response.url, reverse('cyclecount:finalize_status', args=(self.count_session.id,)))
+        else:
+            self.assertEqual(response.url, reverse('cyclecount:list_active_sessions'))
         updated_count_session = CountSession.objects.get(pk=self.count_session.id)
         self.assertEqual(final_state, updated_count_session.final_state)
+        # What finalize_worker would do
+        run_pending_jobs('test-worker')
         return
 
     def test_session_review_already_finalized(self):
@@ -158,21 +177,35 @@ class SessionReviewTests(TestCase):
         response = self.logged_in_client.get(url)
         self.assertEqual(response.status_code, 200)
 
-        location_quantities = response.context['location_quantities']
-        self.assertDictEqual(location_quantities, {
-            (self.location_01.id, self.product_01.id): {
-                'location': self.location_01,
-                'product': self.product_01,
-                'cyclecount_qty': 1,
-                'qty': 0,
-            },
-            (self.location_02.id, self.product_02.id): {
-                'location': self.location_02,
-                'product': self.product_02,
-                'cyclecount_qty': 1,
-                'qty': 5,
-            },
-        })
+        self.assertEqual(
+            [(row['location_id'], row['product_id'], row['cyclecount_qty'], row['qty'])
+             for row in self.location_quantities()],
+            [(self.location_01.id, self.product_01.id, 1, 0), (self.location_02.id, self.product_02.id, 1, 5)]
+        )
+
+    def test_session_review_query_count_independent_of_session_size(self):
+        locations = [Location(description=f'test-location-bulk-{i}') for i in range(20)]
+        Location.objects.bulk_create(locations)
+        add_to_tallies(IndividualCount.objects.bulk_create([
+            IndividualCount(associate=self.user, session=self.count_session, location=location, product=self.product_02)
+            for location in locations
+        ]))
+        Inventory.objects.bulk_create([Inventory(location=location, product=self.product_02, qty=9)
+                                       for location in locations[:10]])
+
+        url = reverse('cyclecount:session_review', args=(self.count_session.id,))
+        # session + user lookups, the session (with its creator), the rows come from the JSON endpoints
+        with self.assertNumQueries(3):
+            self.logged_in_client.get(url)
+
+        url = reverse('cyclecount:proposed_modifications_page', args=(self.count_session.id,))
+        # session + user lookups, the session, one page of rows (short page, so no COUNT)
+        with self.assertNumQueries(4):
+            response = self.logged_in_client.get(url, {'page': 1, 'size': 100})
+
+        location_quantities = response.json()['data']
+        self.assertEqual(21, len(location_quantities))
+        self.assertEqual(9, location_quantities[1]['qty'])
 
     def test_finalize_session_canceled_creates_inventory_record(self):
         self.finalize_session_helper(CountSession.FinalState.CANCELED)
@@ -232,3 +265,87 @@ class SessionReviewTests(TestCase):
         with self.assertRaises(Exception):
             self.logged_in_client.post(url, {'choice': CountSession.FinalState.ACCEPTED})
 
+    def test_finalize_session_accepted_sums_qty_and_skips_deleted(self):
+        Inventory(location=self.location_02, product=self.product_02, qty=7).save()
+        for (qty, state) in ((3, IndividualCount.CountState.ACTIVE),
+                             (4, IndividualCount.CountState.ACTIVE),
+                             (50, IndividualCount.CountState.DELETED)):
+            IndividualCount(associate=self.user, session=self.count_session, location=self.location_02,
+                            product=self.product_02, qty=qty, state=state).save()
+
+        self.finalize_session_helper(CountSession.FinalState.ACCEPTED)
+
+        self.assertEqual(7, Inventory.objects.get(location=self.location_02, product=self.product_02).qty)
+        cc_mod = CycleCountModification.objects.get(
+            session=self.count_session, location=self.location_02, product=self.product_02
+        )
+        self.assertEqual((7, 7), (cc_mod.old_qty, cc_mod.new_qty))
+        self.assertEqual(self.user, cc_mod.associate)
+        self.check_inventory_and_ccmod(self.location_01, self.product_01, 0, 1)
+
+    def test_finalize_session_query_count_independent_of_session_size(self):
+        locations = [Location(description=f'test-location-bulk-{i}') for i in range(20)]
+        Location.objects.bulk_create(locations)
+        add_to_tallies(IndividualCount.objects.bulk_create([
+            IndividualCount(associate=self.user, session=self.count_session, location=location, product=self.product_02)
+            for location in locations
+        ]))
+        Inventory.objects.bulk_create([Inventory(location=location, product=self.product_02, qty=9)
+                                       for location in locations[:10]])
+
+        url = reverse('cyclecount:finalize_session', args=(self.count_session.id,))
+        # session + user lookups, savepoint, lock + update of the CountSession, queue the job, release
+        with self.assertNumQueries(10):
+            self.logged_in_client.post(url, {'choice': CountSession.FinalState.ACCEPTED})
+        # claim (lock, count, update), then a chunk (lock, tallies, insert missing + lock + update inventory, bulk
+        # insert, job update) in savepoints
+        with self.assertNumQueries(18):
+            run_pending_jobs('test-worker')
+
+        self.assertEqual(21, CycleCountModification.objects.filter(session=self.count_session).count())
+        self.assertEqual(9, CycleCountModification.objects.get(session=self.count_session,
+                                                               location=locations[0]).old_qty)
+
+    def test_proposed_modifications_filter_by_variance_and_sort(self):
+        Inventory(location=self.location_02, product=self.product_02, qty=5).save()
+        Inventory(location=self.location_02, product=self.product_01, qty=1).save()
+        for (product, qty) in ((self.product_02, 2), (self.product_01, 1)):
+            IndividualCount(associate=self.user, session=self.count_session, location=self.location_02,
+                            product=product, qty=qty, state=IndividualCount.CountState.ACTIVE).save()
+
+        negative = self.location_quantities(**{'filter[0][field]': 'variance', 'filter[0][type]': '=',
+                                               'filter[0][value]': 'negative'})
+        self.assertEqual([(self.product_02.sku, -3)], [(row['sku'], row['variance']) for row in negative])
+
+        by_variance = self.location_quantities(**{'sort[0][field]': 'variance', 'sort[0][dir]': 'desc'})
+        self.assertEqual([1, 0, -3], [row['variance'] for row in by_variance])
+
+        url = reverse('cyclecount:proposed_modifications_page', args=(self.count_session.id,))
+        response = self.logged_in_client.get(url, {'sort[0][field]': 'id; DROP TABLE', 'sort[0][dir]': 'asc'})
+        self.assertEqual(400, response.status_code)
+
+    def test_individual_counts_page(self):
+        other_user = CustomUser.objects.create_user('other-associate', 'other@test.com', 'test-pw')
+        for (associate, qty) in ((self.user, 3), (other_user, 4), (other_user, 5)):
+            IndividualCount(associate=associate, session=self.count_session, location=self.location_02,
+                            product=self.product_02, qty=qty, state=IndividualCount.CountState.ACTIVE).save()
+
+        url = reverse('cyclecount:individual_counts_page', args=(self.count_session.id,))
+        response = self.logged_in_client.get(url, {'page': 2, 'size': 3})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(2, response.json()['last_page'])
+        self.assertEqual([5], [row['qty'] for row in response.json()['data']])
+
+        response = self.logged_in_client.get(url, {
+            'page': 1, 'size': 10, 'sort[0][field]': 'qty', 'sort[0][dir]': 'desc',
+            'filter[0][field]': 'username', 'filter[0][type]': '=', 'filter[0][value]': 'other-associate',
+            'filter[1][field]': 'location_description', 'filter[1][type]': 'like', 'filter[1][value]': 'location-02',
+        })
+        self.assertEqual(1, response.json()['last_page'])
+        self.assertEqual([(5, 'other-associate', 'test-location-02-desc', 'test-sku-02'),
+                          (4, 'other-associate', 'test-location-02-desc', 'test-sku-02')],
+                         [(row['qty'], row['username'], row['location_description'], row['sku'])
+                          for row in response.json()['data']])
+
+        response = self.logged_in_client.get(url, {'filter[0][field]': 'associate_id', 'filter[0][value]': '1'})
+        self.assertEqual(400, response.status_code)
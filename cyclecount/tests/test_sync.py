@@ -0,0 +1,151 @@
+import json
+import threading
+
+from django.db import OperationalError, connection, transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+
+from cyclecount.models import CustomUser, CountSession, Location, Product, IndividualCount, SessionTally
+from cyclecount.sync import changes_since
+
+
+class SyncTests(TestCase):
+    user: CustomUser = None
+    other_user: CustomUser = None
+    location: Location = None
+    product: Product = None
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create_user('sync', 'sync@test.com', 'test-pw')
+        cls.other_user = CustomUser.objects.create_user('sync-other', 'sync-other@test.com', 'test-pw')
+        cls.location = Location.objects.create(description='sync-location')
+        cls.product = Product.objects.create(description='sync-product', sku='sync-sku')
+
+    def setUp(self):
+        self.session = CountSession.objects.create(created_by=self.user)
+        self.client.force_login(self.user)
+
+    def scan(self, key: str, qty: int = 1):
+        return {'key': key, 'location': self.location.description, 'sku': self.product.sku, 'qty': qty}
+
+    def sync(self, body, user: CustomUser = None, session: CountSession = None):
+        self.client.force_login(user or self.user)
+        url = reverse('cyclecount:sync', args=((session or self.session).id,))
+        return self.client.post(url, json.dumps(body), content_type='application/json')
+
+    def assertTally(self, counted_qty: int, scan_count: int):
+        tally = SessionTally.objects.get(session=self.session)
+        self.assertEqual((counted_qty, scan_count), (tally.counted_qty, tally.scan_count))
+
+    def test_resubmitted_scans_recorded_once(self):
+        body = {'scans': [self.scan('key-1'), self.scan('key-2', qty=3), self.scan('key-1')]}
+        first = self.sync(body).json()
+        self.assertEqual(['created', 'created', 'duplicate'], [result['status'] for result in first['results']])
+        self.assertEqual(first['results'][0]['id'], first['results'][2]['id'])
+
+        # The response got lost, the handheld sends it all again
+        second = self.sync(body).json()
+        self.assertEqual(['duplicate'] * 3, [result['status'] for result in second['results']])
+        self.assertEqual([result['id'] for result in first['results']],
+                         [result['id'] for result in second['results']])
+        self.assertEqual(2, IndividualCount.objects.filter(session=self.session).count())
+        self.assertTally(4, 2)
+        self.session.refresh_from_db()
+        self.assertEqual(2, self.session.total_scans)
+
+    def test_scans_without_key_rejected(self):
+        body = {'scans': [self.scan('key-1'), {'location': self.location.description, 'sku': self.product.sku}]}
+        for _ in range(2):
+            results = self.sync(body).json()['results']
+            self.assertEqual('rejected', results[1]['status'])
+            self.assertTrue(results[1]['error'].startswith('key'))
+        self.assertEqual(1, IndividualCount.objects.filter(session=self.session).count())
+        self.assertTally(1, 1)
+
+    def test_changes_since_cursor(self):
+        uploaded = self.sync({'scans': [self.scan('key-1'), self.scan('key-2')]}).json()
+        # The handheld's own scans come back too, it knows them by key
+        self.assertEqual(['key-1', 'key-2'], [change['key'] for change in uploaded['changes']])
+
+        pulled = self.sync({'cursor': 0}, user=self.other_user).json()
+        self.assertEqual(uploaded['changes'], pulled['changes'])
+        self.assertEqual((uploaded['cursor'], False), (pulled['cursor'], pulled['more']))
+        nothing_new = self.sync({'cursor': pulled['cursor']}, user=self.other_user).json()
+        self.assertEqual(([], pulled['cursor']), (nothing_new['changes'], nothing_new['cursor']))
+
+        deleted = self.sync({'cursor': uploaded['cursor'], 'deletes': ['key-1', 'key-1', 'no-such-key']}).json()
+        self.assertEqual(['deleted', 'deleted', 'not_found'], [result['status'] for result in deleted['deletes']])
+        self.assertTally(1, 1)
+
+        pulled = self.sync({'cursor': pulled['cursor']}, user=self.other_user).json()
+        self.assertEqual([('key-1', IndividualCount.CountState.DELETED)],
+                         [(change['key'], change['state']) for change in pulled['changes']])
+        self.assertGreater(pulled['cursor'], uploaded['cursor'])
+
+    @override_settings(SYNC_PAGE_SIZE=2)
+    def test_changes_paged(self):
+        self.sync({'scans': [self.scan(f'key-{i}') for i in range(3)]})
+        first = self.sync({'cursor': 0}).json()
+        self.assertEqual((2, True), (len(first['changes']), first['more']))
+        second = self.sync({'cursor': first['cursor']}).json()
+        self.assertEqual((['key-2'], False), ([change['key'] for change in second['changes']], second['more']))
+
+    def test_finalized_session(self):
+        self.sync({'scans': [self.scan('key-1')]})
+        CountSession.objects.filter(pk=self.session.id).update(final_state=CountSession.FinalState.ACCEPTED)
+        self.assertEqual(404, self.sync({'scans': [self.scan('key-2')]}).status_code)
+        self.assertEqual(404, self.sync({'deletes': ['key-1']}).status_code)
+        # Can still catch up on it
+        self.assertEqual(['key-1'], [change['key'] for change in self.sync({}).json()['changes']])
+        self.assertEqual(1, IndividualCount.objects.filter(session=self.session).count())
+
+    def test_bad_request(self):
+        for body in ({'cursor': -1}, {'deletes': 'key-1'}, ['not', 'an', 'object']):
+            with self.subTest(body=body):
+                self.assertEqual(400, self.sync(body).status_code)
+        with override_settings(SCAN_BATCH_MAX_SIZE=1):
+            self.assertEqual(400, self.sync({'scans': [self.scan('key-1'), self.scan('key-2')]}).status_code)
+
+
+class SyncCursorTests(TransactionTestCase):
+
+    def test_writers_to_a_session_take_turns(self):
+        user = CustomUser.objects.create_user('sync-cursor', 'cursor@test.com', 'test-pw')
+        location = Location.objects.create(description='cursor-location')
+        product = Product.objects.create(description='cursor-product', sku='cursor-sku')
+        (count_session, other_session) = (CountSession.objects.create(created_by=user) for _ in range(2))
+
+        def new_scan(session: CountSession) -> IndividualCount:
+            return IndividualCount.objects.create(associate=user, session=session, location=location, product=product)
+
+        written = threading.Event()
+        release = threading.Event()
+
+        def hold_a_scan():
+            try:
+                with transaction.atomic():
+                    new_scan(count_session)
+                    written.set()
+                    release.wait(10)
+            finally:
+                connection.close()
+
+        writer = threading.Thread(target=hold_a_scan)
+        writer.start()
+        try:
+            self.assertTrue(written.wait(10))
+            # A later sync_seq of the same session can't commit first, so a cursor can't skip past the open one
+            with self.assertRaises(OperationalError), transaction.atomic():
+                with connection.cursor() as cursor:
+                    cursor.execute("SET LOCAL lock_timeout = '200ms'")
+                new_scan(count_session)
+            self.assertEqual([], changes_since(count_session.id, 0, 10).changes)
+            # Other sessions don't wait
+            new_scan(other_session)
+        finally:
+            release.set()
+            writer.join()
+
+        new_scan(count_session)
+        self.assertEqual(2, len(changes_since(count_session.id, 0, 10).changes))
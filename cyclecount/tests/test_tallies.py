@@ -0,0 +1,142 @@
+from io import StringIO
+
+from django.core.management import call_command, CommandError
+from django.test import TestCase
+
+from cyclecount.models import CustomUser, CountSession, Location, Product, IndividualCount, SessionTally
+from cyclecount.scans import record_scan_batch
+from cyclecount.tallies import find_tally_mismatches, find_counter_mismatches, rebuild_tallies
+
+
+class SessionTallyTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create_user('cycle_count_test', 'cc@test.com', 'test-pw')
+        cls.location_01 = Location.objects.create(description='test-location-01-desc')
+        cls.location_02 = Location.objects.create(description='test-location-02-desc')
+        cls.product_01 = Product.objects.create(description='test-product-01', sku='test-sku-01')
+        cls.count_session = CountSession.objects.create(created_by=cls.user)
+
+    def count(self, qty=1, location=None):
+        individual_count = IndividualCount(
+            associate=self.user, session=self.count_session, location=location or self.location_01,
+            product=self.product_01, qty=qty, state=IndividualCount.CountState.ACTIVE
+        )
+        individual_count.save()
+        return individual_count
+
+    def tally(self, location=None):
+        tally = SessionTally.objects.get(session=self.count_session, location=location or self.location_01,
+                                         product=self.product_01)
+        return tally.counted_qty, tally.scan_count
+
+    def test_scans_are_tallied(self):
+        self.count(qty=3)
+        latest = self.count(qty=4)
+
+        self.assertEqual((7, 2), self.tally())
+        self.assertEqual(latest.created_at, SessionTally.objects.get().last_scanned_at)
+        self.assertEqual([], find_tally_mismatches())
+
+    def test_marked_deleted_and_restored(self):
+        individual_count = self.count(qty=3)
+        self.count(qty=4)
+
+        individual_count.state = IndividualCount.CountState.DELETED
+        individual_count.save()
+        self.assertEqual((4, 1), self.tally())
+
+        # Reloaded from the DB, rather than the instance that was just saved
+        individual_count = IndividualCount.objects.get(pk=individual_count.pk)
+        individual_count.state = IndividualCount.CountState.ACTIVE
+        individual_count.save()
+        self.assertEqual((7, 2), self.tally())
+
+    def test_qty_and_location_changes(self):
+        individual_count = self.count(qty=3)
+
+        individual_count.qty = 5
+        individual_count.save()
+        self.assertEqual((5, 1), self.tally())
+
+        individual_count.location = self.location_02
+        individual_count.save()
+        self.assertEqual((0, 0), self.tally())
+        self.assertEqual((5, 1), self.tally(self.location_02))
+
+        IndividualCount.objects.get(pk=individual_count.pk).delete()
+        self.assertEqual((0, 0), self.tally(self.location_02))
+        self.assertEqual([], find_tally_mismatches())
+
+    def test_scan_batch_is_tallied(self):
+        record_scan_batch(self.count_session.id, self.user, [
+            {'location': self.location_01.description, 'sku': self.product_01.sku, 'qty': 2},
+            {'location': self.location_01.description, 'sku': self.product_01.sku},
+            {'location': self.location_02.description, 'sku': self.product_01.sku},
+        ])
+
+        self.assertEqual((3, 2), self.tally())
+        self.assertEqual((1, 1), self.tally(self.location_02))
+        self.assertEqual([], find_tally_mismatches([self.count_session.id]))
+
+    def test_check_and_rebuild(self):
+        self.count(qty=3)
+        # QuerySet.update doesn't send signals, so the tally drifts
+        IndividualCount.objects.update(qty=10)
+
+        mismatches = find_tally_mismatches()
+        self.assertEqual(1, len(mismatches))
+        self.assertEqual((10, 1, 3, 1), mismatches[0][3:])
+        with self.assertRaises(CommandError):
+            call_command('session_tallies', stdout=StringIO())
+
+        self.assertEqual(1, rebuild_tallies([self.count_session.id]))
+        self.assertEqual((10, 1), self.tally())
+        out = StringIO()
+        call_command('session_tallies', '--rebuild', stdout=out)
+        self.assertIn('Tallies are consistent', out.getvalue())
+
+    def counters(self):
+        count_session = CountSession.objects.get(pk=self.count_session.pk)
+        return (count_session.total_scans, count_session.active_scans, count_session.distinct_locations,
+                count_session.distinct_skus)
+
+    def test_session_counters(self):
+        product_02 = Product.objects.create(description='test-product-02', sku='test-sku-02')
+        first = self.count(qty=3)
+        self.count(qty=4)
+        moved = self.count(location=self.location_02)
+        self.assertEqual((3, 3, 2, 1), self.counters())
+
+        IndividualCount(associate=self.user, session=self.count_session, location=self.location_02,
+                        product=product_02, state=IndividualCount.CountState.ACTIVE).save()
+        self.assertEqual((4, 4, 2, 2), self.counters())
+
+        # location_02 still has product_02
+        moved.location = self.location_01
+        moved.save()
+        self.assertEqual((4, 4, 2, 2), self.counters())
+
+        first.state = IndividualCount.CountState.DELETED
+        first.save()
+        self.assertEqual((4, 3, 2, 2), self.counters())
+
+        IndividualCount.objects.filter(location=self.location_02).get().delete()
+        self.assertEqual((3, 2, 1, 1), self.counters())
+        self.assertEqual([], find_counter_mismatches())
+        self.assertIsNotNone(CountSession.objects.get(pk=self.count_session.pk).last_scan_at)
+
+    def test_session_counters_from_scan_batch_and_rebuild(self):
+        record_scan_batch(self.count_session.id, self.user, [
+            {'location': self.location_01.description, 'sku': self.product_01.sku},
+            {'location': self.location_02.description, 'sku': self.product_01.sku},
+        ])
+        self.assertEqual((2, 2, 2, 1), self.counters())
+        self.assertEqual([], find_counter_mismatches([self.count_session.id]))
+
+        CountSession.objects.update(total_scans=0, active_scans=0)
+        self.assertEqual([(self.count_session.id, (2, 2, 2, 1), (0, 0, 2, 1))],
+                         [tuple(mismatch) for mismatch in find_counter_mismatches()])
+        rebuild_tallies()
+        self.assertEqual((2, 2, 2, 1), self.counters())
@@ -1,17 +1,29 @@
 from django.urls import path
 
-from cyclecount.views import individualcount_workflow, sessionreview
+from cyclecount.views import individualcount_workflow, sessionreview, session_review_api, scan_api
 
 app_name = 'cyclecount'
 urlpatterns = [
     path('begin-cycle-count/', individualcount_workflow.begin_cycle_count, name='begin_cycle_count'),
     path('start-session/', individualcount_workflow.start_new_session, name='start_new_session'),
+    path('scan/<int:session_id>', individualcount_workflow.scan_page, name='scan_page'),
     path('scan-prompt-location/<int:session_id>', individualcount_workflow.scan_prompt_location, name='scan_prompt_location'),
     path('scan-location/<int:session_id>', individualcount_workflow.scan_location, name='scan_location'),
     path('scan-prompt-product/<int:session_id>/<int:location_id>', individualcount_workflow.scan_prompt_product, name='scan_prompt_product'),
     path('scan-product/<int:session_id>/<int:location_id>', individualcount_workflow.scan_product, name='scan_product'),
 
+    path('api/scan/<int:session_id>', scan_api.scan, name='scan'),
+    path('api/scan-batch/<int:session_id>', scan_api.scan_batch, name='scan_batch'),
+    path('api/sync/<int:session_id>', scan_api.sync, name='sync'),
+
     path('list-active-sessions/', sessionreview.list_active_sessions, name='list_active_sessions'),
     path('session-review/<int:session_id>', sessionreview.session_review, name='session_review'),
+    path('api/session-review/<int:session_id>/proposed-modifications',
+         session_review_api.proposed_modifications_page, name='proposed_modifications_page'),
+    path('api/session-review/<int:session_id>/individual-counts',
+         session_review_api.individual_counts_page, name='individual_counts_page'),
     path('finalize-session/<int:session_id>', sessionreview.finalize_session, name='finalize_session'),
+    path('finalize-status/<int:session_id>', sessionreview.finalize_status, name='finalize_status'),
+    path('api/finalize-status/<int:session_id>', session_review_api.finalize_status_json,
+         name='finalize_status_json'),
 ]
\ No newline at end of file
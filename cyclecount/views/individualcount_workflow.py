@@ -1,15 +1,35 @@
 import structlog
 from django.contrib.auth.decorators import login_required
-from django.http import HttpResponseRedirect, HttpRequest, HttpResponse, HttpResponseNotFound
-from django.shortcuts import render, get_object_or_404
+from django.db import transaction
+from django.http import Http404, HttpResponseRedirect, HttpRequest, HttpResponse
+from django.shortcuts import render
 from django.urls import reverse
 
-from cyclecount.models import Location, Product, CountSession, IndividualCount
+from cyclecount.barcodes import location_resolver, resolve_product_barcode
+from cyclecount.models import CountSession, IndividualCount
+from cyclecount.scan_context import SessionContext, LocationContext, open_session, location_contexts
+from cyclecount.scans import MAX_SCAN_QTY, counted_qty, insert_scan
+from cyclecount.tallies import add_to_tallies
 
 
 log = structlog.get_logger(__name__)
 
 
+def _open_session_or_404(session_id: int) -> SessionContext:
+    # From scan_context, no query once the session has been seen. Anything that records a scan re-checks it.
+    session = open_session(session_id)
+    if session is None:
+        raise Http404('No open session')
+    return session
+
+
+def _location_or_404(location_id: int) -> LocationContext:
+    location = location_contexts.get(location_id)
+    if location is None:
+        raise Http404('No such location')
+    return location
+
+
 @login_required
 def begin_cycle_count(request: HttpRequest) -> HttpResponse:
     # Prompt the user to see if they want to start a cycle counting session
@@ -22,66 +42,85 @@ def start_new_session(request: HttpRequest) -> HttpResponseRedirect:
     # TODO -      Note that its been a few years since I though through these full stack design issues
     new_session = CountSession(created_by=request.user)
     new_session.save()
-    return HttpResponseRedirect(reverse('cyclecount:scan_prompt_location', args=(new_session.id,)))
+    return HttpResponseRedirect(reverse('cyclecount:scan_page', args=(new_session.id,)))
+
+
+@login_required
+def scan_page(request: HttpRequest, session_id: int) -> HttpResponse:
+    # The whole scan loop on one page, scans are posted to scan_api.scan without leaving it. The scan_prompt_*
+    # pages below are the same loop as plain forms.
+    session = _open_session_or_404(session_id)
+    return render(request, 'cyclecount/scan.html', {'session': session})
 
 
 @login_required
 def scan_prompt_location(request: HttpRequest, session_id: int) -> HttpResponse:
-    session = get_object_or_404(CountSession, pk=session_id)
-    if session.final_state is not None:
-        return HttpResponseNotFound()
+    session = _open_session_or_404(session_id)
     return render(request, 'cyclecount/scan_prompt_location.html', {'session': session})
 
 
 @login_required
 def scan_location(request: HttpRequest, session_id: int) -> HttpResponse:
-    session = get_object_or_404(CountSession, pk=session_id)
-    if session.final_state is not None:
-        return HttpResponseNotFound()
+    session = _open_session_or_404(session_id)
     # TODO - How to I deal with invalid location scans
     #  I can visualize the behavior I want, but unsure on how to do it in Django.
     #  This will probably be generic behavior for both location and product scan (validation and user suggestions)
-    location = Location.objects.filter(description=request.POST['location-barcode']).first()
-    if location is None:
+    location_id = location_resolver.resolve(request.POST['location-barcode'])
+    if location_id is None:
         return render(request, 'cyclecount/scan_prompt_location.html',
                       {'session': session, 'error_message': "Invalid location"})
 
-    log.info('scan_location', session_id=session_id, location=location.id, associate=request.user.id)
+    log.info('scan_location', session_id=session_id, location=location_id, associate=request.user.id)
     # TODO - the back button in the browser was triggering MultiValueDictKeyError
     #  https://stackoverflow.com/questions/5895588/django-multivaluedictkeyerror-error-how-do-i-deal-with-it
     #  ANSWER: the name on the attribute in the form was different from what I was trying to get from the POST dict key
-    return HttpResponseRedirect(reverse('cyclecount:scan_prompt_product', args=(session.id, location.id)))
+    return HttpResponseRedirect(reverse('cyclecount:scan_prompt_product', args=(session.id, location_id)))
 
 
 @login_required
 def scan_prompt_product(request: HttpRequest, session_id: int, location_id: int) -> HttpResponse:
-    session = get_object_or_404(CountSession, pk=session_id)
-    if session.final_state is not None:
-        return HttpResponseNotFound()
-    location = get_object_or_404(Location, pk=location_id)
+    session = _open_session_or_404(session_id)
+    location = _location_or_404(location_id)
     return render(request, 'cyclecount/scan_prompt_product.html', {'session': session, 'location': location})
 
 
 @login_required
 def scan_product(request: HttpRequest, session_id: int, location_id: int) -> HttpResponse:
-    session = get_object_or_404(CountSession, pk=session_id)
-    if session.final_state is not None:
-        return HttpResponseNotFound()
-    location = get_object_or_404(Location, pk=location_id)
+    session = _open_session_or_404(session_id)
+    location = _location_or_404(location_id)
+
+    # Optional, lets the associate count a stack of identical units with a single scan.
+    try:
+        qty = int(request.POST.get('qty') or '1')
+    except ValueError:
+        qty = 0
+    if not 1 <= qty <= MAX_SCAN_QTY:
+        return render(request, 'cyclecount/scan_prompt_product.html', {
+            'session': session, 'location': location, 'error_message': "Invalid quantity"
+        })
 
-    product = Product.objects.filter(sku=request.POST['sku']).first()
-    if product is None:
+    # Plain sku (1 unit), case pack barcode or GS1-128 label (many units)
+    product_scan = resolve_product_barcode(request.POST['sku'])
+    if product_scan is None:
         return render(request, 'cyclecount/scan_prompt_product.html', {
-            'session': session, 'location': location, 'error_message': "Invalid location"
+            'session': session, 'location': location, 'error_message': "Invalid product"
+        })
+    if counted_qty(qty, product_scan) is None:
+        return render(request, 'cyclecount/scan_prompt_product.html', {
+            'session': session, 'location': location, 'error_message': "Invalid quantity"
         })
 
     individual_count = IndividualCount(
-        associate=request.user, session=session, location=location, product=product,
-        state=IndividualCount.CountState.ACTIVE
+        associate=request.user, session_id=session.id, location_id=location.id, product_id=product_scan.product_id,
+        qty=counted_qty(qty, product_scan), state=IndividualCount.CountState.ACTIVE
     )
-    individual_count.save()
-
-    log.info('scan_product individual_count created',
-             session_id=session_id, location=location.id, product=product.id, associate=request.user.id)
+    with transaction.atomic():
+        # The cached session may be out of date, the insert itself refuses a finalized one
+        if not insert_scan(individual_count):
+            raise Http404('No open session')
+        add_to_tallies([individual_count])
+
+    log.info('scan_product individual_count created', session_id=session_id, location=location.id,
+             product=product_scan.product_id, qty=individual_count.qty, associate=request.user.id)
 
     return HttpResponseRedirect(reverse('cyclecount:scan_prompt_product', args=(session.id, location.id)))
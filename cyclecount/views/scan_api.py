@@ -0,0 +1,104 @@
+import json
+
+import structlog
+from django.conf import settings
+from django.contrib.auth.decorators import login_required
+from django.http import HttpRequest, JsonResponse
+from django.views.decorators.http import require_POST
+
+from cyclecount.scans import record_scan_batch, record_scan
+from cyclecount.sync import SyncError, sync_session
+
+
+log = structlog.get_logger(__name__)
+
+
+'''
+JSON endpoints for handhelds. These use the same session authentication as the rest of the site,
+so requests need the csrftoken cookie value in an X-CSRFToken header.
+'''
+
+
+@login_required
+@require_POST
+def scan_batch(request: HttpRequest, session_id: int) -> JsonResponse:
+    """
+    Submit many scans in one request, so a handheld can buffer scans and flush them every few seconds.
+
+    Request:  {"scans": [{"location": "<location barcode>", "sku": "<sku>", "qty": 1,
+                          "client_timestamp": "2023-01-20T17:30:00Z", "key": "<uuid, optional>"}, ...]}
+    Response: {"created_count": 1, "results": [{"index": 0, "status": "created", "id": 123},
+                                               {"index": 1, "status": "duplicate", "id": 122},
+                                               {"index": 2, "status": "rejected", "error": "Invalid product"}]}
+    """
+    try:
+        raw_scans = json.loads(request.body)['scans']
+    except (ValueError, KeyError, TypeError):
+        return JsonResponse({'error': 'Expected a JSON body of {"scans": [...]}'}, status=400)
+    if not isinstance(raw_scans, list):
+        return JsonResponse({'error': 'scans must be a list'}, status=400)
+    if len(raw_scans) > settings.SCAN_BATCH_MAX_SIZE:
+        return JsonResponse({'error': f'At most {settings.SCAN_BATCH_MAX_SIZE} scans per request'}, status=400)
+
+    results = record_scan_batch(session_id, request.user, raw_scans)
+    if results is None:
+        return JsonResponse({'error': 'Session not found or already finalized'}, status=404)
+
+    return JsonResponse({
+        'created_count': sum(1 for result in results if result['status'] == 'created'),
+        'results': results,
+    })
+
+
+@login_required
+@require_POST
+def scan(request: HttpRequest, session_id: int) -> JsonResponse:
+    """
+    A single scan, posted by the scan page (scan.html) as it happens, instead of the form/redirect round trips of
+    scan_location and scan_product.
+
+    Request:  {"location": "<location barcode>", "sku": "<sku>", "qty": 1, "client_timestamp": "..."}
+              (sku left out to check the location before scanning products)
+    Response: {"status": "created", "id": 123, "location_id": 4, "product_id": 5, "qty": 1,
+               "tallies": [{"product_id": 5, "sku": "<sku>", "counted_qty": 3, "scan_count": 2}, ...]}
+              {"status": "location", "location_id": 4, "tallies": [...]}
+              {"status": "rejected", "error": "Invalid product"} (400)
+    """
+    try:
+        raw_scan = json.loads(request.body)
+    except ValueError:
+        return JsonResponse({'status': 'rejected', 'error': 'Expected a JSON body'}, status=400)
+
+    result = record_scan(session_id, request.user, raw_scan)
+    if result is None:
+        return JsonResponse({'error': 'Session not found or already finalized'}, status=404)
+    return JsonResponse(result, status=400 if result['status'] == 'rejected' else 200)
+
+
+@login_required
+@require_POST
+def sync(request: HttpRequest, session_id: int) -> JsonResponse:
+    """
+    Store and forward sync for handhelds that scan offline, see cyclecount.sync.
+
+    Request:  {"cursor": 0, "scans": [{"key": "<uuid>", "location": ..., "sku": ..., "qty": 1,
+                                       "client_timestamp": ...}, ...],
+               "deletes": ["<uuid of a scan to delete>", ...]}
+    Response: {"results": [{"index": 0, "status": "created" | "duplicate", "id": 123}, ...],
+               "deletes": [{"key": "<uuid>", "status": "deleted", "id": 122}, ...],
+               "changes": [{"id": 123, "key": "<uuid>", "associate_id": 1, "location_id": 4, "product_id": 5,
+                            "qty": 1, "state": "Active", "client_timestamp": ...}, ...],
+               "cursor": 4567, "more": false}
+    """
+    try:
+        raw_sync = json.loads(request.body)
+    except ValueError:
+        return JsonResponse({'error': 'Expected a JSON body'}, status=400)
+
+    try:
+        result = sync_session(session_id, request.user, raw_sync)
+    except SyncError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    if result is None:
+        return JsonResponse({'error': 'Session not found or already finalized'}, status=404)
+    return JsonResponse(result)
@@ -0,0 +1,101 @@
+import math
+import re
+from typing import Callable, Dict, List, Tuple
+
+import structlog
+from django.contrib.auth.decorators import login_required
+from django.db.models import QuerySet
+from django.http import HttpRequest, JsonResponse, QueryDict
+from django.shortcuts import get_object_or_404
+
+from CycleCounter.db_router import replica_reads
+from cyclecount.models import CountSession, FinalizeJob
+from cyclecount.review import proposed_modifications, individual_counts, filter_proposed_modifications, \
+    filter_individual_counts, ReviewQueryError, Sorters, Filters
+
+
+log = structlog.get_logger(__name__)
+
+
+'''
+Remote pagination for the two tables on the session review page (see session_review.html).
+
+Query string, as sent by Tabulator with paginationMode/sortMode/filterMode "remote":
+    page=1&size=100
+    sort[0][field]=variance&sort[0][dir]=desc
+    filter[0][field]=variance&filter[0][type]==&filter[0][value]=negative
+Response: {"last_page": 3, "data": [{...}, ...]}
+'''
+
+MAX_PAGE_SIZE = 1000
+
+TABULATOR_PARAM = re.compile(r'^(sort|filter)\[(\d+)]\[(\w+)]$')
+
+
+def tabulator_params(query: QueryDict) -> Tuple[Sorters, Filters]:
+    params: Dict[str, Dict[int, Dict[str, str]]] = {'sort': {}, 'filter': {}}
+    for (key, value) in query.items():
+        match = TABULATOR_PARAM.match(key)
+        if match:
+            (kind, index, attribute) = match.groups()
+            params[kind].setdefault(int(index), {})[attribute] = value
+    sorters = [(sort.get('field'), sort.get('dir')) for (_, sort) in sorted(params['sort'].items())]
+    # An emptied header filter means no filter
+    filters = {param['field']: param['value']
+               for param in params['filter'].values() if param.get('field') and param.get('value')}
+    return sorters, filters
+
+
+def _page(request: HttpRequest, session_id: int, rows: Callable[[CountSession], QuerySet],
+          filter_rows: Callable[[QuerySet, Filters, Sorters], QuerySet]) -> JsonResponse:
+    count_session = get_object_or_404(CountSession, pk=session_id)
+    try:
+        page = int(request.GET.get('page', 1))
+        size = min(int(request.GET.get('size', 100)), MAX_PAGE_SIZE)
+        if page < 1 or size < 1:
+            raise ValueError()
+    except ValueError:
+        return JsonResponse({'error': 'page and size must be positive integers'}, status=400)
+
+    sorters, filters = tabulator_params(request.GET)
+    try:
+        filtered_rows = filter_rows(rows(count_session), filters, sorters)
+    except ReviewQueryError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    start = size * (page - 1)
+    data: List[Dict] = list(filtered_rows[start:start + size])
+    # Only count when we can't tell from the page itself that it is the last one.
+    total_count = start + len(data) if len(data) < size and (data or page == 1) else filtered_rows.count()
+
+    log.info('session_review page', session_id=session_id, rows=rows.__name__, page=page, size=size,
+             sorters=sorters, filters=filters, returned_count=len(data), total_count=total_count)
+    return JsonResponse({'last_page': max(math.ceil(total_count / size), 1), 'data': data})
+
+
+@login_required
+@replica_reads
+def proposed_modifications_page(request: HttpRequest, session_id: int) -> JsonResponse:
+    # Filters: location_description, sku (contains), variance (positive | negative | zero)
+    return _page(request, session_id, proposed_modifications, filter_proposed_modifications)
+
+
+@login_required
+@replica_reads
+def individual_counts_page(request: HttpRequest, session_id: int) -> JsonResponse:
+    # Filters: username, state (exact), location_description, sku (contains)
+    return _page(request, session_id, individual_counts, filter_individual_counts)
+
+
+@login_required
+def finalize_status_json(request: HttpRequest, session_id: int) -> JsonResponse:
+    # Polled by finalize_status.html
+    job = get_object_or_404(FinalizeJob, session_id=session_id)
+    return JsonResponse({
+        'state': job.state,
+        'keys_total': job.keys_total,
+        'keys_done': job.keys_done,
+        'attempts': job.attempts,
+        'error': job.error,
+        'finished_at': job.finished_at,
+    })
@@ -1,23 +1,21 @@
-import operator
-from functools import reduce
-from typing import Tuple, Dict
-
 import structlog
 from django.contrib.auth.decorators import login_required
 from django.db import transaction
-from django.db.models import Q
 from django.http import HttpResponseRedirect, HttpRequest, HttpResponse, HttpResponseNotFound
 from django.shortcuts import render, get_object_or_404
 from django.urls import reverse
 from django.utils import timezone
 
-from cyclecount.models import CountSession, IndividualCount, Inventory, CycleCountModification
+from CycleCounter.db_router import replica_reads
+from cyclecount.finalize_jobs import enqueue_finalize
+from cyclecount.models import CountSession, FinalizeJob
 
 
 log = structlog.get_logger(__name__)
 
 
 @login_required
+@replica_reads
 def list_active_sessions(request: HttpRequest) -> HttpResponse:
     # Going to start with just getting sessions created by the user, once I decide
     # on how to approach multi-tenant, this will surely change.
@@ -27,45 +25,12 @@ def list_active_sessions(request: HttpRequest) -> HttpResponse:
 
 
 @login_required
+@replica_reads
 def session_review(request: HttpRequest, session_id: int) -> HttpResponse:
-    count_session = get_object_or_404(CountSession, pk=session_id)
-
-    individual_counts = (IndividualCount.objects
-                         .filter(session=count_session)
-                         .select_related('associate', 'location', 'product'))
-
-    # For each (location,product) get its current qty. Also roll up the count based on the cycle count.
-    location_quantities: Dict[Tuple[int, int], Dict] = {}
-    for individual_count in individual_counts:
-        key = (individual_count.location.id, individual_count.product.id)
-        if key not in location_quantities:
-            location_quantities[key] = {
-                'location': individual_count.location,
-                'product': individual_count.product,
-                'cyclecount_qty': 0,
-                'qty': 0
-            }
-        location_quantities[key]['cyclecount_qty'] += individual_count.qty
-
-    if location_quantities:  # We don't want to look up inventory if there are zero IndividualCounts
-        query = reduce(
-            operator.or_,
-            (Q(location_id=loc, product_id=prod) for (loc, prod) in location_quantities.keys())
-        )
-        for inventory in Inventory.objects.filter(query):
-            location_quantities[(inventory.location_id, inventory.product_id)]['qty'] = inventory.qty
-
-    log.info(
-        'session_review summary',
-        individual_counts_count=len(individual_counts),
-        location_quantities_count=len(location_quantities)
-    )
-    context = {
-        'count_session': count_session,
-        'location_quantities': location_quantities,
-        'individual_counts': individual_counts,
-    }
-    return render(request, 'cyclecount/session_review.html', context)
+    # Just the page shell, both tables load a page at a time from session_review_api so the page costs
+    # the same to render for 10 scans or 30k.
+    count_session = get_object_or_404(CountSession.objects.select_related('created_by'), pk=session_id)
+    return render(request, 'cyclecount/session_review.html', {'count_session': count_session})
 
 
 @login_required
@@ -83,33 +48,22 @@ def finalize_session(request: HttpRequest, session_id: int) -> HttpResponse:
         count_session_lock.final_state = request.POST['choice']
         count_session_lock.completed_by = current_user
         count_session_lock.final_state_datetime = timezone.now()
-        count_session_lock.save()
+        # Only the fields we changed, the counters are maintained by the scans.
+        count_session_lock.save(update_fields=['final_state', 'completed_by', 'final_state_datetime', 'updated_at'])
 
         if request.POST['choice'] == CountSession.FinalState.CANCELED:
             return HttpResponseRedirect(reverse('cyclecount:list_active_sessions'))
 
-        individual_counts = IndividualCount.objects.filter(session=count_session_lock)
-
-        # Modify inventory for everything in the session
-        location_quantities = {}
-        for individual_count in individual_counts:
-            key = (individual_count.location, individual_count.product)
-            if key not in location_quantities:
-                location_quantities[key] = 0
-            location_quantities[key] += 1
-
-        for (location, product) in location_quantities:
-            old_qty = 0
-            inventory = Inventory.objects.filter(location=location, product=product).first()
-            if inventory is None:
-                inventory = Inventory(location=location, product=product, qty=location_quantities[(location, product)])
-                inventory.save()
-            else:
-                old_qty = inventory.qty
-                inventory.qty = location_quantities[(location, product)]
-                inventory.save()
-
-            CycleCountModification(session=count_session_lock, location=location, product=product, old_qty=old_qty,
-                                   new_qty=inventory.qty, associate=current_user).save()
-
-    return HttpResponseRedirect(reverse('cyclecount:list_active_sessions'))
+        # Applying the counts to Inventory can take longer than a request should, manage.py finalize_worker does
+        # it. Queued in this transaction, so the job exists if and only if the session is accepted.
+        enqueue_finalize(count_session_lock, current_user)
+
+    return HttpResponseRedirect(reverse('cyclecount:finalize_status', args=(session_id,)))
+
+
+@login_required
+def finalize_status(request: HttpRequest, session_id: int) -> HttpResponse:
+    # Polls session_review_api.finalize_status_json until the worker is done. Not on the replica, the supervisor
+    # lands here straight after accepting the session.
+    job = get_object_or_404(FinalizeJob.objects.select_related('session'), session_id=session_id)
+    return render(request, 'cyclecount/finalize_status.html', {'job': job, 'count_session': job.session})
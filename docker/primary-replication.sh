@@ -0,0 +1,3 @@
+#!/bin/bash
+# Runs once when the db container initializes its volume: lets the replica service stream WAL from it.
+echo "host replication all all trust" >> "$PGDATA/pg_hba.conf"
@@ -0,0 +1,108 @@
+import csv
+import datetime
+import io
+import json
+import zlib
+from typing import Iterable, Iterator, Optional, Tuple
+
+import structlog
+from django.conf import settings
+
+from cyclecount.models import Inventory
+
+
+log = structlog.get_logger(__name__)
+
+'''
+Full table export of Inventory (with the location barcode and SKU joined in), for the nightly ERP reconciliation.
+
+Rows are read with QuerySet.iterator(), which on Postgres is a server-side cursor fetching chunk_size rows at a
+time, and written out as they arrive, so memory stays flat however big the table is. Used by the
+inventory_export view (StreamingHttpResponse) and manage.py export_inventory.
+'''
+
+COLUMNS = ('id', 'location', 'sku', 'qty', 'updated_at')
+FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+
+# (id, location description, sku, qty, updated_at)
+ExportRow = Tuple[int, str, str, int, datetime.datetime]
+
+
+def export_rows(location_prefix: Optional[str] = None, updated_since: Optional[datetime.datetime] = None,
+                chunk_size: Optional[int] = None) -> Iterator[ExportRow]:
+    inventory = Inventory.objects.all()
+    if location_prefix:
+        inventory = inventory.filter(location__description__startswith=location_prefix)
+    if updated_since is not None:
+        inventory = inventory.filter(updated_at__gte=updated_since)
+    rows = (inventory
+            .order_by('id')
+            .values_list('id', 'location__description', 'product__sku', 'qty', 'updated_at')
+            .iterator(chunk_size=chunk_size or settings.INVENTORY_EXPORT_CHUNK_SIZE))
+    count = 0
+    for row in rows:
+        count += 1
+        yield row
+    log.info('inventory export', location_prefix=location_prefix, updated_since=updated_since, row_count=count)
+
+
+def csv_lines(rows: Iterable[ExportRow]) -> Iterator[str]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def line(values) -> str:
+        # One line at a time, the buffer never holds more than that
+        writer.writerow(values)
+        value = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return value
+
+    yield line(COLUMNS)
+    for row in rows:
+        yield line((*row[:4], row[4].isoformat()))
+
+
+def ndjson_lines(rows: Iterable[ExportRow]) -> Iterator[str]:
+    for row in rows:
+        yield json.dumps(dict(zip(COLUMNS, (*row[:4], row[4].isoformat())))) + '\n'
+
+
+def encoded(lines: Iterable[str], batch_bytes: int = 64 * 1024) -> Iterator[bytes]:
+    # Individual lines are tiny, hand them on in batches of about batch_bytes
+    batch = []
+    size = 0
+    for line in lines:
+        data = line.encode()
+        batch.append(data)
+        size += len(data)
+        if size >= batch_bytes:
+            yield b''.join(batch)
+            batch = []
+            size = 0
+    if batch:
+        yield b''.join(batch)
+
+
+def gzipped(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    # A gzip stream (wbits 31 = gzip header and trailer), compressed as we go
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def export(export_format: str, gzip: bool = False, location_prefix: Optional[str] = None,
+           updated_since: Optional[datetime.datetime] = None, chunk_size: Optional[int] = None) -> Iterator[bytes]:
+    """
+    :return: the export as a stream of bytes chunks, nothing is read from the DB until it is iterated
+    """
+    rows = export_rows(location_prefix, updated_since, chunk_size)
+    lines = csv_lines(rows) if export_format == 'csv' else ndjson_lines(rows)
+    chunks = encoded(lines)
+    return gzipped(chunks) if gzip else chunks
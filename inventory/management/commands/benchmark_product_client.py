@@ -0,0 +1,51 @@
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+
+from inventory.product_client import ProductClient
+from inventory.product_service_stub import ProductServiceStub
+
+
+class Command(BaseCommand):
+    help = ('Compare per-product, concurrent fan-out and bulk ProductClient lookups for one inventory page, '
+            'against a local stub service')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--page-size', type=int, default=100)
+        parser.add_argument('--delay-ms', type=int, default=5, help='Artificial latency of each stub request')
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--concurrency', default='1,4,16,64',
+                            help='Comma separated max_in_flight values to try for the fan-out mode')
+
+    def handle(self, *args, **options):
+        page_size = options['page_size']
+        # Synthetic products, so the benchmark doesn't depend on what happens to be in the local DB.
+        products = {product_id: {'id': product_id, 'sku': f'sku-{product_id}', 'description': f'product {product_id}'}
+                    for product_id in range(1, page_size + 1)}
+        product_ids = list(products.keys())
+
+        modes = {
+            'per_product': (lambda client: [client.get_product(product_id) for product_id in product_ids], {}),
+        }
+        for max_in_flight in (int(value) for value in options['concurrency'].split(',')):
+            modes[f'fan_out_{max_in_flight}'] = (lambda client: client.get_products_concurrently(product_ids),
+                                                 {'max_in_flight': max_in_flight})
+        modes['bulk'] = (lambda client: client.get_products(product_ids), {'bulk_lookup': True})
+
+        stub = ProductServiceStub(products, port=0, delay_seconds=options['delay_ms'] / 1000).start_process()
+        try:
+            self.stdout.write(f'page_size={page_size} delay_ms={options["delay_ms"]} repeat={options["repeat"]}')
+            for (mode, (fetch, client_options)) in modes.items():
+                client = ProductClient(base_url=stub.url, **client_options)
+                requests_before = stub.request_count
+                timings = []
+                for _ in range(options['repeat']):
+                    start = time.perf_counter()
+                    fetch(client)
+                    timings.append(time.perf_counter() - start)
+                requests_per_page = (stub.request_count - requests_before) / options['repeat']
+                self.stdout.write(f'{mode:>14}: median_ms={statistics.median(timings) * 1000:.1f} '
+                                  f'max_ms={max(timings) * 1000:.1f} requests_per_page={requests_per_page:.0f}')
+        finally:
+            stub.stop()
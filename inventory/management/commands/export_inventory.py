@@ -0,0 +1,40 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_datetime
+
+from inventory.export import FORMATS, export
+
+
+class Command(BaseCommand):
+    help = 'Export the whole Inventory table (with location barcode and SKU) as CSV or NDJSON, streamed as it is read'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=list(FORMATS), default='csv')
+        parser.add_argument('--gzip', action='store_true')
+        parser.add_argument('--location-prefix', help='Only locations whose barcode starts with this')
+        parser.add_argument('--updated-since', help='Only inventory updated at or after this ISO 8601 datetime')
+        parser.add_argument('--chunk-size', type=int, help='Rows per fetch from the server-side cursor')
+        parser.add_argument('--output', help='File to write to, stdout when not given')
+
+    def handle(self, *args, **options):
+        updated_since = None
+        if options['updated_since']:
+            try:
+                updated_since = parse_datetime(options['updated_since'])
+            except ValueError:
+                pass
+            if updated_since is None:
+                raise CommandError('--updated-since must be an ISO 8601 datetime')
+
+        chunks = export(options['format'], gzip=options['gzip'], location_prefix=options['location_prefix'],
+                        updated_since=updated_since, chunk_size=options['chunk_size'])
+        output = open(options['output'], 'wb') if options['output'] else sys.stdout.buffer
+        try:
+            for chunk in chunks:
+                output.write(chunk)
+        finally:
+            if options['output']:
+                output.close()
+            else:
+                output.flush()
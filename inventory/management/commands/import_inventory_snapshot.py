@@ -0,0 +1,47 @@
+import gzip
+
+from django.core.management.base import BaseCommand, CommandError
+
+from cyclecount.models import CustomUser
+from inventory.snapshot_import import SnapshotImportError, import_snapshot
+
+
+class Command(BaseCommand):
+    help = ('Re-baseline Inventory from a WMS snapshot (CSV with location,sku,qty columns or NDJSON), '
+            'recording every change in CycleCountModification')
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Snapshot file, .gz files are decompressed')
+        parser.add_argument('--format', choices=['csv', 'ndjson'],
+                            help='Defaults to the file extension (.ndjson/.jsonl, otherwise csv)')
+        parser.add_argument('--associate', required=True, help='Username the changes are recorded under')
+        parser.add_argument('--partial', action='store_true',
+                            help="Only insert/update what is in the snapshot, don't delete the inventory it doesn't have")
+        parser.add_argument('--batch-size', type=int, default=50000, help='Changes applied per statement')
+        parser.add_argument('--dry-run', action='store_true', help='Report the changes without applying them')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        name = path[:-3] if path.endswith('.gz') else path
+        snapshot_format = options['format'] or ('ndjson' if name.endswith(('.ndjson', '.jsonl')) else 'csv')
+        try:
+            associate = CustomUser.objects.get(username=options['associate'])
+        except CustomUser.DoesNotExist:
+            raise CommandError(f'No user {options["associate"]}')
+
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'rt', newline='') as snapshot:
+            try:
+                result = import_snapshot(snapshot, snapshot_format, associate, full_snapshot=not options['partial'],
+                                         batch_size=options['batch_size'], dry_run=options['dry_run'])
+            except SnapshotImportError as e:
+                raise CommandError(str(e))
+
+        self.stdout.write(f'{result.rows} rows: {result.inserted} inserted, {result.updated} updated, '
+                          f'{result.deleted} deleted in {result.seconds}s'
+                          + (' (dry run, nothing applied)' if options['dry_run'] else
+                             f', recorded under CountSession {result.session_id}'))
+        if result.skipped:
+            self.stdout.write(f'{result.skipped} rows skipped: {result.unknown_locations} unknown locations '
+                              f'(e.g. {", ".join(result.unknown_samples["location"])}), {result.unknown_skus} '
+                              f'unknown skus (e.g. {", ".join(result.unknown_samples["sku"])})')
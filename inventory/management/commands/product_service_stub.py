@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from inventory.product_service_stub import ProductServiceStub, products_from_db
+
+
+class Command(BaseCommand):
+    help = 'Run a local stand-in for the product service, serving products from the local Product table'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--port', type=int, default=8001)
+        parser.add_argument('--delay-ms', type=int, default=0, help='Artificial latency added to every request')
+        parser.add_argument('--no-bulk', action='store_true', help='Behave like a deployment without ?ids= lookups')
+
+    def handle(self, *args, **options):
+        products = products_from_db()
+        stub = ProductServiceStub(products, port=options['port'], delay_seconds=options['delay_ms'] / 1000,
+                                  bulk_enabled=not options['no_bulk'])
+        self.stdout.write(f'Serving {len(products)} products on {stub.url} (Ctrl-C to stop)')
+        try:
+            stub.serve_forever()
+        except KeyboardInterrupt:
+            stub.server.server_close()
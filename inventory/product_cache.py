@@ -0,0 +1,183 @@
+import threading
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import Future
+from typing import Callable, Dict, Optional, Sequence, Tuple
+
+import structlog
+from django.conf import settings
+from django.core.cache import caches
+
+from inventory.product_client import ProductModel
+
+
+log = structlog.get_logger(__name__)
+
+# Stored (in both tiers) for products the service told us don't exist, so we don't ask again every page.
+NOT_FOUND = 'not-found'
+
+# Takes the ids that missed both tiers, returns id -> ProductModel, or None for a product that doesn't exist.
+# Ids left out of the result failed to load and are not cached.
+FetchProducts = Callable[[Sequence[int]], Dict[int, Optional[ProductModel]]]
+
+
+class ProductCache:
+    """
+    Two tier cache in front of the product service.
+
+    1. An in-process LRU with a TTL, checked without any I/O.
+    2. Optionally a shared tier through Django's cache framework, so a product one process (or worker) has
+       loaded doesn't have to be fetched by all the others.
+
+    Products that don't exist are cached as NOT_FOUND for a shorter TTL. Concurrent misses for the same id
+    are coalesced, only the first caller goes upstream and the others wait for its answer.
+    """
+
+    def __init__(self, max_entries: int = 10000, ttl_seconds: float = 300, negative_ttl_seconds: float = 60,
+                 shared_cache_alias: Optional[str] = None, coalesce_timeout_seconds: float = 10):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.negative_ttl_seconds = negative_ttl_seconds
+        self.shared_cache_alias = shared_cache_alias
+        self.coalesce_timeout_seconds = coalesce_timeout_seconds
+        self.stats: Counter = Counter()
+        self._entries: 'OrderedDict[int, Tuple[float, object]]' = OrderedDict()
+        self._in_flight: Dict[int, Future] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls) -> 'ProductCache':
+        return cls(max_entries=settings.PRODUCT_CACHE_MAX_ENTRIES,
+                   ttl_seconds=settings.PRODUCT_CACHE_TTL_SECONDS,
+                   negative_ttl_seconds=settings.PRODUCT_CACHE_NEGATIVE_TTL_SECONDS,
+                   shared_cache_alias=settings.PRODUCT_CACHE_SHARED_ALIAS)
+
+    @staticmethod
+    def _shared_key(product_id: int) -> str:
+        return f'product:{product_id}'
+
+    def _ttl(self, value: object) -> float:
+        return self.negative_ttl_seconds if value == NOT_FOUND else self.ttl_seconds
+
+    def _store_local(self, product_id: int, value: object, call_stats: Counter) -> None:
+        # Caller holds self._lock
+        self._entries[product_id] = (time.monotonic() + self._ttl(value), value)
+        self._entries.move_to_end(product_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            call_stats['evictions'] += 1
+
+    def get_many(self, product_ids: Sequence[int], fetch: FetchProducts) -> Dict[int, ProductModel]:
+        """
+        :return: the products that exist, keyed by id. Missing and failed ids are left out.
+        """
+        call_stats: Counter = Counter(requested=len(product_ids))
+        values: Dict[int, object] = {}
+
+        # Tier 1 - in process
+        misses = []
+        now = time.monotonic()
+        with self._lock:
+            for product_id in product_ids:
+                entry = self._entries.get(product_id)
+                if entry is not None and entry[0] > now:
+                    self._entries.move_to_end(product_id)
+                    values[product_id] = entry[1]
+                    call_stats['local_hits'] += 1
+                    call_stats['negative_hits'] += entry[1] == NOT_FOUND
+                else:
+                    misses.append(product_id)
+
+        # Tier 2 - shared
+        if misses and self.shared_cache_alias:
+            shared = caches[self.shared_cache_alias].get_many([self._shared_key(product_id) for product_id in misses])
+            with self._lock:
+                for product_id in misses:
+                    value = shared.get(self._shared_key(product_id))
+                    if value is not None:
+                        values[product_id] = value
+                        self._store_local(product_id, value, call_stats)
+                        call_stats['shared_hits'] += 1
+                        call_stats['negative_hits'] += value == NOT_FOUND
+            misses = [product_id for product_id in misses if product_id not in values]
+
+        # Upstream, but only for the ids nobody else is already fetching
+        owned: Dict[int, Future] = {}
+        waiting: Dict[int, Future] = {}
+        with self._lock:
+            for product_id in misses:
+                if product_id in self._in_flight:
+                    waiting[product_id] = self._in_flight[product_id]
+                else:
+                    owned[product_id] = self._in_flight[product_id] = Future()
+        call_stats['coalesced'] = len(waiting)
+        call_stats['fetched'] = len(owned)
+
+        if owned:
+            try:
+                fetched = fetch(list(owned.keys()))
+            except BaseException as e:
+                with self._lock:
+                    for product_id, future in owned.items():
+                        del self._in_flight[product_id]
+                        future.set_exception(e)
+                raise
+
+            to_share = {}
+            with self._lock:
+                for product_id, future in owned.items():
+                    del self._in_flight[product_id]
+                    if product_id not in fetched:
+                        call_stats['failed'] += 1
+                        future.set_result(None)
+                        continue
+                    value = fetched[product_id] if fetched[product_id] is not None else NOT_FOUND
+                    self._store_local(product_id, value, call_stats)
+                    to_share[product_id] = value
+                    values[product_id] = value
+                    future.set_result(value)
+            if to_share and self.shared_cache_alias:
+                shared_cache = caches[self.shared_cache_alias]
+                for ttl in {self._ttl(value) for value in to_share.values()}:
+                    shared_cache.set_many({self._shared_key(product_id): value
+                                           for (product_id, value) in to_share.items() if self._ttl(value) == ttl},
+                                          timeout=ttl)
+
+        for product_id, future in waiting.items():
+            try:
+                value = future.result(timeout=self.coalesce_timeout_seconds)
+            except Exception:
+                value = None
+            if value is not None:
+                values[product_id] = value
+
+        self.stats.update(call_stats)
+        log.info('product_cache', **call_stats, size=len(self._entries),
+                 total_local_hits=self.stats['local_hits'], total_shared_hits=self.stats['shared_hits'],
+                 total_fetched=self.stats['fetched'], total_evictions=self.stats['evictions'])
+        return {product_id: value for (product_id, value) in values.items() if value != NOT_FOUND}
+
+    def invalidate(self, product_id: int) -> None:
+        with self._lock:
+            self._entries.pop(product_id, None)
+        if self.shared_cache_alias:
+            caches[self.shared_cache_alias].delete(self._shared_key(product_id))
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+        self.stats.clear()
+
+
+_product_cache: Optional[ProductCache] = None
+_product_cache_lock = threading.Lock()
+
+
+def product_cache() -> ProductCache:
+    # One cache per process, shared by the ProductClient instances we create for each request.
+    global _product_cache
+    if _product_cache is None:
+        with _product_cache_lock:
+            if _product_cache is None:
+                _product_cache = ProductCache.from_settings()
+    return _product_cache
@@ -0,0 +1,172 @@
+import contextvars
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Iterable, Dict, Sequence, List, Tuple, TYPE_CHECKING
+
+import requests
+import structlog
+from django.conf import settings
+from pydantic import BaseModel
+
+if TYPE_CHECKING:
+    from inventory.product_cache import ProductCache
+
+
+log = structlog.get_logger(__name__)
+
+
+'''
+Contract with the product service (see also inventory/product_service_stub.py)
+
+Single product:
+    GET {PRODUCT_SERVICE_URL}/product/products/<id>/
+    200 -> {"id": 1, "sku": "...", "description": "..."}
+    404 -> unknown product
+
+Bulk lookup:
+    GET {PRODUCT_SERVICE_URL}/product/products/?ids=1,2,3
+    200 -> [{"id": 1, "sku": "...", "description": "..."}, ...]
+    Unknown ids are left out of the response rather than failing the whole request. A DRF style
+    paginated body ({"results": [...]}) is also accepted. The client never sends more than
+    PRODUCT_SERVICE_BULK_CHUNK_SIZE ids in one request, to keep the URL to a sane length.
+
+Deployments that don't implement the bulk lookup yet should run with PRODUCT_SERVICE_BULK_LOOKUP = False,
+get_products then fans out single product requests over a bounded thread pool instead.
+'''
+
+
+class ProductModel(BaseModel):
+    id: int
+    sku: str
+    description: str
+
+
+class ProductClient:
+    def __init__(self, base_url: Optional[str] = None, chunk_size: Optional[int] = None,
+                 bulk_lookup: Optional[bool] = None, max_in_flight: Optional[int] = None,
+                 timeout: Optional[float] = None, cache: Optional['ProductCache'] = None):
+        # logging.basicConfig(level=logging.DEBUG)
+        self.s = requests.Session()
+        # Experimenting with an adapter to control retry behavior.
+        # s.mount('http://', HTTPAdapter(max_retries=Retry(total=1)))
+        self.provenance_id = uuid.uuid1()
+        self.headers = {'X-Correlation-ID': str(self.provenance_id)}
+        self.base_url = base_url or settings.PRODUCT_SERVICE_URL
+        self.chunk_size = chunk_size or settings.PRODUCT_SERVICE_BULK_CHUNK_SIZE
+        self.bulk_lookup = settings.PRODUCT_SERVICE_BULK_LOOKUP if bulk_lookup is None else bulk_lookup
+        self.max_in_flight = max_in_flight or settings.PRODUCT_SERVICE_MAX_IN_FLIGHT
+        self.timeout = timeout or settings.PRODUCT_SERVICE_TIMEOUT_SECONDS
+        # Optional, the caller decides whether lookups go through a (process wide) ProductCache.
+        self.cache = cache
+        # requests.Session isn't documented as thread safe, so the fan-out workers each get their own. The pool
+        # (and its threads) only lasts for one fan out, _fan_out closes their sessions when it shuts down.
+        self._thread_local = threading.local()
+        self._thread_local.session = self.s
+        self._worker_sessions: List[requests.Session] = []
+        self._worker_sessions_lock = threading.Lock()
+
+    def _session(self) -> requests.Session:
+        session = getattr(self._thread_local, 'session', None)
+        if session is None:
+            session = self._thread_local.session = requests.Session()
+            with self._worker_sessions_lock:
+                self._worker_sessions.append(session)
+        return session
+
+    def _close_worker_sessions(self) -> None:
+        with self._worker_sessions_lock:
+            (sessions, self._worker_sessions) = (self._worker_sessions, [])
+        for session in sessions:
+            session.close()
+
+    def _lookup_product(self, product_id: int) -> Tuple[bool, Optional[ProductModel]]:
+        """
+        :return: (answered, product) - answered is False when we got no usable answer (timeout, 5xx),
+                 as opposed to the service telling us the product doesn't exist (404).
+        """
+        log.info('get_product', product_id=product_id, correlation_id=str(self.provenance_id))
+        # Todo - in order to play nice with the X-Request-ID in the logging framework
+        #  should I set a request header so retries are clearer ?
+        #  https://django-structlog.readthedocs.io/en/latest/events.html#django-s-requestmiddleware
+        try:
+            response = self._session().get(f'{self.base_url}/product/products/{product_id}/', headers=self.headers,
+                                           timeout=self.timeout)
+        except requests.RequestException as e:
+            # A slow or broken lookup costs us one blank SKU on the page, not the whole page.
+            log.warning('get_product failed', product_id=product_id, error=repr(e),
+                        correlation_id=str(self.provenance_id))
+            return False, None
+        if response.status_code == 200:
+            product = ProductModel(**response.json())
+            return True, product
+        return response.status_code == 404, None
+
+    def get_product(self, product_id: int) -> Optional[ProductModel]:
+        if self.cache is not None:
+            return self.cache.get_many([product_id], self._fetch_products_individually).get(product_id)
+        return self._lookup_product(product_id)[1]
+
+    def _fan_out(self, product_ids: Sequence[int]) -> List[Tuple[bool, Optional[ProductModel]]]:
+        if not product_ids:
+            return []
+        try:
+            with ThreadPoolExecutor(max_workers=min(self.max_in_flight, len(product_ids)),
+                                    thread_name_prefix='product-client') as executor:
+                # Each task runs in a copy of our context, so the structlog request_id follows it into the worker.
+                futures = [executor.submit(contextvars.copy_context().run, self._lookup_product, product_id)
+                           for product_id in product_ids]
+                # Collected in submission order, regardless of the order the requests complete in.
+                return [future.result() for future in futures]
+        finally:
+            # The workers are gone, otherwise their connection pools stay open until the GC gets to them
+            self._close_worker_sessions()
+
+    def get_products_concurrently(self, product_ids: Sequence[int]) -> List[Optional[ProductModel]]:
+        """
+        Fan out one get_product per id, with at most max_in_flight requests outstanding at once.
+        :return: a result for every id, in the same order as product_ids (None when not found or failed)
+        """
+        return [product for (_, product) in self._fan_out(product_ids)]
+
+    def _fetch_products_individually(self, product_ids: Sequence[int]) -> Dict[int, Optional[ProductModel]]:
+        return {product_id: product
+                for (product_id, (answered, product)) in zip(product_ids, self._fan_out(product_ids)) if answered}
+
+    def _fetch_products_in_bulk(self, product_ids: Sequence[int]) -> Dict[int, Optional[ProductModel]]:
+        products: Dict[int, Optional[ProductModel]] = {}
+        for start in range(0, len(product_ids), self.chunk_size):
+            chunk = product_ids[start:start + self.chunk_size]
+            log.info('get_products', product_count=len(chunk), correlation_id=str(self.provenance_id))
+            try:
+                response = self._session().get(f'{self.base_url}/product/products/',
+                                               params={'ids': ','.join(str(product_id) for product_id in chunk)},
+                                               headers=self.headers, timeout=self.timeout)
+            except requests.RequestException as e:
+                log.warning('get_products failed', error=repr(e), product_count=len(chunk),
+                            correlation_id=str(self.provenance_id))
+                continue
+            if response.status_code != 200:
+                log.warning('get_products failed', status_code=response.status_code, product_count=len(chunk),
+                            correlation_id=str(self.provenance_id))
+                continue
+
+            # Ids the service left out of a successful response don't exist.
+            products.update((product_id, None) for product_id in chunk)
+            body = response.json()
+            for product_json in (body['results'] if isinstance(body, dict) else body):
+                product = ProductModel(**product_json)
+                products[product.id] = product
+        return products
+
+    def get_products(self, product_ids: Iterable[int]) -> Dict[int, ProductModel]:
+        """
+        Look up many products with one request per chunk of ids, instead of one request per product.
+        Falls back to concurrent single product requests when bulk_lookup is disabled.
+        :return: the products that were found, keyed by id
+        """
+        unique_ids = sorted(set(product_ids))
+        fetch = self._fetch_products_in_bulk if self.bulk_lookup else self._fetch_products_individually
+        if self.cache is not None:
+            return self.cache.get_many(unique_ids, fetch)
+        return {product_id: product for (product_id, product) in fetch(unique_ids).items() if product is not None}
@@ -0,0 +1,136 @@
+import json
+import multiprocessing
+import sys
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Dict, Optional
+from urllib.parse import urlsplit, parse_qs
+
+import structlog
+
+from cyclecount.models import Product
+
+
+log = structlog.get_logger(__name__)
+
+
+class StubHTTPServer(ThreadingHTTPServer):
+    # The default listen backlog of 5 drops connections under a concurrent fan-out, which shows up as
+    # one second SYN retransmits in the benchmark rather than anything the client did.
+    request_queue_size = 128
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # A client that timed out and hung up on a delayed response is expected here, not worth a traceback.
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class ProductServiceStub:
+    """
+    Local stand-in for the product service on :8001, implementing the contract documented in
+    inventory/product_client.py. Serves products from an in-memory dict, with an optional artificial
+    delay per request so we can measure how the inventory grid behaves against a slow network.
+    """
+
+    def __init__(self, products: Dict[int, dict], host: str = '127.0.0.1', port: int = 8001,
+                 delay_seconds: float = 0.0, bulk_enabled: bool = True):
+        self.products = products
+        self.delay_seconds = delay_seconds
+        self.bulk_enabled = bulk_enabled
+        # Shared memory, so the count is still visible to the parent when serving from a forked process.
+        self._request_count = multiprocessing.get_context('fork').Value('i', 0)
+        self._thread: Optional[threading.Thread] = None
+        self._process: Optional[multiprocessing.Process] = None
+        self.server = StubHTTPServer((host, port), self._handler_class())
+
+    @property
+    def request_count(self) -> int:
+        return self._request_count.value
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def _handler_class(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                with stub._request_count.get_lock():
+                    stub._request_count.value += 1
+                if stub.delay_seconds:
+                    time.sleep(stub.delay_seconds)
+
+                url = urlsplit(self.path)
+                parts = [part for part in url.path.split('/') if part]
+                if parts[:2] != ['product', 'products'] or len(parts) > 3:
+                    return self._send(404, {'detail': 'Not found.'})
+
+                if len(parts) == 3:
+                    product = stub.products.get(int(parts[2])) if parts[2].isdigit() else None
+                    if product is None:
+                        return self._send(404, {'detail': 'Not found.'})
+                    return self._send(200, product)
+
+                ids = parse_qs(url.query).get('ids')
+                if not stub.bulk_enabled or not ids:
+                    return self._send(404, {'detail': 'Not found.'})
+                product_ids = [int(product_id) for product_id in ids[0].split(',') if product_id]
+                return self._send(200, [stub.products[product_id] for product_id in product_ids
+                                        if product_id in stub.products])
+
+            def _send(self, status: int, body) -> None:
+                payload = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                # The default handler writes every request to stderr, which swamps benchmark output.
+                pass
+
+        return Handler
+
+    def serve_forever(self) -> None:
+        log.info('product_service_stub started', url=self.url, product_count=len(self.products),
+                 delay_seconds=self.delay_seconds, bulk_enabled=self.bulk_enabled)
+        self.server.serve_forever()
+
+    def start(self) -> 'ProductServiceStub':
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def start_process(self) -> 'ProductServiceStub':
+        # Serving from a background thread shares the GIL with the client under test, which flattens any
+        # concurrency benchmark. A forked process inherits the already listening socket instead.
+        self._process = multiprocessing.get_context('fork').Process(target=self.serve_forever, daemon=True)
+        self._process.start()
+        return self
+
+    def stop(self) -> None:
+        if self._process:
+            self._process.terminate()
+            self._process.join()
+        else:
+            self.server.shutdown()
+        self.server.server_close()
+        if self._thread:
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+
+def products_from_db() -> Dict[int, dict]:
+    # While we are in the dual state of having a local Product table AND a product service,
+    # the local table is the obvious source of data for the stand-in.
+    return {product['id']: product for product in Product.objects.values('id', 'sku', 'description').iterator()}
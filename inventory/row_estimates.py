@@ -0,0 +1,45 @@
+import structlog
+from django.core.cache import cache
+from django.db import connections, router
+from django.db.models import Model
+from typing import Type
+
+
+log = structlog.get_logger(__name__)
+
+# Below this many rows an exact COUNT(*) is cheap, and the planner estimate is too coarse to drive
+# pagination (reltuples is -1 until the table has been vacuumed/analyzed).
+EXACT_COUNT_THRESHOLD = 10000
+# How long a large table's row estimate is reused before asking the planner again.
+ESTIMATE_CACHE_SECONDS = 60
+
+
+def planner_row_estimate(model: Type[Model]) -> int:
+    # pg_class.reltuples is maintained by VACUUM/ANALYZE (autovacuum), reading it is a single catalog lookup.
+    # Asks whichever database the model's reads go to (the replica from the read only views).
+    with connections[router.db_for_read(model)].cursor() as cursor:
+        cursor.execute('SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass', [model._meta.db_table])
+        row = cursor.fetchone()
+    return row[0] if row else -1
+
+
+def estimated_row_count(model: Type[Model]) -> int:
+    """
+    Total row count for pagination, without paying for a COUNT(*) on every request.
+
+    Small tables get an exact count. Large tables use the planner's estimate, cached for
+    ESTIMATE_CACHE_SECONDS so most requests don't touch the DB at all.
+    """
+    cache_key = f'row_estimate:{model._meta.db_table}'
+    cached_estimate = cache.get(cache_key)
+    if cached_estimate is not None:
+        return cached_estimate
+
+    estimate = planner_row_estimate(model)
+    if estimate < EXACT_COUNT_THRESHOLD:
+        # Not cached, a small table can change size noticeably between requests.
+        return model.objects.count()
+
+    log.info('row_estimate refreshed', table=model._meta.db_table, estimate=estimate)
+    cache.set(cache_key, estimate, ESTIMATE_CACHE_SECONDS)
+    return estimate
@@ -0,0 +1,235 @@
+import csv
+import time
+from typing import Dict, IO, List, NamedTuple, Optional
+
+import psycopg2
+import structlog
+from django.db import DataError, connection, transaction
+from django.utils import timezone
+
+from cyclecount.models import CountSession, CustomUser
+
+
+log = structlog.get_logger(__name__)
+
+'''
+Re-baseline Inventory from a WMS snapshot of (location barcode, sku, qty), CSV or NDJSON.
+
+Everything is set based, nothing goes through the ORM row by row:
+1. COPY the file into a temp table as is (CSV columns by header, NDJSON a line per row)
+2. Resolve barcodes to ids with joins against Location/Product, rows with an unknown barcode are reported and skipped
+3. Diff against Inventory into a temp table: inserts, qty updates and (for a full snapshot) deletes of inventory
+   the snapshot doesn't have
+4. Apply the diff batch_size rows at a time, recording every change in CycleCountModification like finalize does.
+   The ledger needs a session, so each import gets one: created and accepted by the importing user, with no scans.
+
+It all runs in one transaction holding a lock on Inventory that keeps sessions from finalizing in the meantime
+(readers aren't blocked), a failed import changes nothing. The CSV export from inventory.export can be imported.
+'''
+
+REQUIRED_COLUMNS = ('location', 'sku', 'qty')
+
+DROP_TEMP_TABLES_SQL = '''
+DROP TABLE IF EXISTS pg_temp.snapshot, pg_temp.snapshot_columns, pg_temp.snapshot_lines, pg_temp.snapshot_resolved,
+                     pg_temp.snapshot_diff
+'''
+
+# NDJSON lines are COPYed whole into a single text column, with quote/delimiter characters that can't appear in
+# JSON text so COPY leaves them alone.
+COPY_NDJSON_SQL = "COPY snapshot_lines (line) FROM STDIN WITH (FORMAT csv, QUOTE e'\\x01', DELIMITER e'\\x02')"
+
+NDJSON_ROWS_SQL = '''
+INSERT INTO snapshot (location, sku, qty)
+SELECT doc->>'location', doc->>'sku', (doc->>'qty')::integer
+FROM (SELECT line::jsonb AS doc FROM snapshot_lines WHERE line <> '') lines
+'''
+
+CHECK_SNAPSHOT_SQL = '''
+SELECT
+    (SELECT COUNT(*) FROM snapshot),
+    (SELECT COUNT(*) FROM snapshot WHERE location IS NULL OR sku IS NULL OR qty IS NULL OR qty < 0),
+    (SELECT COUNT(*) FROM (SELECT 1 FROM snapshot GROUP BY location, sku HAVING COUNT(*) > 1) duplicates)
+'''
+
+RESOLVE_SQL = '''
+CREATE TEMP TABLE snapshot_resolved ON COMMIT DROP AS
+SELECT s.location, s.sku, s.qty, l.id AS location_id, p.id AS product_id
+FROM snapshot s
+LEFT JOIN cyclecount_location l ON l.description = s.location
+LEFT JOIN cyclecount_product p ON p.sku = s.sku
+'''
+
+UNKNOWN_BARCODES_SQL = '''
+SELECT 'location', location FROM (SELECT DISTINCT location FROM snapshot_resolved WHERE location_id IS NULL
+                                  ORDER BY location LIMIT %(sample)s) locations
+UNION ALL
+SELECT 'sku', sku FROM (SELECT DISTINCT sku FROM snapshot_resolved WHERE product_id IS NULL
+                        ORDER BY sku LIMIT %(sample)s) skus
+'''
+
+UNKNOWN_COUNTS_SQL = '''
+SELECT COUNT(*) FILTER (WHERE location_id IS NULL), COUNT(*) FILTER (WHERE product_id IS NULL),
+       COUNT(*) FILTER (WHERE location_id IS NULL OR product_id IS NULL)
+FROM snapshot_resolved
+'''
+
+# new_qty is NULL for a delete, inventory_id is NULL for an insert
+DIFF_SQL = '''
+CREATE TEMP TABLE snapshot_diff ON COMMIT DROP AS
+SELECT row_number() OVER (ORDER BY location_id, product_id) AS n, changes.*
+FROM (
+    SELECT r.location_id, r.product_id, i.id AS inventory_id, COALESCE(i.qty, 0) AS old_qty, r.qty AS new_qty
+    FROM snapshot_resolved r
+    LEFT JOIN cyclecount_inventory i ON i.location_id = r.location_id AND i.product_id = r.product_id
+    WHERE r.location_id IS NOT NULL AND r.product_id IS NOT NULL AND (i.id IS NULL OR i.qty <> r.qty)
+    UNION ALL
+    SELECT i.location_id, i.product_id, i.id, i.qty, NULL
+    FROM cyclecount_inventory i
+    WHERE %(full_snapshot)s AND NOT EXISTS (
+        SELECT 1 FROM snapshot_resolved r WHERE r.location_id = i.location_id AND r.product_id = i.product_id
+    )
+) changes
+'''
+
+DIFF_COUNTS_SQL = '''
+SELECT COUNT(*) FILTER (WHERE inventory_id IS NULL),
+       COUNT(*) FILTER (WHERE inventory_id IS NOT NULL AND new_qty IS NOT NULL),
+       COUNT(*) FILTER (WHERE new_qty IS NULL)
+FROM snapshot_diff
+'''
+
+APPLY_BATCH_SQL = '''
+WITH batch AS (
+    SELECT * FROM snapshot_diff WHERE n > %(start)s AND n <= %(stop)s
+), deleted AS (
+    DELETE FROM cyclecount_inventory i USING batch
+    WHERE batch.new_qty IS NULL AND i.id = batch.inventory_id
+), updated AS (
+    UPDATE cyclecount_inventory i SET qty = batch.new_qty, updated_at = %(now)s
+    FROM batch
+    WHERE batch.inventory_id IS NOT NULL AND batch.new_qty IS NOT NULL AND i.id = batch.inventory_id
+), inserted AS (
+    INSERT INTO cyclecount_inventory (location_id, product_id, qty, created_at, updated_at)
+    SELECT location_id, product_id, new_qty, %(now)s, %(now)s FROM batch WHERE inventory_id IS NULL
+)
+INSERT INTO cyclecount_cyclecountmodification (session_id, location_id, product_id, old_qty, new_qty, associate_id,
+                                               created_at, updated_at)
+SELECT %(session_id)s, location_id, product_id, old_qty, COALESCE(new_qty, 0), %(associate_id)s, %(now)s, %(now)s
+FROM batch
+'''
+
+
+class SnapshotImportError(ValueError):
+    pass
+
+
+class SnapshotImportResult(NamedTuple):
+    # The CountSession the CycleCountModification records are under, None for a dry run
+    session_id: Optional[int]
+    rows: int
+    unknown_locations: int
+    unknown_skus: int
+    # Rows skipped because either barcode is unknown
+    skipped: int
+    # A few of the unknown barcodes, e.g. {'location': ['Z-001'], 'sku': []}
+    unknown_samples: Dict[str, List[str]]
+    inserted: int
+    updated: int
+    deleted: int
+    seconds: float
+
+
+def _copy_csv(cursor, snapshot: IO[str]) -> None:
+    header = [column.strip().lower() for column in next(csv.reader([snapshot.readline()]), [])]
+    missing = [column for column in REQUIRED_COLUMNS if column not in header]
+    if missing:
+        raise SnapshotImportError(f'CSV header is missing {", ".join(missing)} (got {", ".join(header)})')
+    # Every column of the file lands as text, only the ones we need are read out of it
+    cursor.execute(f'CREATE TEMP TABLE snapshot_columns ({", ".join(f"c{i} text" for i in range(len(header)))}) '
+                   f'ON COMMIT DROP')
+    cursor.copy_expert('COPY snapshot_columns FROM STDIN WITH (FORMAT csv)', snapshot)
+    (location, sku, qty) = (f'c{header.index(column)}' for column in REQUIRED_COLUMNS)
+    cursor.execute(f'INSERT INTO snapshot (location, sku, qty) '
+                   f'SELECT {location}, {sku}, {qty}::integer FROM snapshot_columns')
+
+
+def _copy_ndjson(cursor, snapshot: IO[str]) -> None:
+    cursor.execute('CREATE TEMP TABLE snapshot_lines (line text) ON COMMIT DROP')
+    cursor.copy_expert(COPY_NDJSON_SQL, snapshot)
+    cursor.execute(NDJSON_ROWS_SQL)
+
+
+def _load(cursor, snapshot: IO[str], snapshot_format: str) -> int:
+    # Left over from an earlier import in the same transaction (ON COMMIT DROP only drops them at the commit)
+    cursor.execute(DROP_TEMP_TABLES_SQL)
+    cursor.execute('CREATE TEMP TABLE snapshot (location text, sku text, qty integer) ON COMMIT DROP')
+    try:
+        if snapshot_format == 'csv':
+            _copy_csv(cursor, snapshot)
+        else:
+            _copy_ndjson(cursor, snapshot)
+    except (DataError, psycopg2.DataError) as e:
+        # Malformed CSV/JSON or a qty that isn't a number
+        raise SnapshotImportError(f'Could not read the snapshot: {e}') from e
+
+    cursor.execute(CHECK_SNAPSHOT_SQL)
+    (rows, invalid, duplicates) = cursor.fetchone()
+    if invalid:
+        raise SnapshotImportError(f'{invalid} rows are missing location/sku/qty or have a negative qty')
+    if duplicates:
+        raise SnapshotImportError(f'{duplicates} location/sku pairs appear more than once')
+    # Temp tables aren't analyzed by autovacuum, without stats the planner guesses badly at a million rows
+    cursor.execute('ANALYZE snapshot')
+    return rows
+
+
+def import_snapshot(snapshot: IO[str], snapshot_format: str, associate: CustomUser, full_snapshot: bool = True,
+                    batch_size: int = 50000, dry_run: bool = False, sample_size: int = 5) -> SnapshotImportResult:
+    """
+    :param full_snapshot: the snapshot is all of the inventory, anything not in it is deleted. Otherwise only what
+                          is in the snapshot is inserted/updated.
+    :param dry_run: work out the changes, then roll back
+    """
+    started = time.perf_counter()
+    with transaction.atomic(), connection.cursor() as cursor:
+        rows = _load(cursor, snapshot, snapshot_format)
+
+        cursor.execute(RESOLVE_SQL)
+        cursor.execute('ANALYZE snapshot_resolved')
+        cursor.execute(UNKNOWN_COUNTS_SQL)
+        (unknown_locations, unknown_skus, skipped) = cursor.fetchone()
+        cursor.execute(UNKNOWN_BARCODES_SQL, {'sample': sample_size})
+        unknown_samples: Dict[str, List[str]] = {'location': [], 'sku': []}
+        for (kind, barcode) in cursor.fetchall():
+            unknown_samples[kind].append(barcode)
+
+        # Sessions finalizing now would write Inventory under the diff, they wait for us instead (reads don't).
+        cursor.execute('LOCK TABLE cyclecount_inventory IN SHARE ROW EXCLUSIVE MODE')
+        cursor.execute(DIFF_SQL, {'full_snapshot': full_snapshot})
+        cursor.execute('CREATE INDEX ON snapshot_diff (n)')
+        cursor.execute(DIFF_COUNTS_SQL)
+        (inserted, updated, deleted) = cursor.fetchone()
+        changes = inserted + updated + deleted
+
+        session_id = None
+        if not dry_run:
+            now = timezone.now()
+            count_session = CountSession.objects.create(
+                created_by=associate, completed_by=associate, final_state=CountSession.FinalState.ACCEPTED,
+                final_state_datetime=now)
+            session_id = count_session.id
+            for start in range(0, changes, batch_size):
+                cursor.execute(APPLY_BATCH_SQL, {'start': start, 'stop': start + batch_size, 'now': now,
+                                                 'session_id': session_id, 'associate_id': associate.id})
+                log.info('snapshot_import batch', session_id=session_id, applied=min(start + batch_size, changes),
+                         changes=changes)
+
+        result = SnapshotImportResult(
+            session_id=session_id, rows=rows, unknown_locations=unknown_locations, unknown_skus=unknown_skus,
+            skipped=skipped, unknown_samples=unknown_samples, inserted=inserted, updated=updated, deleted=deleted,
+            seconds=round(time.perf_counter() - started, 2))
+        if dry_run:
+            transaction.set_rollback(True)
+
+    log.info('snapshot_import', dry_run=dry_run, full_snapshot=full_snapshot, **result._asdict())
+    return result
@@ -1,10 +1,27 @@
-from django.test import TestCase
+import csv
+import gzip
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import TestCase, SimpleTestCase
 from django.urls import reverse
 
+from .product_cache import ProductCache, product_cache
+from .product_client import ProductClient
+from .product_service_stub import ProductServiceStub
+from .row_estimates import estimated_row_count
+from .snapshot_import import SnapshotImportError, import_snapshot
 from .views import ProductModel
-from cyclecount.models import Location, Product, Inventory
-from typing import Optional
-from unittest.mock import patch, call
+from cyclecount.models import Location, Product, Inventory, CustomUser, CountSession, CycleCountModification
+from typing import Optional, Iterable, Dict
+from unittest.mock import patch
 
 
 class MockResponse:
@@ -23,6 +40,15 @@ def mocked_request_get(product_id: int) -> Optional[ProductModel]:
     return None
 
 
+def mocked_request_get_products(product_ids: Iterable[int]) -> Dict[int, ProductModel]:
+    products = {}
+    for product_id in product_ids:
+        product = mocked_request_get(product_id)
+        if product:
+            products[product_id] = product
+    return products
+
+
 class InventoryTests(TestCase):
     location_00_empty = None
     location_01 = None
@@ -78,11 +104,11 @@ class InventoryTests(TestCase):
         inv01 = Inventory(location=self.location_01, product=self.product_01, qty=5)
         inv01.save()
 
-        with patch('inventory.views.ProductClient.get_product', side_effect=mocked_request_get) as mock_method:
+        with patch('inventory.views.ProductClient.get_products', side_effect=mocked_request_get_products) as mock_method:
             url = reverse('inventory:inventory_table_api')
             response = self.client.get(url, {'page': 1, 'size': 10})
 
-        mock_method.assert_called_once_with(self.product_01.id)
+        mock_method.assert_called_once_with({self.product_01.id})
         self.assertEqual(response.status_code, 200)
         expected_result = {"last_page": 1, "data": [
             {'id': inv01.id, 'location': inv01.location.description, 'sku': inv01.product.sku, 'qty': inv01.qty},
@@ -95,14 +121,334 @@ class InventoryTests(TestCase):
         inv02 = Inventory(location=self.location_02, product=self.product_02, qty=1)
         inv02.save()
 
-        with patch('inventory.views.ProductClient.get_product', side_effect=mocked_request_get) as mock_method:
+        with patch('inventory.views.ProductClient.get_products', side_effect=mocked_request_get_products) as mock_method:
             url = reverse('inventory:inventory_table_api')
             response = self.client.get(url, {'page': 1, 'size': 10})
 
-        mock_method.assert_has_calls([call(self.product_01.id), call(self.product_02.id)])
+        # A single bulk lookup for the whole page, rather than a request per row
+        mock_method.assert_called_once_with({self.product_01.id, self.product_02.id})
         self.assertEqual(response.status_code, 200)
         expected_result = {"last_page": 1, "data": [
             {'id': inv01.id, 'location': inv01.location.description, 'sku': inv01.product.sku, 'qty': inv01.qty},
             {'id': inv02.id, 'location': inv02.location.description, 'sku': None, 'qty': inv02.qty},
         ]}
-        self.assertJSONEqual(response.content, expected_result)
\ No newline at end of file
+        self.assertJSONEqual(response.content, expected_result)
+
+    def test_inventory_table_cursor_pagination(self):
+        inventory = [Inventory(location=location, product=self.product_01, qty=i)
+                     for (i, location) in enumerate((self.location_00_empty, self.location_01, self.location_02))]
+        Inventory.objects.bulk_create(inventory)
+
+        url = reverse('inventory:inventory_table_db')
+        response = self.client.get(url, {'after_id': 0, 'size': 2})
+        self.assertEqual(response.status_code, 200)
+        first_page = response.json()
+        self.assertEqual(2, first_page['last_page'])
+        self.assertEqual([inventory[0].id, inventory[1].id], [record['id'] for record in first_page['data']])
+        self.assertEqual(inventory[1].id, first_page['next_cursor'])
+        self.assertIsNone(first_page['prev_cursor'])
+
+        response = self.client.get(url, {'after_id': first_page['next_cursor'], 'size': 2})
+        second_page = response.json()
+        self.assertEqual([inventory[2].id], [record['id'] for record in second_page['data']])
+        self.assertIsNone(second_page['next_cursor'])
+        self.assertEqual(inventory[2].id, second_page['prev_cursor'])
+
+        response = self.client.get(url, {'before_id': second_page['prev_cursor'], 'size': 2})
+        back_page = response.json()
+        self.assertEqual([inventory[0].id, inventory[1].id], [record['id'] for record in back_page['data']])
+        self.assertEqual((inventory[1].id, None), (back_page['next_cursor'], back_page['prev_cursor']))
+
+    def test_inventory_table_cursor_pagination_before_id(self):
+        inventory = [Inventory(location=location, product=self.product_01, qty=i)
+                     for (i, location) in enumerate((self.location_00_empty, self.location_01, self.location_02))]
+        Inventory.objects.bulk_create(inventory)
+        url = reverse('inventory:inventory_table_db')
+
+        # Paging backwards from the end, the last page back is short but still has rows after it
+        response = self.client.get(url, {'before_id': inventory[2].id + 1, 'size': 2})
+        last_page = response.json()
+        self.assertEqual([inventory[1].id, inventory[2].id], [record['id'] for record in last_page['data']])
+        self.assertEqual((None, inventory[1].id), (last_page['next_cursor'], last_page['prev_cursor']))
+
+        response = self.client.get(url, {'before_id': last_page['prev_cursor'], 'size': 2})
+        first_page = response.json()
+        self.assertEqual([inventory[0].id], [record['id'] for record in first_page['data']])
+        self.assertEqual((inventory[0].id, None), (first_page['next_cursor'], first_page['prev_cursor']))
+
+        # And forward again from there
+        response = self.client.get(url, {'after_id': first_page['next_cursor'], 'size': 2})
+        self.assertEqual([inventory[1].id, inventory[2].id], [record['id'] for record in response.json()['data']])
+
+    def test_product_save_and_delete_invalidate_product_cache(self):
+        self.addCleanup(product_cache().clear)
+        fetched = []
+
+        def fetch(product_ids):
+            fetched.extend(product_ids)
+            return {product_id: ProductModel(id=product_id, description='cached', sku='cached-sku')
+                    for product_id in product_ids}
+
+        product_id = self.product_01.id
+        product_cache().get_many([product_id], fetch)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product_01.description = 'test-product-01-renamed'
+            self.product_01.save()
+            # Not until the commit, a page still reading the old row would cache it again
+            product_cache().get_many([product_id], fetch)
+            self.assertEqual([product_id], fetched)
+        product_cache().get_many([product_id], fetch)
+        self.assertEqual([product_id] * 2, fetched)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product_01.delete()
+        product_cache().get_many([product_id], fetch)
+        self.assertEqual([product_id] * 3, fetched)
+
+    def test_estimated_row_count_uses_cached_planner_estimate(self):
+        self.addCleanup(cache.clear)
+        Inventory(location=self.location_01, product=self.product_01, qty=5).save()
+        self.assertEqual(1, estimated_row_count(Inventory))
+
+        with patch('inventory.row_estimates.planner_row_estimate', return_value=400000) as mock_estimate:
+            self.assertEqual(400000, estimated_row_count(Inventory))
+            self.assertEqual(400000, estimated_row_count(Inventory))
+        mock_estimate.assert_called_once_with(Inventory)
+
+
+class ProductClientTests(SimpleTestCase):
+    products = {
+        product_id: {'id': product_id, 'sku': f'test-sku-{product_id}', 'description': f'test-product-{product_id}'}
+        for product_id in range(1, 6)
+    }
+
+    def test_get_product(self):
+        with ProductServiceStub(self.products, port=0) as stub:
+            client = ProductClient(base_url=stub.url)
+            self.assertEqual(ProductModel(**self.products[2]), client.get_product(2))
+            self.assertIsNone(client.get_product(99))
+
+    def test_get_products_chunks_and_skips_unknown_ids(self):
+        with ProductServiceStub(self.products, port=0) as stub:
+            client = ProductClient(base_url=stub.url, chunk_size=2)
+            products = client.get_products([5, 1, 2, 2, 3, 99])
+
+            self.assertEqual(3, stub.request_count)  # 5 distinct ids, 2 per request
+        self.assertEqual({1, 2, 3, 5}, set(products.keys()))
+        self.assertEqual('test-sku-5', products[5].sku)
+
+    def test_get_products_without_bulk_endpoint(self):
+        with ProductServiceStub(self.products, port=0, bulk_enabled=False) as stub:
+            client = ProductClient(base_url=stub.url)
+            self.assertEqual({}, client.get_products([1, 2]))
+
+    def test_get_products_fan_out_when_bulk_lookup_disabled(self):
+        with ProductServiceStub(self.products, port=0, bulk_enabled=False) as stub:
+            client = ProductClient(base_url=stub.url, bulk_lookup=False, max_in_flight=3)
+            products = client.get_products([4, 1, 99, 1])
+
+            self.assertEqual(3, stub.request_count)  # one per distinct id
+        self.assertEqual({1, 4}, set(products.keys()))
+
+    def test_get_products_concurrently_keeps_order_and_times_out(self):
+        with ProductServiceStub(self.products, port=0) as stub:
+            client = ProductClient(base_url=stub.url, max_in_flight=4)
+            results = client.get_products_concurrently([3, 99, 1, 5, 2])
+            self.assertEqual([3, None, 1, 5, 2], [product.id if product else None for product in results])
+
+        with ProductServiceStub(self.products, port=0, delay_seconds=0.5) as stub:
+            client = ProductClient(base_url=stub.url, timeout=0.05)
+            self.assertEqual([None, None], client.get_products_concurrently([1, 2]))
+
+    def test_fan_out_closes_worker_sessions(self):
+        closed = []
+        with ProductServiceStub(self.products, port=0) as stub, \
+                patch('requests.Session.close', autospec=True, side_effect=closed.append):
+            client = ProductClient(base_url=stub.url, max_in_flight=3)
+            client.get_products_concurrently([1, 2, 3, 4, 5])
+            client.get_products_concurrently([1, 2])
+        # Every worker's session, but not the client's own
+        self.assertTrue(closed)
+        self.assertNotIn(client.s, closed)
+        self.assertEqual([], client._worker_sessions)
+
+
+class ProductCacheTests(SimpleTestCase):
+    products = ProductClientTests.products
+
+    def fetch(self, product_ids):
+        self.fetched.append(list(product_ids))
+        return {product_id: ProductModel(**self.products[product_id]) if product_id in self.products else None
+                for product_id in product_ids if product_id != 4}  # 4 fails to load
+
+    def setUp(self):
+        self.fetched = []
+
+    def test_local_hits_and_negative_caching(self):
+        product_cache = ProductCache()
+        self.assertEqual({1, 2}, set(product_cache.get_many([1, 2, 99], self.fetch).keys()))
+        self.assertEqual({1, 2}, set(product_cache.get_many([1, 2, 99], self.fetch).keys()))
+
+        self.assertEqual([[1, 2, 99]], self.fetched)  # 99 was remembered as not found
+        self.assertEqual(3, product_cache.stats['local_hits'])
+        self.assertEqual(1, product_cache.stats['negative_hits'])
+
+    def test_failures_are_not_cached(self):
+        product_cache = ProductCache()
+        self.assertEqual({}, product_cache.get_many([4], self.fetch))
+        self.assertEqual({}, product_cache.get_many([4], self.fetch))
+        self.assertEqual([[4], [4]], self.fetched)
+
+    def test_ttl_and_eviction(self):
+        product_cache = ProductCache(max_entries=2, ttl_seconds=0.05)
+        product_cache.get_many([1, 2, 3], self.fetch)
+        self.assertEqual(1, product_cache.stats['evictions'])
+        product_cache.get_many([3], self.fetch)
+        time.sleep(0.1)
+        product_cache.get_many([3], self.fetch)
+        self.assertEqual([[1, 2, 3], [3]], self.fetched)
+
+    def test_shared_tier(self):
+        self.addCleanup(cache.clear)
+        ProductCache(shared_cache_alias='default').get_many([1, 99], self.fetch)
+        other_process = ProductCache(shared_cache_alias='default')
+        self.assertEqual({1}, set(other_process.get_many([1, 99], self.fetch).keys()))
+        self.assertEqual([[1, 99]], self.fetched)
+        self.assertEqual(2, other_process.stats['shared_hits'])
+
+    def test_concurrent_misses_are_coalesced(self):
+        product_cache = ProductCache()
+        release = threading.Event()
+
+        def slow_fetch(product_ids):
+            release.wait(5)
+            return self.fetch(product_ids)
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            futures = [executor.submit(product_cache.get_many, [1], slow_fetch) for _ in range(4)]
+            time.sleep(0.1)
+            release.set()
+            results = [future.result() for future in futures]
+
+        self.assertEqual([[1]], self.fetched)
+        self.assertTrue(all(result[1].sku == 'test-sku-1' for result in results))
+        self.assertEqual(3, product_cache.stats['coalesced'])
+
+    def test_product_client_reads_through_cache(self):
+        with ProductServiceStub(self.products, port=0) as stub:
+            client = ProductClient(base_url=stub.url, cache=ProductCache())
+            client.get_products([1, 2, 99])
+            self.assertEqual({1, 2}, set(client.get_products([1, 2, 99]).keys()))
+            self.assertEqual('test-sku-2', client.get_product(2).sku)
+            self.assertEqual(1, stub.request_count)
+
+
+class InventoryExportTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        product = Product.objects.create(description='test-product-01', sku='test-sku-01')
+        locations = Location.objects.bulk_create([Location(description=f'{zone}-location-{i}')
+                                                  for zone in ('A', 'B') for i in range(3)])
+        Inventory.objects.bulk_create([Inventory(location=location, product=product, qty=i)
+                                       for (i, location) in enumerate(locations)])
+
+    def export(self, **params) -> bytes:
+        response = self.client.get(reverse('inventory:inventory_export'), params)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        return b''.join(response.streaming_content)
+
+    def test_csv(self):
+        rows = list(csv.reader(io.StringIO(self.export().decode())))
+        self.assertEqual(['id', 'location', 'sku', 'qty', 'updated_at'], rows[0])
+        self.assertEqual([['A-location-0', 'test-sku-01', '0'], ['B-location-2', 'test-sku-01', '5']],
+                         [rows[1][1:4], rows[-1][1:4]])
+        self.assertEqual(7, len(rows))
+
+    def test_ndjson_gzip_and_filters(self):
+        body = gzip.decompress(self.export(format='ndjson', gzip='1', location_prefix='B-'))
+        rows = [json.loads(line) for line in body.decode().splitlines()]
+        self.assertEqual(['B-location-0', 'B-location-1', 'B-location-2'], [row['location'] for row in rows])
+
+        Inventory.objects.filter(location__description='A-location-1').update(updated_at='2030-01-01T00:00:00Z')
+        body = self.export(format='ndjson', updated_since='2029-12-31T00:00:00Z')
+        self.assertEqual(['A-location-1'], [json.loads(line)['location'] for line in body.decode().splitlines()])
+
+    def test_bad_params(self):
+        url = reverse('inventory:inventory_export')
+        self.assertEqual(400, self.client.get(url, {'format': 'xml'}).status_code)
+        self.assertEqual(400, self.client.get(url, {'updated_since': 'yesterday'}).status_code)
+
+    def test_export_command(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'inventory.ndjson.gz')
+            call_command('export_inventory', '--format', 'ndjson', '--gzip', '--location-prefix', 'A-',
+                         '--chunk-size', '2', '--output', path)
+            with gzip.open(path) as f:
+                self.assertEqual(3, len(f.read().splitlines()))
+
+
+class SnapshotImportTests(TestCase):
+    user: CustomUser = None
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create_user('importer', 'importer@test.com', 'test-pw')
+        Product.objects.bulk_create([Product(description=f'product-{i}', sku=f'sku-{i}') for i in range(3)])
+        Location.objects.bulk_create([Location(description=f'location-{i}') for i in range(3)])
+        for (location, sku, qty) in (('location-0', 'sku-0', 5), ('location-0', 'sku-1', 2), ('location-1', 'sku-0', 7)):
+            Inventory.objects.create(location=Location.objects.get(description=location),
+                                     product=Product.objects.get(sku=sku), qty=qty)
+
+    def inventory(self):
+        return set(Inventory.objects.values_list('location__description', 'product__sku', 'qty'))
+
+    def test_full_snapshot_csv(self):
+        # Columns found by header, so the export can be imported as is
+        snapshot = io.StringIO('id,qty,location,sku\n'
+                               '1,5,location-0,sku-0\n'
+                               '2,9,location-1,sku-0\n'
+                               '3,1,location-2,sku-2\n'
+                               '4,1,location-9,sku-2\n'
+                               '5,1,location-2,sku-9\n')
+        result = import_snapshot(snapshot, 'csv', self.user)
+
+        self.assertEqual((5, 1, 1, 1, 1, 2), (result.rows, result.inserted, result.updated, result.deleted,
+                                              result.unknown_locations, result.skipped))
+        self.assertEqual({'location': ['location-9'], 'sku': ['sku-9']}, result.unknown_samples)
+        self.assertEqual({('location-0', 'sku-0', 5), ('location-1', 'sku-0', 9), ('location-2', 'sku-2', 1)},
+                         self.inventory())
+        ledger = set(CycleCountModification.objects.filter(session_id=result.session_id)
+                     .values_list('location__description', 'product__sku', 'old_qty', 'new_qty', 'associate'))
+        self.assertEqual({('location-1', 'sku-0', 7, 9, self.user.id), ('location-2', 'sku-2', 0, 1, self.user.id),
+                          ('location-0', 'sku-1', 2, 0, self.user.id)}, ledger)
+        self.assertEqual(CountSession.FinalState.ACCEPTED, CountSession.objects.get(pk=result.session_id).final_state)
+
+    def test_partial_ndjson_in_batches(self):
+        snapshot = io.StringIO('{"location": "location-2", "sku": "sku-1", "qty": 3}\n'
+                               '{"location": "location-2", "sku": "sku-2", "qty": 4}\n'
+                               '{"location": "location-0", "sku": "sku-0", "qty": 0}\n')
+        result = import_snapshot(snapshot, 'ndjson', self.user, full_snapshot=False, batch_size=1)
+
+        self.assertEqual((2, 1, 0), (result.inserted, result.updated, result.deleted))
+        self.assertEqual(3, CycleCountModification.objects.count())
+        self.assertIn(('location-0', 'sku-1', 2), self.inventory())
+        self.assertIn(('location-0', 'sku-0', 0), self.inventory())
+
+    def test_dry_run(self):
+        result = import_snapshot(io.StringIO('location,sku,qty\n'), 'csv', self.user, dry_run=True)
+        self.assertEqual((None, 3), (result.session_id, result.deleted))
+        self.assertEqual(3, Inventory.objects.count())
+        self.assertFalse(CycleCountModification.objects.exists())
+
+    def test_bad_snapshots(self):
+        for (snapshot_format, body) in (('csv', 'location,sku\nlocation-0,sku-0\n'),
+                                        ('csv', 'location,sku,qty\nlocation-0,sku-0,lots\n'),
+                                        ('csv', 'location,sku,qty\nlocation-0,sku-0,1\nlocation-0,sku-0,2\n'),
+                                        ('ndjson', '{"location": "location-0", "sku": "sku-0", "qty": -1}\n'),
+                                        ('ndjson', 'not json\n')):
+            with self.subTest(body=body):
+                with self.assertRaises(SnapshotImportError):
+                    import_snapshot(io.StringIO(body), snapshot_format, self.user)
+        self.assertEqual(3, Inventory.objects.count())
@@ -7,4 +7,5 @@ urlpatterns = [
     path('list-inventory/', views.list_inventory, name='list_inventory'),
     path('inventory-table-db/', views.inventory_table_from_db, name='inventory_table_db'),
     path('inventory-table-api/', views.inventory_table_from_product_svc, name='inventory_table_api'),
+    path('export/', views.inventory_export, name='inventory_export'),
 ]
\ No newline at end of file
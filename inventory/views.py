@@ -1,47 +1,24 @@
 import math
-import time
 import structlog
-import uuid
-from typing import Optional
+from typing import Tuple, List, Dict
 
-import requests
-from pydantic import BaseModel
-from django.http import HttpRequest, HttpResponse, JsonResponse
+from django.db.models import QuerySet
+from django.http import HttpRequest, HttpResponse, JsonResponse, StreamingHttpResponse
 from django.shortcuts import render
+from django.utils.dateparse import parse_datetime
 
+from CycleCounter.db_router import replica_reads
+from CycleCounter.perf import PerfTrack
 from cyclecount.models import Inventory
+from inventory.export import FORMATS, export
+from inventory.product_cache import product_cache
+from inventory.product_client import ProductClient, ProductModel
+from inventory.row_estimates import estimated_row_count
 
 
 log = structlog.get_logger(__name__)
 
 
-class ProductModel(BaseModel):
-    id: int
-    sku: str
-    description: str
-
-
-class ProductClient:
-    def __init__(self):
-        # logging.basicConfig(level=logging.DEBUG)
-        self.s = requests.Session()
-        # Experimenting with an adapter to control retry behavior.
-        # s.mount('http://', HTTPAdapter(max_retries=Retry(total=1)))
-        self.provenance_id = uuid.uuid1()
-        self.headers = {'X-Correlation-ID': str(self.provenance_id)}
-
-    def get_product(self, product_id: int) -> Optional[ProductModel]:
-        log.info('get_product', product_id=product_id, correlation_id=str(self.provenance_id))
-        # Todo - in order to play nice with the X-Request-ID in the logging framework
-        #  should I set a request header so retries are clearer ?
-        #  https://django-structlog.readthedocs.io/en/latest/events.html#django-s-requestmiddleware
-        response = self.s.get(f'http://127.0.0.1:8001/product/products/{product_id}/', headers=self.headers)
-        if response.status_code == 200:
-            product = ProductModel(**response.json())
-            return product
-        return None
-
-
 def list_inventory(request: HttpRequest) -> HttpResponse:
     return render(request, 'inventory/list_inventory.html', {})
 
@@ -56,76 +33,124 @@ Both of these should general equivalent results for calls made by the list_inven
 
 inventory_table_from_product_svc looks pretty unusual, but it is being used to experiment
 with the requests library (experimenting with sessions, logging, and error handling).
-The large number of small requests to the product service isn't the way I would solve
-the problem of list_inventory + pagination, but its a vehicle for experimentation.
+It started out making one small request to the product service per inventory row, it now
+makes a single bulk lookup per page (ProductClient.get_products).
 '''
 
 
-def inventory_table_from_db(request: HttpRequest) -> HttpResponse:
+def inventory_page(request: HttpRequest, inventory: QuerySet) -> Tuple[List[Inventory], Dict]:
+    """
+    Slice out one page of Inventory ordered by id, along with the pagination fields of the response.
 
-    page = int(request.GET.get('page')) - 1
+    Tabulator's remote pagination sends page/size, which we serve with OFFSET. Callers that walk the whole
+    table should send after_id/before_id (the next_cursor/prev_cursor of the previous response) instead,
+    which seeks on the primary key so deep pages cost the same as the first one.
+    """
     size = int(request.GET.get('size'))
-    log.info('pagination_details', page=page, size=size)
+    after_id = request.GET.get('after_id')
+    before_id = request.GET.get('before_id')
+
+    if after_id is not None:
+        records = list(inventory.filter(id__gt=int(after_id)).order_by('id')[:size])
+    elif before_id is not None:
+        records = list(inventory.filter(id__lt=int(before_id)).order_by('-id')[:size])
+        records.reverse()
+    else:
+        page = int(request.GET.get('page')) - 1
+        start = size * page
+        records = list(inventory.order_by('id')[start:start + size])
 
     with PerfTrack() as pt0:
-        inventory_count = Inventory.objects.count()
-
-    start = size * page
-    end = start + size
+        inventory_count = estimated_row_count(Inventory)
+    pagination = {'last_page': math.ceil(inventory_count / size)}
+    if after_id is not None or before_id is not None:
+        # records is in id order for both seeks. A cursor is only sent when there are rows on that side of the
+        # page, a short page isn't necessarily the end (before_id) and the first page has nothing before it.
+        has_next = bool(records) and inventory.filter(id__gt=records[-1].id).exists()
+        has_prev = bool(records) and inventory.filter(id__lt=records[0].id).exists()
+        pagination['next_cursor'] = records[-1].id if has_next else None
+        pagination['prev_cursor'] = records[0].id if has_prev else None
+
+    log.info('pagination_details', size=size, page=request.GET.get('page'), after_id=after_id,
+             before_id=before_id, returned_count=len(records), total_count=inventory_count,
+             sql_count_perf_ms=int(pt0.result * 1000))
+    return records, pagination
+
+
+@replica_reads
+def inventory_table_from_db(request: HttpRequest) -> HttpResponse:
 
     with PerfTrack() as pt1:
-        inventory = Inventory.objects.select_related('product', 'location').all().order_by('id')[start:end]
+        inventory, pagination = inventory_page(request, Inventory.objects.select_related('product', 'location'))
 
         inventory_records = []
         for inv in inventory:
             inventory_records.append({'id': inv.id, 'location': inv.location.description, 'sku': inv.product.sku, 'qty': inv.qty})
 
-    log.info('inventory DB results', returned_count=len(inventory_records), total_count=inventory_count, slice=f'{start}-{end}', sql_count_perf_ms=int(pt0.result * 1000), sql_perf_ms=int(pt1.result * 1000))
+    log.info('inventory DB results', returned_count=len(inventory_records), sql_perf_ms=int(pt1.result * 1000))
     result = {
-        'last_page': math.ceil(inventory_count / size),
+        **pagination,
         'data': inventory_records
     }
     return JsonResponse(result)
 
 
+@replica_reads
 def inventory_table_from_product_svc(request: HttpRequest) -> HttpResponse:
 
-    page = int(request.GET.get('page')) - 1
-    size = int(request.GET.get('size'))
-    log.info('pagination_details', page=page, size=size)
-
     with PerfTrack() as pt0:
-        inventory_count = Inventory.objects.count()
-
-    start = size * page
-    end = start + size
+        inventory, pagination = inventory_page(request, Inventory.objects.select_related('location'))
 
-    product_client = ProductClient()
+    # The client is per request, the cache it reads through is per process.
+    product_client = ProductClient(cache=product_cache())
 
     with PerfTrack() as pt1:
-        inventory = Inventory.objects.select_related('location').all().order_by('id')[start:end]
+        # One bulk lookup for the distinct products on the page, then join in memory.
+        products: Dict[int, ProductModel] = product_client.get_products({inv.product_id for inv in inventory})
 
         inventory_records = []
         for inv in inventory:
-            product_model = product_client.get_product(inv.product_id)
+            product_model = products.get(inv.product_id)
 
             if product_model:
                 inventory_records.append({'id': inv.id, 'location': inv.location.description, 'sku': product_model.sku, 'qty': inv.qty})
             else:
                 inventory_records.append({'id': inv.id, 'location': inv.location.description, 'sku': None, 'qty': inv.qty})
 
-    log.info('inventory API results', returned_count=len(inventory_records), total_count=inventory_count, slice=f'{start}-{end}', sql_count_perf_ms=int(pt0.result * 1000), API_perf_ms=int(pt1.result * 1000))
+    log.info('inventory API results', returned_count=len(inventory_records), sql_perf_ms=int(pt0.result * 1000), API_perf_ms=int(pt1.result * 1000))
     result = {
-        'last_page': math.ceil(inventory_count / size),
+        **pagination,
         'data': inventory_records
     }
     return JsonResponse(result)
 
 
-class PerfTrack:
-    def __enter__(self):
-        self.time = time.perf_counter()
-        return self
-
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        self.result = time.perf_counter() - self.time
+@replica_reads
+def inventory_export(request: HttpRequest) -> HttpResponse:
+    """
+    The whole Inventory table in one response, streamed as it is read (see inventory.export).
+    Query string: format=csv|ndjson, gzip=1, location_prefix=A-001, updated_since=2023-01-20T00:00:00Z
+    """
+    export_format = request.GET.get('format', 'csv')
+    if export_format not in FORMATS:
+        return JsonResponse({'error': f'format must be one of {", ".join(FORMATS)}'}, status=400)
+    updated_since = None
+    if request.GET.get('updated_since'):
+        try:
+            updated_since = parse_datetime(request.GET['updated_since'])
+        except ValueError:
+            pass
+        if updated_since is None:
+            return JsonResponse({'error': 'updated_since must be an ISO 8601 datetime'}, status=400)
+    gzip = request.GET.get('gzip') == '1'
+
+    log.info('inventory export requested', export_format=export_format, gzip=gzip,
+             location_prefix=request.GET.get('location_prefix'), updated_since=updated_since)
+    response = StreamingHttpResponse(
+        export(export_format, gzip=gzip, location_prefix=request.GET.get('location_prefix'),
+               updated_since=updated_since),
+        content_type=FORMATS[export_format],
+    )
+    filename = f'inventory.{export_format}' + ('.gz' if gzip else '')
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response